@@ -0,0 +1,119 @@
+import numpy as np
+from ECFM_NN_helpers import get_sensitivity
+
+BASIS_PROFILES = ['Constant', 'Linear', 'Parabolic', 'Power']
+
+def get_profile_basis(profile_type, rad_pos):
+    ''' Gets the shape vectors that the constant, linear and parabolic profile families are combinations of
+
+    Each profile of these families is v = temp_max_vel * basis[0] + temp_min_vel * basis[1] (the constant
+    family only has basis[0]), which matches the profiles made by the sample_*_profiles functions
+
+    Args:
+        profile_type: one of 'Constant', 'Linear' or 'Parabolic'
+        rad_pos: A list of radial positions where the velocity profile should be sampled
+    Returns:
+        (k, N) ndarray of basis vectors
+    '''
+    if profile_type == 'Constant':
+        return np.ones((1, len(rad_pos)))
+    scaled_rad_pos = rad_pos / rad_pos[-1]
+    if profile_type == 'Linear':
+        weight = (scaled_rad_pos - scaled_rad_pos[0]) / (scaled_rad_pos[-1] - scaled_rad_pos[0])
+    elif profile_type == 'Parabolic':
+        shape = 1 - (scaled_rad_pos / scaled_rad_pos[-1])**2
+        weight = 1 - shape / (1 - (scaled_rad_pos[0] / scaled_rad_pos[-1])**2)
+    else:
+        raise ValueError('No fixed basis for profile type: ' + profile_type)
+    return np.stack([1 - weight, weight])
+
+def get_power_basis(rad_pos, R, min_n, max_n, num_n=64):
+    ''' Tabulates the normalized power law shape ((1 - r / R) / (1 - r_0 / R))^(1 / n) on a grid of exponents
+
+    The grid is uniform in 1 / n, in which the shape changes smoothly, so that linear interpolation
+    between neighbouring rows is accurate
+
+    Args:
+        rad_pos: A list of radial positions where the velocity profile should be sampled
+        R: The inner radius of the pipe being modeled
+        min_n: the smallest power law exponent
+        max_n: the largest power law exponent
+        num_n: the number of tabulated exponents. Default = 64
+    Returns:
+        inverse_n: (num_n, ) ndarray of the tabulated values of 1 / n in increasing order
+        basis: (num_n, N) ndarray of the shape vector for each tabulated exponent
+    '''
+    scaled_rad_pos = rad_pos / R
+    inverse_n = np.linspace(1 / max_n, 1 / min_n, num_n)
+    ratio = (1 - scaled_rad_pos) / (1 - scaled_rad_pos[0])
+    return inverse_n, ratio.reshape(1, -1)**inverse_n.reshape(-1, 1)
+
+def generate_basis_data(A, profile_type, size, min_vel, max_vel, rad_pos, R=None, min_n=None, max_n=None,
+                        rng=None, num_n=64, compact=False, with_bs=False):
+    ''' Generates the same data as generate_*_data for the parametric families by projecting a precomputed basis
+
+    Since b = A * v is linear and every constant, linear and parabolic profile is a combination of k <= 2
+    fixed shape vectors, A * basis is computed once and each b costs O(M * k) instead of O(M * N). The power
+    family uses the tabulated basis of get_power_basis, with A * basis computed once for the whole table and
+    b and v both interpolated between the two nearest exponents, so b = A * v holds exactly for every pair while
+    v differs from the exact power profile by the interpolation error (below 5e-6 relative for the default
+    num_n = 64 and 5 <= n <= 10). The random parameters are drawn in the same order as the sample_*_profiles
+    functions, so for the same rng the profiles match those of generate_*_data (up to that error for Power).
+
+    Args:
+        A: the matrix generated from the COMSOL simulation, (M, N)
+        profile_type: one of 'Constant', 'Linear', 'Parabolic' or 'Power'
+        size: the number of pairs of sensitivity, velocity vectors that you want to generate
+        min_vel: the minimum fluid velocity that will be included in the sensitivity generation
+        max_vel: the maximum fluid velocity that will be included in the sensitivity generation
+        rad_pos: A list of radial positions where the velocity profile should be sampled
+        R: The inner radius of the pipe being modeled. Needed by the Power family
+        min_n: the smallest power law exponent. Needed by the Power family
+        max_n: the largest power law exponent. Needed by the Power family
+        rng: the numpy Generator used to draw the random parameters. Default = None (the global np.random state)
+        num_n: the number of tabulated exponents for the Power family, at least 2. Default = 64
+        compact: An option to return the float32 layout of get_compact_profile_data instead. Default = False
+        with_bs: With compact, an option to also return the b vectors. Default = False
+    Returns:
+        sensitivity: (size, M, 1) ndarray of sensitivity matricies.
+        velocity_profile: (size, N, 1) ndarray of corrisponding velocty profiles.
+        phases: (size, M, 1) of phases of the values in b
+        bs: (size, M, 1) ndarray of both the real and imginary components of the b vector
+        When compact is True the (inputs, velocity_profile[, bs]) of get_compact_profile_data are returned instead
+    '''
+    if rng is None:
+        rng = np.random
+    profile_type = profile_type.replace('_With_Phase', '')
+    temp_max_vel = rng.uniform(min_vel, max_vel, (size, 1))
+    if profile_type == 'Power':
+        # the exponents are interpolated between neighbouring rows of the table, which needs two distinct rows
+        if min_n is None or max_n is None or not min_n < max_n:
+            raise ValueError('The Power family needs min_n < max_n, got min_n = ' + str(min_n) + ', max_n = ' + str(max_n))
+        if num_n < 2:
+            raise ValueError('The Power family needs num_n >= 2 tabulated exponents, got ' + str(num_n))
+        n = rng.uniform(min_n, max_n, (size, 1))
+        inverse_n, basis = get_power_basis(rad_pos, R, min_n, max_n, num_n)
+        projected_basis = np.matmul(A, basis.T)
+        # linear interpolation weights between the tabulated exponents
+        position = np.clip((1 / n[:, 0] - inverse_n[0]) / (inverse_n[1] - inverse_n[0]), 0, num_n - 1)
+        lower = np.minimum(position.astype(int), num_n - 2)
+        fraction = (position - lower).reshape(-1, 1)
+        bs = temp_max_vel * ((1 - fraction) * projected_basis.T[lower] + fraction * projected_basis.T[lower + 1])
+        # the profiles are interpolated with the same weights as b, so every (b, v) pair is exactly b = A * v
+        velocity_profile = temp_max_vel * ((1 - fraction) * basis[lower] + fraction * basis[lower + 1])
+    else:
+        basis = get_profile_basis(profile_type, rad_pos)
+        coefficients = temp_max_vel
+        if basis.shape[0] == 2:
+            coefficients = np.concatenate([temp_max_vel, rng.uniform(min_vel, temp_max_vel)], axis=1)
+        projected_basis = np.matmul(A, basis.T)
+        bs = np.matmul(coefficients, projected_basis.T)
+        velocity_profile = np.matmul(coefficients, basis)
+
+    if compact:
+        inputs = np.concatenate([get_sensitivity(bs), np.angle(bs)], axis=1).astype(np.float32)
+        if with_bs:
+            return inputs, velocity_profile.astype(np.float32), bs
+        return inputs, velocity_profile.astype(np.float32)
+    return (get_sensitivity(bs)[:, :, np.newaxis], velocity_profile[:, :, np.newaxis],
+            np.angle(bs)[:, :, np.newaxis], bs[:, :, np.newaxis])
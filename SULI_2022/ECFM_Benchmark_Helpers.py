@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import numpy as np
+
+# helper modules that should import without any of HEAVY_MODULES
+LIGHT_MODULES = ['ECFM_NN_helpers', 'ECFM_Data_Helpers', 'ECFM_Parallel_Helpers', 'ECFM_Cache_Helpers',
+                 'ECFM_Input_Helpers', 'ECFM_Basis_Helpers', 'ECFM_Inference_Helpers',
+                 'ECFM_Uncertainty_Helpers', 'ECFM_Validation_Helpers', 'ECFM_Metrics_Helpers']
+HEAVY_MODULES = ['tensorflow', 'keras', 'sklearn', 'matplotlib']
+# seconds, generous enough for numpy on a slow machine but far below the cost of importing TensorFlow
+IMPORT_TIME_BUDGET = 1.0
+
+_IMPORT_SCRIPT = '''
+import sys, time, json
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [name for name in %r if name in sys.modules]]))
+'''
+
+def measure_import_time(module_name, repeats=5):
+    ''' Measures the time taken to import a module in a fresh interpreter
+
+    Every repeat runs in its own subprocess so nothing is already cached in sys.modules
+
+    Args:
+        module_name: the name of the module to import
+        repeats: the number of fresh imports that are timed. Default = 5
+    Returns:
+        import_time: the median import time [s]
+        heavy_modules: the modules of HEAVY_MODULES that were loaded by the import
+    '''
+    times = []
+    heavy_modules = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', _IMPORT_SCRIPT % (module_name, HEAVY_MODULES)],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout
+        elapsed, heavy_modules = json.loads(output.strip().splitlines()[-1])
+        times.append(elapsed)
+    return float(np.median(times)), heavy_modules
+
+def check_import_times(modules=LIGHT_MODULES, budget=IMPORT_TIME_BUDGET, repeats=5):
+    ''' Checks that the helper modules import quickly and without the heavy dependencies
+
+    Args:
+        modules: the names of the modules to check. Default = LIGHT_MODULES
+        budget: the longest acceptable median import time [s]. Default = IMPORT_TIME_BUDGET
+        repeats: the number of fresh imports timed per module. Default = 5
+    Returns:
+        results: dict of module name -> (import time, heavy modules loaded)
+        failures: list of messages for the modules that are over budget or load a heavy dependency
+    '''
+    results = {}
+    failures = []
+    for module_name in modules:
+        import_time, heavy_modules = measure_import_time(module_name, repeats)
+        results[module_name] = (import_time, heavy_modules)
+        if import_time > budget:
+            failures.append('%s took %.3f s to import (budget %.3f s)' % (module_name, import_time, budget))
+        if heavy_modules:
+            failures.append('%s imports %s' % (module_name, ', '.join(heavy_modules)))
+    return results, failures
+
+def compare_sampler_variance(predict_velocity, velocity_profile, sensitivity, error_factor,
+                             sample_counts=(2**8, 2**10, 2**12, 2**14), repeats=16, phase=None,
+                             samplers=('random', 'latin_hypercube', 'sobol'), seed=0):
+    ''' Compares the variance of the Monte Carlo RMSE estimate of the noise samplers against the sample count
+
+    Every sampler estimates the RMSE repeats times with independent seeds for each sample count, and the
+    variance of those estimates shows how many model evaluations each one needs for a given accuracy
+
+    Args:
+        predict_velocity: function (sensitivity, phase) -> velocity, see get_velocity_predictor
+        velocity_profile: the velocity profile behind sensitivity
+        sensitivity: the noiseless sensitivity vector, shape (1, M)
+        error_factor: the relative standard deviation of the sensitivity noise
+        sample_counts: the sample counts compared. Default = (2**8, 2**10, 2**12, 2**14)
+        repeats: the number of independent estimates per sample count. Default = 16
+        phase: the phase vector for models trained with phase. Default = None
+        samplers: the names of the samplers compared, see get_noise_sampler. Default = every one but 'antithetic',
+                  whose pairs do not reduce the variance of the RMSE
+        seed: the seed of the first repeat. Default = 0
+    Returns:
+        dict of sampler name -> array with the variance of the RMSE estimate averaged over the profile points,
+        one entry per sample count
+    '''
+    from ECFM_Uncertainty_Helpers import monte_carlo_errors
+    results = {}
+    for sampler in samplers:
+        variances = []
+        for num_samples in sample_counts:
+            estimates = [monte_carlo_errors(predict_velocity, velocity_profile, sensitivity, error_factor, num_samples,
+                                            phase=phase, rng=np.random.default_rng(seed + repeat),
+                                            sampler=sampler).rmse
+                         for repeat in range(repeats)]
+            variances.append(np.mean(np.var(estimates, axis=0, ddof=1)))
+        results[sampler] = np.array(variances)
+    return results
+
+def print_sampler_variance(results, sample_counts=(2**8, 2**10, 2**12, 2**14)):
+    ''' Prints the variances from compare_sampler_variance and their reduction relative to the first sampler '''
+    reference = next(iter(results.values()))
+    print('%-16s' % 'samples' + ''.join('%12d' % num_samples for num_samples in sample_counts))
+    for sampler, variances in results.items():
+        print('%-16s' % sampler + ''.join('%12.3E' % variance for variance in variances))
+        print('%-16s' % '  reduction' + ''.join('%12.1f' % ratio for ratio in reference / variances))
+
+def compare_linearized_monte_carlo(model, scaler, velocity_profile, sensitivity, error_factors=(0.001, 0.01, 0.05),
+                                   num_samples=2**16, phase=None, phase_shift=None, seed=0):
+    ''' Cross checks the linearized uncertainty propagation against Monte Carlo for increasing noise
+
+    The two agree for small noise and drift apart as the curvature of the model over the spread of the noise
+    starts to matter, which shows up to which error_factor the linearized method can be trusted
+
+    Args:
+        model: a Keras model or a NumpyModel
+        scaler: the Scaler of the model
+        velocity_profile: the (N, ) profile the predictions are compared to [m/s]
+        sensitivity: the (M, ) sensitivity the noise is added to [V]
+        error_factors: the noise levels compared. Default = (0.001, 0.01, 0.05)
+        num_samples: the number of Monte Carlo samples per noise level. Default = 2**16
+        phase: the (M, ) phases for models trained with phase. Default = None
+        phase_shift: the shift added to the phases before scaling. Default = None (the shift of the scaler)
+        seed: the seed of the Monte Carlo noise. Default = 0
+    Returns:
+        list with a dictionary per error factor of the largest relative differences of the std and RMSE
+        of the components and the time taken by each method [s]
+    '''
+    from ECFM_Uncertainty_Helpers import (get_velocity_predictor, get_velocity_jacobian, linearized_errors,
+                                          monte_carlo_errors)
+    predict_velocity = get_velocity_predictor(model, scaler, phase_shift=phase_shift)
+    results = []
+    for error_factor in error_factors:
+        start = time.perf_counter()
+        jacobian = get_velocity_jacobian(model, scaler, sensitivity, phase=phase, phase_shift=phase_shift)
+        linearized = linearized_errors(predict_velocity, jacobian, velocity_profile, sensitivity, error_factor,
+                                       phase=phase)
+        linearized_time = time.perf_counter() - start
+        start = time.perf_counter()
+        monte_carlo = monte_carlo_errors(predict_velocity, velocity_profile, sensitivity, error_factor, num_samples,
+                                         phase=phase, rng=np.random.default_rng(seed))
+        monte_carlo_time = time.perf_counter() - start
+        results.append({'error_factor': error_factor,
+                        'std_difference': float(np.max(np.abs(linearized.std / monte_carlo.std - 1))),
+                        'rmse_difference': float(np.max(np.abs(linearized.rmse / monte_carlo.rmse - 1))),
+                        'linearized_time': linearized_time,
+                        'monte_carlo_time': monte_carlo_time})
+    return results
+
+def print_linearized_monte_carlo(results):
+    ''' Prints the cross check from compare_linearized_monte_carlo '''
+    print('%12s %12s %12s %16s %17s' % ('error factor', 'std diff %', 'RMSE diff %', 'linearized [ms]', 'Monte Carlo [ms]'))
+    for result in results:
+        print('%12g %12.2f %12.2f %16.2f %17.2f' % (result['error_factor'], 100 * result['std_difference'],
+                                                    100 * result['rmse_difference'], 1e3 * result['linearized_time'],
+                                                    1e3 * result['monte_carlo_time']))
+
+def main():
+    results, failures = check_import_times()
+    for module_name, (import_time, heavy_modules) in results.items():
+        print('%-28s %8.1f ms  %s' % (module_name, 1e3 * import_time, ', '.join(heavy_modules)))
+    for failure in failures:
+        print('FAIL:', failure)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+from ECFM_Parallel_Helpers import generate_parallel_data
+
+CACHE_ARRAYS = ['sensitivity', 'velocity', 'phase']
+
+def get_file_hash(path):
+    ''' Calculates the sha256 hex digest of a file's contents
+
+    Args:
+        path: the location of the file
+    Returns:
+        The hex digest of the file
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_dataset_key(matrix_file, generator_name, generator_args, seed):
+    ''' Creates the content addressed key of a generated data set
+
+    Args:
+        matrix_file: the location of the COMSOL A matrix csv used to generate the data
+        generator_name: the name of the generate_*_data function used
+        generator_args: a dictionary of the arguments passed to the generator (size, min_vel, rad_pos, ...)
+        seed: the seed used for the random number generation
+    Returns:
+        A hex digest that changes whenever the matrix contents, generator, arguments or seed change
+    '''
+    digest = hashlib.sha256(get_file_hash(matrix_file).encode())
+    args = {key: np.asarray(value).tolist() for key, value in generator_args.items()}
+    description = json.dumps({'generator': generator_name, 'args': args, 'seed': seed}, sort_keys=True)
+    digest.update(description.encode())
+    return digest.hexdigest()
+
+def load_cached_dataset(cache_dir, key):
+    ''' Opens a cached data set as read only memory mapped arrays
+
+    Args:
+        cache_dir: the directory holding the cached data sets
+        key: the key of the data set, see get_dataset_key
+    Returns:
+        sensitivity, velocity and phase as float32 memory mapped arrays or None if the data set is not cached
+    '''
+    path_to_entry = os.path.join(cache_dir, key)
+    path_to_manifest = os.path.join(path_to_entry, 'manifest.json')
+    if not os.path.isfile(path_to_manifest):
+        return None
+    # the modification time of the manifest marks the last use of the entry for eviction
+    os.utime(path_to_manifest)
+    return tuple(np.load(os.path.join(path_to_entry, name + '.npy'), mmap_mode='r') for name in CACHE_ARRAYS)
+
+def save_cached_dataset(cache_dir, key, sensitivity, velocity, phase, description=None):
+    ''' Stores a generated data set in the cache as float32 .npy shards
+
+    The entry is written to a temporary directory and renamed into place so a killed run never leaves
+    a partial entry behind
+
+    Args:
+        cache_dir: the directory holding the cached data sets
+        key: the key of the data set, see get_dataset_key
+        sensitivity: the sensitivity data to be stored
+        velocity: the velocity data to be stored
+        phase: the phase data to be stored
+        description: an optional dictionary saved with the entry to describe how it was generated
+    Returns:
+        The location of the new cache entry
+    '''
+    path_to_entry = os.path.join(cache_dir, key)
+    path_to_tmp = path_to_entry + '.tmp%d' % os.getpid()
+    os.makedirs(path_to_tmp, exist_ok=True)
+    size_bytes = 0
+    for name, data in zip(CACHE_ARRAYS, [sensitivity, velocity, phase]):
+        data = np.asarray(data, dtype=np.float32)
+        np.save(os.path.join(path_to_tmp, name + '.npy'), data)
+        size_bytes += data.nbytes
+    with open(os.path.join(path_to_tmp, 'manifest.json'), 'w') as f:
+        json.dump({'key': key, 'created': time.time(), 'size_bytes': size_bytes,
+                   'description': description}, f, indent=4, default=str)
+    if os.path.isdir(path_to_entry):
+        # another run cached the same data set first
+        shutil.rmtree(path_to_tmp)
+    else:
+        os.rename(path_to_tmp, path_to_entry)
+    return path_to_entry
+
+def evict_dataset_cache(cache_dir, max_bytes=None, max_age=None, keep=()):
+    ''' Removes cached data sets so the cache stays within a total size and age
+
+    Args:
+        cache_dir: the directory holding the cached data sets
+        max_bytes: the largest total size of the cache in bytes. The least recently used entries are removed
+                   first. Default = None (no size limit)
+        max_age: the longest time in seconds an entry may go unused before it is removed. Default = None (no age limit)
+        keep: the keys that are never removed, e.g. the entry that was just written. Default = ()
+    Returns:
+        A list of the keys that were removed
+    '''
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for key in os.listdir(cache_dir):
+        path_to_manifest = os.path.join(cache_dir, key, 'manifest.json')
+        if not os.path.isfile(path_to_manifest):
+            continue
+        with open(path_to_manifest, 'r') as f:
+            size_bytes = json.load(f)['size_bytes']
+        entries.append((os.path.getmtime(path_to_manifest), size_bytes, key))
+    # oldest entries first
+    entries.sort()
+    removed = []
+    total_bytes = sum(entry[1] for entry in entries)
+    now = time.time()
+    for last_used, size_bytes, key in entries:
+        if key in keep:
+            continue
+        too_old = max_age is not None and now - last_used > max_age
+        too_big = max_bytes is not None and total_bytes > max_bytes
+        if not too_old and not too_big:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, key))
+        total_bytes -= size_bytes
+        removed.append(key)
+    return removed
+
+def generate_cached_data(generator, A, matrix_file, size, seed, cache_dir='ECFM_Dataset_Cache',
+                         max_cache_bytes=None, max_cache_age=None, workers=1, **generator_args):
+    ''' Returns a data set from the cache or generates and caches it when it has not been generated before
+
+    Args:
+        generator: the generate_*_data function used to create the data (e.g. generate_power_data)
+        A: the matrix generated from the COMSOL simulation, (M, N)
+        matrix_file: the location of the csv that A was read from. Its contents are part of the cache key
+        size: the number of pairs of sensitivity, velocity vectors that you want to generate
+        seed: the seed used for the random number generation, see generate_parallel_data
+        cache_dir: the directory holding the cached data sets. Default = 'ECFM_Dataset_Cache'
+        max_cache_bytes: the largest total size of the cache after a new entry is added. A data set larger than
+                         it is generated and returned without being cached. Default = None
+        max_cache_age: the longest time in seconds an unused entry is kept. Default = None
+        workers: the number of processes used to generate a missing data set. Default = 1
+        generator_args: the remaining arguments of the generator (min_vel, max_vel, rad_pos, R, min_n, max_n)
+    Returns:
+        sensitivity: (size, M, 1) float32 read only memory mapped array of sensitivities
+        velocity_profile: (size, N, 1) float32 read only memory mapped array of velocity profiles
+        phases: (size, M, 1) float32 read only memory mapped array of phases
+        The arrays are read only in memory arrays instead when the data set does not fit in max_cache_bytes
+    '''
+    # the models with and without phase use different frequencies of the same matrix file
+    key = get_dataset_key(matrix_file, generator.__name__, dict(generator_args, size=size, num_freq=A.shape[0]), seed)
+    cached = load_cached_dataset(cache_dir, key)
+    if cached is not None:
+        return cached
+    data = generate_parallel_data(generator, A, size, seed, workers=workers, with_bs=False, **generator_args)
+    # the float32 sensitivity, velocity and phase shards, known before anything is written
+    size_bytes = size * (2 * A.shape[0] + A.shape[1]) * np.dtype(np.float32).itemsize
+    if max_cache_bytes is not None and size_bytes > max_cache_bytes:
+        # a data set that can never fit is returned uncached rather than evicting every other entry
+        data = tuple(np.asarray(values, dtype=np.float32) for values in data)
+        for values in data:
+            values.flags.writeable = False
+        return data
+    save_cached_dataset(cache_dir, key, *data,
+                        description={'generator': generator.__name__, 'size': size, 'seed': seed,
+                                     'matrix_file': matrix_file})
+    if max_cache_bytes is not None or max_cache_age is not None:
+        evict_dataset_cache(cache_dir, max_bytes=max_cache_bytes, max_age=max_cache_age, keep=[key])
+    del data
+    return load_cached_dataset(cache_dir, key)
+    sensitivity, velocity, phase = generate_parallel_data(generator, A, size, seed, workers=workers,
+                                                          with_bs=False, **generator_args)
+    save_cached_dataset(cache_dir, key, sensitivity, velocity, phase,
+                        description={'generator': generator.__name__, 'size': size, 'seed': seed,
+                                     'matrix_file': matrix_file})
+    del sensitivity, velocity, phase
+    if max_cache_bytes is not None or max_cache_age is not None:
+        evict_dataset_cache(cache_dir, max_bytes=max_cache_bytes, max_age=max_cache_age)
+    cached = load_cached_dataset(cache_dir, key)
+    if cached is None:
+        # the new entry was itself evicted because it is larger than max_cache_bytes
+        raise ValueError('Data set of %d samples does not fit in a cache of %d bytes' % (size, max_cache_bytes))
+    return cached
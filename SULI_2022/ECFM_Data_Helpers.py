@@ -0,0 +1,304 @@
+import os
+import numpy as np
+from ECFM_NN_helpers import get_profile_data, get_compact_profile_data, Scaler
+from ECFM_NN_helpers import sample_constant_profiles, sample_linear_profiles, sample_parabolic_profiles
+from ECFM_NN_helpers import sample_power_profiles, sample_monotonic_profiles, sample_random_profiles
+
+def sample_profiles(profile_type, size, num_vel, min_vel, max_vel, rad_pos=None, R=None, min_n=None, max_n=None, rng=None):
+    ''' Samples a block of velocity profiles from one of the generate_*_data families by name
+
+    Args:
+        profile_type: the family of profile to sample. One of 'Constant', 'Linear', 'Parabolic', 'Power',
+                      'Monotonic' or 'Random'
+        size: the number of velocity profiles to generate
+        num_vel: the number of components in each velocity profile
+        min_vel: the minimum fluid velocity
+        max_vel: the maximum fluid velocity
+        rad_pos: A list of radial positions where the velocity profile should be sampled.
+                 Needed by the Linear, Parabolic and Power families
+        R: The inner radius of the pipe being modeled. Needed by the Power family
+        min_n: the smallest power law exponent. Needed by the Power family
+        max_n: the largest power law exponent. Needed by the Power family
+        rng: the numpy Generator used to draw the random parameters. Default = None (the global np.random state)
+    Returns:
+        (size, num_vel) ndarray of velocity profiles
+    '''
+    profile_type = profile_type.replace('_With_Phase', '')
+    if profile_type == 'Constant':
+        return sample_constant_profiles(size, num_vel, min_vel, max_vel, rng=rng)
+    if profile_type == 'Linear':
+        return sample_linear_profiles(size, min_vel, max_vel, rad_pos, rng=rng)
+    if profile_type == 'Parabolic':
+        return sample_parabolic_profiles(size, min_vel, max_vel, rad_pos, rng=rng)
+    if profile_type == 'Power':
+        return sample_power_profiles(size, min_vel, max_vel, rad_pos, R, min_n, max_n, rng=rng)
+    if profile_type == 'Monotonic':
+        return sample_monotonic_profiles(size, num_vel, min_vel, max_vel, rng=rng)
+    if profile_type == 'Random':
+        return sample_random_profiles(size, num_vel, min_vel, max_vel, rng=rng)
+    raise ValueError('Unknown profile type: ' + profile_type)
+
+def fit_scaler(A, profile_type, min_vel, max_vel, num_samples=2**14, phase_shift=0, with_phase=True,
+               batch_size=2**14, rng=None, **profile_args):
+    ''' Fits a Scaler over streamed batches of the profile family without holding the samples in memory
+
+    Args:
+        A: the matrix generated from the COMSOL simulation, (M, N)
+        profile_type: the family of profile used for training, see sample_profiles
+        min_vel: the minimum fluid velocity
+        max_vel: the maximum fluid velocity
+        num_samples: the number of profiles the scaler is fitted on. Default = 2**14
+        phase_shift: the shift added to the phases before scaling. Default = 0
+        with_phase: if the network inputs contain the phases after the sensitivities. Default = True
+        batch_size: the number of profiles generated at once. Default = 2**14
+        rng: the numpy Generator used to draw the profiles. Default = None (the global np.random state)
+        profile_args: the extra arguments needed by the profile family (rad_pos, R, min_n, max_n)
+    Returns:
+        The fitted Scaler
+    '''
+    scaler = Scaler(max_vel, phase_shift=phase_shift, with_phase=with_phase)
+    for start in range(0, num_samples, batch_size):
+        size = min(batch_size, num_samples - start)
+        velocity = sample_profiles(profile_type, size, A.shape[1], min_vel, max_vel, rng=rng, **profile_args)
+        inputs = get_compact_profile_data(A, velocity)[0]
+        if not with_phase:
+            inputs = inputs[:, :A.shape[0]]
+        scaler.partial_fit(inputs)
+    return scaler
+
+def estimate_scale_factors(A, profile_type, min_vel, max_vel, num_samples=2**14, phase_shift=0, **profile_args):
+    ''' Estimates the sensitivity and phase scale factors from a pilot sample of the profile family
+
+    A streamed data set is never held in memory as a whole so the scale factors that get_with_phase_input
+    would normally compute from the full training set are taken from a smaller pilot sample instead
+
+    Args:
+        A: the matrix generated from the COMSOL simulation, (M, N)
+        profile_type: the family of profile used for training, see sample_profiles
+        min_vel: the minimum fluid velocity
+        max_vel: the maximum fluid velocity
+        num_samples: the number of profiles in the pilot sample. Default = 2**14
+        phase_shift: the shift added to the phases before scaling. Default = 0
+        profile_args: the extra arguments needed by the profile family (rad_pos, R, min_n, max_n)
+    Returns:
+        sensitivity_scale_factor: The factor the sensitivity should be scaled by
+        phase_scale_factor: The factor the phase should be scaled by
+    '''
+    scaler = fit_scaler(A, profile_type, min_vel, max_vel, num_samples=num_samples, phase_shift=phase_shift, **profile_args)
+    return scaler.sensitivity_scale_factor, scaler.phase_scale_factor
+
+def make_scaled_batch(A, velocity, max_vel, sensitivity_scale_factor, phase_scale_factor=None, phase_shift=0, scaler=None):
+    ''' Turns a block of velocity profiles into a scaled float32 (input, target) pair for the NN
+
+    The batch is built in the compact layout of get_compact_profile_data and scaled in place by a Scaler,
+    so no intermediate float64 or concatenated copies are made
+
+    Args:
+        A: the matrix generated from the COMSOL simulation, (M, N)
+        velocity: (size, N) ndarray of velocity profiles
+        max_vel: The maximum possible velocity in the training set
+        sensitivity_scale_factor: The factor the sensitivity is scaled by
+        phase_scale_factor: The factor the phase is scaled by. If None only the sensitivity is used as input
+        phase_shift: the shift added to the phases before scaling. Default = 0
+        scaler: An optional fitted Scaler that is used instead of max_vel and the scale factors. Default = None
+    Returns:
+        inputs: (size, M) or (size, 2M) float32 ndarray of scaled network inputs
+        targets: (size, N) float32 ndarray of scaled velocity profiles
+    '''
+    if scaler is None:
+        scaler = Scaler(max_vel, sensitivity_scale_factor, phase_scale_factor, phase_shift,
+                        with_phase=phase_scale_factor is not None)
+    inputs, targets = get_compact_profile_data(A, velocity)
+    if not scaler.with_phase:
+        inputs = np.ascontiguousarray(inputs[:, :A.shape[0]])
+    return scaler.transform(inputs), scaler.transform_velocity(targets)
+
+class _ECFMSequence:
+    ''' Keras Sequence that synthesizes, scales and batches ECFM training data on the fly
+
+    Only one batch is ever materialized per worker so memory use is bounded by batch_size no matter how many
+    samples the model is trained on. Each epoch draws fresh profiles. When a seed is given every batch draws
+    from its own random stream spawned from (seed, epoch, batch index), so the data does not depend on the
+    order or number of workers that build the batches. The sequence can be passed directly to
+    model.fit for a model built by create_model with input_shape (2M, ) (or (M, ) without phase) and
+    background workers can be used through the workers/use_multiprocessing arguments of model.fit
+
+    Args:
+        A: the matrix generated from the COMSOL simulation, (M, N)
+        profile_type: the family of profile to train on, see sample_profiles
+        size: the number of samples per epoch
+        batch_size: the number of samples in each batch
+        min_vel: the minimum fluid velocity
+        max_vel: the maximum fluid velocity
+        sensitivity_scale_factor: The factor the sensitivity is scaled by, see fit_scaler. Required unless a
+                                  fitted scaler is given
+        phase_scale_factor: The factor the phase is scaled by. If None only the sensitivity is used as input
+        phase_shift: the shift added to the phases before scaling. Default = 0
+        seed: the seed of the per batch random streams. Default = None (the global np.random state)
+        scaler: An optional fitted Scaler that is used instead of max_vel and the scale factors. Default = None
+        profile_args: the extra arguments needed by the profile family (rad_pos, R, min_n, max_n)
+    '''
+    def __init__(self, A, profile_type, size, batch_size, min_vel, max_vel,
+                 sensitivity_scale_factor=None, phase_scale_factor=None, phase_shift=0, seed=None, scaler=None,
+                 **profile_args):
+        super().__init__()
+        self.A = A
+        self.profile_type = profile_type
+        self.size = size
+        self.batch_size = batch_size
+        self.min_vel = min_vel
+        self.max_vel = max_vel
+        self.sensitivity_scale_factor = sensitivity_scale_factor
+        self.phase_scale_factor = phase_scale_factor
+        self.phase_shift = phase_shift
+        self.seed = seed
+        self.epoch = 0
+        if scaler is None:
+            scaler = Scaler(max_vel, sensitivity_scale_factor, phase_scale_factor, phase_shift,
+                            with_phase=phase_scale_factor is not None)
+        # fails here rather than in the first batch a keras worker builds
+        scaler.check_fitted()
+        self.scaler = scaler
+        self.profile_args = profile_args
+
+    def __len__(self):
+        return int(np.ceil(self.size / self.batch_size))
+
+    def __getitem__(self, idx):
+        # the last batch may be smaller than batch_size
+        size = min(self.batch_size, self.size - idx * self.batch_size)
+        rng = None
+        if self.seed is not None:
+            rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(self.epoch, idx)))
+        velocity = sample_profiles(self.profile_type, size, self.A.shape[1], self.min_vel, self.max_vel,
+                                   rng=rng, **self.profile_args)
+        return make_scaled_batch(self.A, velocity, self.max_vel, self.sensitivity_scale_factor,
+                                 self.phase_scale_factor, self.phase_shift, scaler=self.scaler)
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+def __getattr__(name):
+    # ECFMSequence has to subclass keras.utils.Sequence, so the class is only built (and TensorFlow imported)
+    # the first time it is used. Pickling still works since the class is found under the same module name
+    if name == 'ECFMSequence':
+        from tensorflow import keras
+        globals()[name] = type(name, (_ECFMSequence, keras.utils.Sequence),
+                               {'__doc__': _ECFMSequence.__doc__, '__module__': __name__})
+        return globals()[name]
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+def make_streaming_dataset(sequence, num_parallel_calls=None, prefetch=None):
+    ''' Wraps an ECFMSequence in a tf.data pipeline that builds batches in parallel and prefetches them
+
+    Args:
+        sequence: the ECFMSequence that produces the batches
+        num_parallel_calls: the number of batches built concurrently. Default = None (tf.data.AUTOTUNE)
+        prefetch: the number of batches prepared ahead of the training step. Default = None (tf.data.AUTOTUNE)
+    Returns:
+        A tf.data.Dataset of (input, target) batches that can be passed directly to model.fit
+    '''
+    import tensorflow as tf
+    if num_parallel_calls is None:
+        num_parallel_calls = tf.data.AUTOTUNE
+    if prefetch is None:
+        prefetch = tf.data.AUTOTUNE
+    num_inputs = sequence.A.shape[0]
+    if sequence.scaler.with_phase:
+        num_inputs *= 2
+    num_outputs = sequence.A.shape[1]
+
+    def get_batch(idx):
+        inputs, targets = tf.numpy_function(lambda i: sequence[int(i)], [idx], [tf.float32, tf.float32])
+        inputs.set_shape((None, num_inputs))
+        targets.set_shape((None, num_outputs))
+        return inputs, targets
+
+    dataset = tf.data.Dataset.range(len(sequence))
+    dataset = dataset.map(get_batch, num_parallel_calls=num_parallel_calls, deterministic=False)
+    return dataset.prefetch(prefetch)
+
+def compose_mixed_data(A, size, family_weights, min_vel, max_vel, seed, family_args=None, compact=False,
+                       shard_size=2**18, out_dir=None, **profile_args):
+    ''' Generates a shuffled mixture of profile families in one pass, written directly into preallocated buffers
+
+    The family of every sample is decided and shuffled up front from the family weights. The samples are then
+    generated shard by shard: for each family only the rows of the shard that belong to it are generated and
+    scattered into place, so no per family arrays are concatenated and the mixture is never shuffled as a whole.
+    Every shard draws from its own random stream spawned from seed, so the result only depends on the seed and
+    shard_size.
+
+    Args:
+        A: the matrix generated from the COMSOL simulation, (M, N)
+        size: the total number of pairs of sensitivity, velocity vectors that you want to generate
+        family_weights: a dictionary of profile family name (see sample_profiles) to its relative weight
+                        e.g. {'Power': 2, 'Parabolic': 1, 'Monotonic': 1}
+        min_vel: the minimum fluid velocity
+        max_vel: the maximum fluid velocity
+        seed: the seed of the random streams used for the family labels and the profiles
+        family_args: an optional dictionary of family name to a dictionary of arguments that override
+                     min_vel, max_vel and profile_args for that family. Default = None
+        compact: An option to produce the float32 layout of get_compact_profile_data. Default = False
+        shard_size: the number of samples generated at once. Default = 2**18
+        out_dir: An optional directory where every shard is saved as its own set of .npy files instead of
+                 being kept in memory. Default = None
+        profile_args: the extra arguments needed by the profile families (rad_pos, R, min_n, max_n)
+    Returns:
+        data: the tuple (sensitivity, velocity_profile, phases) as made by the generate_*_data functions,
+              or (inputs, velocity_profile) when compact is True. None when out_dir is given
+        labels: (size, ) int8 ndarray of the index of the family of each sample in families
+        families: the list of family names in the order used by labels
+    '''
+    if family_args is None:
+        family_args = {}
+    families = list(family_weights.keys())
+    weights = np.array([family_weights[family] for family in families], dtype=float)
+    seed_sequence = np.random.SeedSequence(seed)
+    label_sequence, shard_sequence = seed_sequence.spawn(2)
+    rng = np.random.default_rng(label_sequence)
+    counts = rng.multinomial(size, weights / np.sum(weights))
+    labels = np.repeat(np.arange(len(families), dtype=np.int8), counts)
+    rng.shuffle(labels)
+
+    num_sens = A.shape[0]
+    num_vel = A.shape[1]
+    if compact:
+        layout = [('inputs', (2 * num_sens, ), np.float32), ('velocity', (num_vel, ), np.float32)]
+    else:
+        layout = [('sensitivity', (num_sens, 1), np.float64), ('velocity', (num_vel, 1), np.float64),
+                  ('phase', (num_sens, 1), np.float64)]
+    if out_dir is None:
+        buffers = [np.empty((size, ) + shape, dtype=dtype) for name, shape, dtype in layout]
+    else:
+        os.makedirs(out_dir, exist_ok=True)
+        np.save(os.path.join(out_dir, 'labels.npy'), labels)
+
+    starts = list(range(0, size, shard_size))
+    for shard, (start, shard_seed) in enumerate(zip(starts, shard_sequence.spawn(len(starts)))):
+        stop = min(start + shard_size, size)
+        shard_rng = np.random.default_rng(shard_seed)
+        shard_labels = labels[start:stop]
+        if out_dir is None:
+            shard_buffers = [buffer[start:stop] for buffer in buffers]
+        else:
+            shard_buffers = [np.empty((stop - start, ) + shape, dtype=dtype) for name, shape, dtype in layout]
+        for label, family in enumerate(families):
+            rows = np.flatnonzero(shard_labels == label)
+            if len(rows) == 0:
+                continue
+            args = dict(profile_args, min_vel=min_vel, max_vel=max_vel)
+            args.update(family_args.get(family, {}))
+            velocity = sample_profiles(family, len(rows), num_vel, rng=shard_rng, **args)
+            if compact:
+                results = get_compact_profile_data(A, velocity)
+            else:
+                results = get_profile_data(A, velocity)
+            for shard_buffer, data in zip(shard_buffers, results):
+                shard_buffer[rows] = data
+        if out_dir is not None:
+            for (name, shape, dtype), shard_buffer in zip(layout, shard_buffers):
+                np.save(os.path.join(out_dir, 'shard_%05d_%s.npy' % (shard, name)), shard_buffer)
+
+    if out_dir is not None:
+        return None, labels, families
+    return tuple(buffers), labels, families
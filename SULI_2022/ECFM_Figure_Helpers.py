@@ -1,4 +1,4 @@
-from ECFM_NN_helpers import load_model_scaling_factors
+from ECFM_NN_helpers import load_model_scaling_factors, plot_predictions
 import matplotlib.pyplot as plt
 import numpy as np 
 plt.rcParams['mathtext.fontset'] = 'stix'
@@ -8,7 +8,7 @@ def show_prev_seperate(profile_type, figsize=(5, 5),
                        title_font_size=24, 
                        label_font_size=20,
                        tick_size=14,
-                       bins=20,history_range=(-0.1, 0.1)):
+                       bins=20,history_range=(-0.1, 0.1), density=None, density_bins=200):
     ''' Displays the training verification data set results saved at the end of the DNN training 
 
     Args: 
@@ -19,6 +19,9 @@ def show_prev_seperate(profile_type, figsize=(5, 5),
         tick_size: the size of the plots ticks. Default = 14 
         bins: The number of bins used in generating the histograms. Default = 20 
         history_range: The range of values that the histogram displays. Defualt = (-0.1, 0.1)
+        density: An option to plot the predictions as a 2D histogram, see plot_predictions. 
+                 Default = None (when there are more than DENSITY_THRESHOLD predictions)
+        density_bins: the number of bins of each axis of the 2D histogram. Default = 200 
     Returns: 
         Generates a plot with the line y=x on it and each of the DNN predictions plotted against the correct answers 
         plot is then saved as "profile_type_Velocity_Results/profile_type_line.pdf"
@@ -37,7 +40,7 @@ def show_prev_seperate(profile_type, figsize=(5, 5),
     model_answers = model_answers.reshape(-1, 1)
     line_data = line_data = np.arange(0, max_vel, max_vel * 1e-3) 
     plt.figure(figsize=figsize) 
-    plt.plot(correct_answers, model_answers, 'o')
+    plot_predictions(plt.gca(), correct_answers, model_answers, density, density_bins)
     plt.plot(line_data, line_data, '-k')
     plt.title(profile_type.replace('_With_Phase', '') + ' Model Verification', fontsize=title_font_size)
     plt.xlabel('Actual [m/s]', fontsize=label_font_size)
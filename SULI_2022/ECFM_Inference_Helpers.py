@@ -0,0 +1,182 @@
+import os
+import numpy as np
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+    'tanh': np.tanh,
+    'softplus': lambda x: np.logaddexp(0, x),
+    'swish': lambda x: x / (1 + np.exp(-x)),
+    'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    'selu': lambda x: 1.0507009873554805 * np.where(x > 0, x, 1.6732632423543772 * np.expm1(np.minimum(x, 0))),
+}
+
+# derivatives of the activations with respect to their input, used for the Jacobian of a model
+ACTIVATION_DERIVATIVES = {
+    'linear': lambda x: np.ones_like(x),
+    'relu': lambda x: (x > 0).astype(x.dtype),
+    'sigmoid': lambda x: ACTIVATIONS['sigmoid'](x) * (1 - ACTIVATIONS['sigmoid'](x)),
+    'tanh': lambda x: 1 - np.tanh(x)**2,
+    'softplus': lambda x: ACTIVATIONS['sigmoid'](x),
+    'swish': lambda x: ACTIVATIONS['sigmoid'](x) * (1 + x * (1 - ACTIVATIONS['sigmoid'](x))),
+    'elu': lambda x: np.where(x > 0, 1, np.exp(np.minimum(x, 0))),
+    'selu': lambda x: 1.0507009873554805 * np.where(x > 0, 1, 1.6732632423543772 * np.exp(np.minimum(x, 0))),
+}
+
+def get_path_to_numpy_model(profile_type):
+    ''' Gets the location of the exported NumPy version of a model
+
+    Args:
+        profile_type: The type of profile used to train the model
+    Returns:
+        The location of the .npz file
+    '''
+    return os.path.join(profile_type + '_Velocity_Results', profile_type + '_Model.npz')
+
+def export_numpy_model(profile_type, model=None, scaler=None, path_to_file=None):
+    ''' Extracts the weights and activations of a trained create_model MLP into a compact .npz file
+
+    Dropout layers are left out since they do nothing at inference time. The scaler factors are stored with
+    the weights so the exported file is all that is needed to turn measurements into velocities.
+
+    Args:
+        profile_type: The type of profile used to train the model
+        model: the trained Keras model. Default = None (loaded with load_model_and_scaler)
+        scaler: the Scaler of the model. Default = None (loaded with load_model_and_scaler)
+        path_to_file: where to save the file. Default = None (see get_path_to_numpy_model)
+    Returns:
+        The location of the .npz file
+    '''
+    if model is None or scaler is None:
+        # importing here keeps TensorFlow out of processes that only run inference
+        from ECFM_NN_helpers import load_model_and_scaler
+        loaded_model, loaded_scaler = load_model_and_scaler(profile_type)
+        model = model if model is not None else loaded_model
+        scaler = scaler if scaler is not None else loaded_scaler
+    if path_to_file is None:
+        path_to_file = get_path_to_numpy_model(profile_type)
+
+    arrays = {}
+    activations = []
+    for layer in model.layers:
+        config = layer.get_config()
+        if 'units' not in config:
+            # Input and Dropout layers have no effect on the predictions
+            continue
+        if config['activation'] not in ACTIVATIONS:
+            raise ValueError('Activation %s can not be exported' % config['activation'])
+        kernel, bias = layer.get_weights()
+        arrays['kernel_%d' % len(activations)] = kernel.astype(np.float32)
+        arrays['bias_%d' % len(activations)] = bias.astype(np.float32)
+        activations.append(config['activation'])
+
+    factors = scaler.to_dict()
+    for key in ['sensitivity_scale_factor', 'phase_scale_factor']:
+        # None can not be stored in an npz file
+        if factors[key] is None:
+            factors[key] = np.nan
+    np.savez(path_to_file, activations=np.array(activations), **arrays,
+             **{key: np.array(value) for key, value in factors.items()})
+    return path_to_file
+
+class NumpyModel:
+    ''' NumPy only forward pass of an MLP exported with export_numpy_model
+
+    predict reproduces model.predict of the Keras model to float32 tolerance without importing TensorFlow
+
+    Args:
+        path_to_file: the location of the exported .npz file
+    '''
+    def __init__(self, path_to_file):
+        with np.load(path_to_file) as data:
+            self.activations = [str(name) for name in data['activations']]
+            self.kernels = [data['kernel_%d' % i] for i in range(len(self.activations))]
+            self.biases = [data['bias_%d' % i] for i in range(len(self.activations))]
+            self.max_vel = float(data['max_vel'])
+            self.sensitivity_scale_factor = float(data['sensitivity_scale_factor'])
+            self.phase_scale_factor = float(data['phase_scale_factor'])
+            self.phase_shift = float(data['phase_shift'])
+            self.with_phase = bool(data['with_phase'])
+
+    @property
+    def num_inputs(self):
+        return self.kernels[0].shape[0]
+
+    @property
+    def num_outputs(self):
+        return self.kernels[-1].shape[1]
+
+    def predict(self, inputs, batch_size=2**16):
+        ''' Runs the network on scaled inputs
+
+        Args:
+            inputs: (num_inputs, ), (size, num_inputs) or (size, num_inputs, 1) array of scaled network inputs
+            batch_size: the number of rows pushed through the network at once to bound memory. Default = 2**16
+        Returns:
+            (size, num_outputs) float32 ndarray of scaled velocity predictions
+        '''
+        inputs = np.asarray(inputs, dtype=np.float32).reshape(-1, self.num_inputs)
+        outputs = np.empty((inputs.shape[0], self.num_outputs), dtype=np.float32)
+        for start in range(0, inputs.shape[0], batch_size):
+            x = inputs[start:start + batch_size]
+            for kernel, bias, activation in zip(self.kernels, self.biases, self.activations):
+                x = ACTIVATIONS[activation](np.matmul(x, kernel) + bias)
+            outputs[start:start + batch_size] = x
+        return outputs
+
+    def jacobian(self, inputs):
+        ''' Computes the derivatives of the scaled predictions with respect to the scaled inputs
+
+        The derivatives are carried forward through the layers in float64, so one pass gives the whole Jacobian
+
+        Args:
+            inputs: (num_inputs, ) or (size, num_inputs) array of scaled network inputs
+        Returns:
+            (size, num_outputs, num_inputs) ndarray where [k, i, j] is d output i / d input j at row k
+        '''
+        x = np.asarray(inputs, dtype=np.float64).reshape(-1, self.num_inputs)
+        jacobian = np.broadcast_to(np.eye(self.num_inputs), (x.shape[0], self.num_inputs, self.num_inputs))
+        for kernel, bias, activation in zip(self.kernels, self.biases, self.activations):
+            z = np.matmul(x, kernel) + bias
+            jacobian = ACTIVATION_DERIVATIVES[activation](z)[:, :, None] * np.einsum('kij,io->koj', jacobian, kernel)
+            x = ACTIVATIONS[activation](z)
+        return jacobian
+
+    def scale_inputs(self, sensitivity, phase=None):
+        ''' Builds the scaled (size, num_inputs) network input from measured sensitivities and phases
+
+        Args:
+            sensitivity: (M, ) or (size, M) array of sensitivities [V]
+            phase: (M, ) or (size, M) array of phases [Radians]. Only used by models trained with phase
+        Returns:
+            (size, num_inputs) float32 ndarray of scaled inputs
+        '''
+        sensitivity = np.asarray(sensitivity, dtype=np.float32)
+        num_sens = sensitivity.size if sensitivity.ndim == 1 else sensitivity.shape[1]
+        sensitivity = sensitivity.reshape(-1, num_sens) / self.sensitivity_scale_factor
+        if not self.with_phase:
+            return sensitivity
+        phase = np.asarray(phase, dtype=np.float32).reshape(-1, num_sens)
+        return np.concatenate([sensitivity, (phase + self.phase_shift) / self.phase_scale_factor], axis=1)
+
+    def predict_velocity(self, sensitivity, phase=None):
+        ''' Predicts velocity profiles in m/s from measured sensitivities and phases
+
+        Args:
+            sensitivity: (M, ) or (size, M) array of sensitivities [V]
+            phase: (M, ) or (size, M) array of phases [Radians]. Only used by models trained with phase
+        Returns:
+            (size, N) ndarray of velocity profiles [m/s]
+        '''
+        return self.predict(self.scale_inputs(sensitivity, phase)) * self.max_vel
+
+def load_numpy_model(profile_type):
+    ''' Loads the exported NumPy version of a model, see export_numpy_model
+
+    Args:
+        profile_type: The type of profile used to train the model
+    Returns:
+        The NumpyModel
+    '''
+    return NumpyModel(get_path_to_numpy_model(profile_type))
@@ -0,0 +1,215 @@
+''' Local long running server that reconstructs velocity profiles from measured ECFM sensitivity (and phase) vectors
+
+Requests arriving within a short window are stacked and pushed through the model in a single batch.
+
+Usage:
+    python ECFM_Inference_Server.py Done_With_Phase --port 8888 --window-ms 5
+
+    POST /predict   {"sensitivity": [...], "phase": [...]}  ->  {"velocity": [...]}
+    GET  /stats     latency and throughput counters
+'''
+import os
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+from collections import deque
+import tornado.web
+from ECFM_Inference_Helpers import load_numpy_model, get_path_to_numpy_model
+
+class KerasBackend:
+    ''' Runs a saved Keras model with the inputs scaled and shifted by its Scaler, like NumpyModel
+
+    Args:
+        profile_type: The type of profile used to train the model
+    '''
+    def __init__(self, profile_type):
+        from ECFM_NN_helpers import load_model_and_scaler
+        from ECFM_Uncertainty_Helpers import get_velocity_predictor
+        self.model, self.scaler = load_model_and_scaler(profile_type)
+        self.with_phase = self.scaler.with_phase
+        self.num_inputs = self.model.input_shape[1]
+        self.predict_velocity = get_velocity_predictor(self.model, self.scaler)
+
+def load_backend(profile_type, backend='auto'):
+    ''' Loads the model used by the server
+
+    Args:
+        profile_type: The type of profile used to train the model
+        backend: 'numpy' for a model exported with export_numpy_model, 'keras' for the saved Keras model or
+                 'auto' to use the NumPy export when it exists. Default = 'auto'
+    Returns:
+        An object with the num_inputs and with_phase of the model and a predict_velocity(sensitivity, phase)
+        method that returns velocities in m/s
+    '''
+    if backend == 'numpy' or (backend == 'auto' and os.path.isfile(get_path_to_numpy_model(profile_type))):
+        return load_numpy_model(profile_type)
+    return KerasBackend(profile_type)
+
+class MicroBatcher:
+    ''' Collects concurrent prediction requests and runs the model once per batch
+
+    A batch is closed when it reaches max_batch_size or window seconds after its first request arrived.
+    The model runs in a worker thread so the event loop keeps accepting requests meanwhile. Requests are
+    grouped by the shapes of their inputs, and a group that fails is retried one request at a time, so a bad
+    request only fails itself.
+
+    Args:
+        backend: the model, see load_backend
+        window: the longest time in seconds a request waits for others to join its batch. Default = 0.005
+        max_batch_size: the largest number of requests run together. Default = 1024
+        history: the number of recent request latencies kept for the percentiles. Default = 10000
+    '''
+    def __init__(self, backend, window=0.005, max_batch_size=1024, history=10000):
+        self.backend = backend
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.queue = asyncio.Queue()
+        self.latencies = deque(maxlen=history)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.busy_time = 0.0
+        self.start_time = time.perf_counter()
+
+    async def predict(self, sensitivity, phase=None):
+        ''' Queues one measurement and waits for its velocity profile '''
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((time.perf_counter(), sensitivity, phase, future))
+        return await future
+
+    async def run(self):
+        ''' Forms and runs batches until cancelled '''
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._run_batch(loop, batch)
+
+    async def _run_batch(self, loop, batch):
+        groups = {}
+        for item in batch:
+            key = (item[1].shape, None if item[2] is None else item[2].shape)
+            groups.setdefault(key, []).append(item)
+        self.num_batches += 1
+        for group in groups.values():
+            if not await self._run_group(loop, group) and len(group) > 1:
+                # finds the requests that made the group fail, the others still get their velocities
+                for item in group:
+                    await self._run_group(loop, [item])
+
+    async def _run_group(self, loop, group):
+        ''' Runs requests with inputs of the same shapes together, returns False when the model raised '''
+        try:
+            sensitivity = np.stack([item[1] for item in group])
+            phase = None
+            if group[0][2] is not None:
+                phase = np.stack([item[2] for item in group])
+            start = time.perf_counter()
+            velocity = await loop.run_in_executor(None, self.backend.predict_velocity, sensitivity, phase)
+            self.busy_time += time.perf_counter() - start
+        except Exception as error:
+            if len(group) == 1 and not group[0][3].done():
+                group[0][3].set_exception(error)
+            return False
+        now = time.perf_counter()
+        self.num_requests += len(group)
+        for (arrival, _, _, future), profile in zip(group, velocity):
+            self.latencies.append(now - arrival)
+            if not future.done():
+                future.set_result(profile)
+        return True
+
+    def stats(self):
+        ''' Latency and throughput counters of the server '''
+        elapsed = time.perf_counter() - self.start_time
+        latencies = np.array(self.latencies)
+        stats = {'requests': self.num_requests,
+                 'batches': self.num_batches,
+                 'mean_batch_size': self.num_requests / self.num_batches if self.num_batches else 0,
+                 'requests_per_second': self.num_requests / elapsed,
+                 'model_busy_fraction': self.busy_time / elapsed}
+        if len(latencies):
+            stats.update({'latency_mean_ms': 1e3 * np.mean(latencies),
+                          'latency_p50_ms': 1e3 * np.percentile(latencies, 50),
+                          'latency_p99_ms': 1e3 * np.percentile(latencies, 99)})
+        return stats
+
+class PredictHandler(tornado.web.RequestHandler):
+    def initialize(self, batcher):
+        self.batcher = batcher
+
+    def parse_request(self):
+        ''' Reads the sensitivity and phase vectors of a request and checks they fit the model '''
+        backend = self.batcher.backend
+        num_sens = backend.num_inputs // 2 if backend.with_phase else backend.num_inputs
+        body = json.loads(self.request.body)
+        sensitivity = np.asarray(body['sensitivity'], dtype=float).reshape(-1)
+        if sensitivity.size != num_sens:
+            raise ValueError('sensitivity needs %d values, got %d' % (num_sens, sensitivity.size))
+        if not backend.with_phase:
+            return sensitivity, None
+        if body.get('phase') is None:
+            raise ValueError('the model was trained with phase, phase needs %d values' % num_sens)
+        phase = np.asarray(body['phase'], dtype=float).reshape(-1)
+        if phase.size != num_sens:
+            raise ValueError('phase needs %d values, got %d' % (num_sens, phase.size))
+        return sensitivity, phase
+
+    async def post(self):
+        try:
+            sensitivity, phase = self.parse_request()
+        except (ValueError, KeyError, TypeError) as error:
+            raise tornado.web.HTTPError(400, reason='Bad request: %s' % error)
+        velocity = await self.batcher.predict(sensitivity, phase)
+        self.write({'velocity': np.asarray(velocity).tolist()})
+
+class StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, batcher):
+        self.batcher = batcher
+
+    def get(self):
+        self.write(self.batcher.stats())
+
+def make_app(batcher):
+    ''' Creates the tornado application serving /predict and /stats with the given MicroBatcher '''
+    return tornado.web.Application([(r'/predict', PredictHandler, {'batcher': batcher}),
+                                    (r'/stats', StatsHandler, {'batcher': batcher})])
+
+async def serve(profile_type, port=8888, address='127.0.0.1', window=0.005, max_batch_size=1024, backend='auto'):
+    ''' Loads the model and serves it until the process is stopped
+
+    Args:
+        profile_type: The type of profile used to train the model
+        port: the port to listen on. Default = 8888
+        address: the address to listen on. Default = '127.0.0.1' (local only)
+        window: the micro batching window in seconds. Default = 0.005
+        max_batch_size: the largest number of requests run together. Default = 1024
+        backend: see load_backend. Default = 'auto'
+    '''
+    batcher = MicroBatcher(load_backend(profile_type, backend), window=window, max_batch_size=max_batch_size)
+    make_app(batcher).listen(port, address=address)
+    print('Serving', profile_type, 'on http://%s:%d' % (address, port))
+    await batcher.run()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve ECFM velocity profile reconstruction locally')
+    parser.add_argument('profile_type', help='the model to serve, e.g. Done_With_Phase')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--window-ms', type=float, default=5.0)
+    parser.add_argument('--max-batch', type=int, default=1024)
+    parser.add_argument('--backend', choices=['auto', 'numpy', 'keras'], default='auto')
+    args = parser.parse_args()
+    asyncio.run(serve(args.profile_type, args.port, args.address, args.window_ms / 1e3, args.max_batch, args.backend))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import os
+import numpy as np
+from ECFM_Cache_Helpers import get_file_hash
+
+INPUT_DIRECTORY = 'ECFM_Inputs'
+MATRIX_FILE = 'ECFM_matrix.csv'
+FREQUENCY_FILE = 'ECFM_freq.csv'
+POSITION_FILE = 'ECFM_rad.csv'
+CACHE_FILE = 'ECFM_inputs_cache.npz'
+# bumped whenever the layout of the cache file changes so old caches are rebuilt
+CACHE_VERSION = 1
+# every frequency, as in ECFM_NN_main, ECFM_Feature_Study and ECFM_confirmation
+DEFAULT_FREQUENCY_INDEX = slice(None)
+# ECFM_NN_main_with_phase and ECFM_Validation leave the two highest frequencies out of the models with phase
+WITH_PHASE_FREQUENCY_INDEX = slice(None, -2)
+
+def read_complex_csv(path):
+    ''' Reads a MATLAB style complex csv (e.g. -7.4e-07-3.5e-06i) in a single vectorized conversion
+
+    Args:
+        path: the location of the csv file
+    Returns:
+        2D complex ndarray with the same layout as the csv file
+    '''
+    with open(path, 'r') as f:
+        rows = [line.strip().replace('i', 'j').split(',') for line in f if line.strip()]
+    return np.array(rows).astype(complex)
+
+def select_frequencies(A, freq, frequency_index):
+    ''' Keeps only the frequencies (rows of A) that the models use
+
+    Args:
+        A: the (num_freq, N) matrix generated from the COMSOL simulation
+        freq: the frequencies that correspond to the rows of A
+        frequency_index: a slice, list of indices or boolean mask of the frequencies to keep
+    Returns:
+        A: the matrix with only the selected rows
+        freq: the selected frequencies
+    '''
+    return A[frequency_index], freq[frequency_index]
+
+def get_frequency_index(with_phase):
+    ''' Gets the frequencies the notebooks train the models with and without phase on, see load_ecfm_inputs '''
+    return WITH_PHASE_FREQUENCY_INDEX if with_phase else DEFAULT_FREQUENCY_INDEX
+
+def load_ecfm_inputs(input_directory=INPUT_DIRECTORY, frequency_index=DEFAULT_FREQUENCY_INDEX, use_cache=True):
+    ''' Loads the COMSOL A matrix, radial positions and frequencies used by the training and validation notebooks
+
+    The complex csv is parsed once and the result is stored in a binary cache file next to the inputs.
+    The cache holds the hashes of the csv files and the frequency selection it was built with and is rebuilt
+    whenever any of them change.
+
+    Args:
+        input_directory: the directory holding ECFM_matrix.csv, ECFM_freq.csv and ECFM_rad.csv. Default = 'ECFM_Inputs'
+        frequency_index: the frequencies to keep, see select_frequencies and get_frequency_index. Default = all
+        use_cache: An option to read and write the binary cache. Default = True
+    Returns:
+        A: the (M, N) complex matrix from the COMSOL simulation
+        rad_pos: the N radial positions of the velocity components [m]
+        freq: the M frequencies of the sensitivity components [Hz]
+    '''
+    paths = [os.path.join(input_directory, name) for name in [MATRIX_FILE, POSITION_FILE, FREQUENCY_FILE]]
+    path_to_cache = os.path.join(input_directory, CACHE_FILE)
+    hashes = np.array([get_file_hash(path) for path in paths])
+    selection = repr(frequency_index)
+    if use_cache and os.path.isfile(path_to_cache):
+        with np.load(path_to_cache) as cache:
+            if (int(cache['version']) == CACHE_VERSION and str(cache['selection']) == selection
+                    and np.array_equal(cache['hashes'], hashes)):
+                return cache['A'], cache['rad_pos'], cache['freq']
+
+    A = np.transpose(read_complex_csv(paths[0]))
+    rad_pos = np.loadtxt(paths[1], delimiter=',') # m
+    freq = np.loadtxt(paths[2], delimiter=',') # Hz
+    A, freq = select_frequencies(A, freq, frequency_index)
+    if A.shape[1] != rad_pos.shape[0]:
+        raise ValueError('A has %d velocity components but %d radial positions were given' % (A.shape[1], rad_pos.shape[0]))
+
+    if use_cache:
+        path_to_tmp = path_to_cache + '.tmp%d.npz' % os.getpid()
+        np.savez(path_to_tmp, A=A, rad_pos=rad_pos, freq=freq, hashes=hashes,
+                 selection=selection, version=CACHE_VERSION)
+        os.replace(path_to_tmp, path_to_cache)
+    return A, rad_pos, freq
@@ -0,0 +1,110 @@
+import numpy as np
+
+# the per component metrics of compute_metrics, their printed names and formats
+METRIC_FORMATS = {'mae': ('MAE', '{:.2f} m/s'),
+                  'nmae': ('NMAE', '{:.0%}'),
+                  'rmse': ('RMSE', '{:.2f} m/s'),
+                  'nrmse': ('NRMSE', '{:.0%}'),
+                  'max_error': ('Max AE', '{:.2f} m/s')}
+
+def compute_metrics(actual, predicted):
+    ''' Computes the error metrics of every velocity component and of the whole profiles in one vectorized pass
+
+    The last two axes are (samples, components) and any leading axes, such as models, are kept, so the metrics
+    of many models are computed at once. actual only needs to broadcast against predicted, e.g. one (N, )
+    profile for a (num_models, num_samples, N) array of predictions
+
+    Args:
+        actual: the correct velocities [m/s]
+        predicted: the predicted velocities [m/s], (..., num_samples, N)
+    Returns:
+        dict of ndarrays. mae, nmae, rmse, nrmse and max_error have shape (..., N) and hold the metrics of each
+        component over the samples. The global_ versions of them have shape (...) and are taken over the samples
+        and components together. max_component is the index of the component with the largest nmae.
+        The absolute errors are normalized by the actual velocity of each sample (nae) and the RMSE by the mean
+        actual speed of the component, so for a single profile nrmse is the RMSE over the actual velocity
+    '''
+    predicted = np.asarray(predicted, dtype=np.float64)
+    actual = np.broadcast_to(np.asarray(actual, dtype=np.float64), predicted.shape)
+    absolute_error = np.abs(predicted - actual)
+    squared_error = absolute_error**2
+    speed = np.abs(actual)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # the wall velocity can be 0, which gives inf rather than a warning
+        normalized_error = absolute_error / speed
+        mean_speed = np.mean(speed, axis=-2)
+        metrics = {'mae': np.mean(absolute_error, axis=-2),
+                   'nmae': np.mean(normalized_error, axis=-2),
+                   'rmse': np.sqrt(np.mean(squared_error, axis=-2)),
+                   'max_error': np.max(absolute_error, axis=-2)}
+        metrics['nrmse'] = metrics['rmse'] / mean_speed
+        metrics['global_mae'] = np.mean(metrics['mae'], axis=-1)
+        metrics['global_nmae'] = np.mean(metrics['nmae'], axis=-1)
+        metrics['global_rmse'] = np.sqrt(np.mean(squared_error, axis=(-2, -1)))
+        metrics['global_nrmse'] = metrics['global_rmse'] / np.mean(mean_speed, axis=-1)
+        metrics['global_max_error'] = np.max(metrics['max_error'], axis=-1)
+    metrics['max_component'] = np.argmax(np.nan_to_num(metrics['nmae'], nan=-np.inf), axis=-1)
+    return metrics
+
+def metrics_to_dict(metrics):
+    ''' Converts metrics to floats and lists so they can be saved as json '''
+    return {key: np.asarray(value).tolist() for key, value in metrics.items()}
+
+def format_component_metrics(metrics, columns=('mae', 'nmae'), label='Component:', max_by=None, average=True):
+    ''' Formats per component metrics as the lines of the tables printed by the validation helpers
+
+    Only the formatting happens here, metrics can come from compute_metrics or be any dict of (N, ) arrays
+
+    Args:
+        metrics: dict of metric name -> (N, ) array, with the global_ entries when average is True
+        columns: the metrics printed on every line, keys of METRIC_FORMATS. Default = ('mae', 'nmae')
+        label: the text in front of the component index. Default = 'Component:'
+        max_by: the metric that picks the max error component line. Default = None (the last of columns)
+        average: An option to add the line of the global metrics. Default = True
+    Returns:
+        The list of lines
+    '''
+    def format_values(values):
+        return ' '.join(METRIC_FORMATS[column][0] + ': ' + METRIC_FORMATS[column][1].format(value)
+                        for column, value in zip(columns, values))
+    if max_by is None:
+        max_by = columns[-1]
+    lines = [label + ' ' + str(i) + ' ' + format_values(values)
+             for i, values in enumerate(zip(*[metrics[column] for column in columns]))]
+    if average:
+        lines.append('Average Error in profile ' + format_values([metrics['global_' + column] for column in columns]))
+    max_component = int(np.argmax(np.nan_to_num(metrics[max_by], nan=-np.inf)))
+    lines.append('Max Error Component: ' + str(max_component) + ' '
+                 + format_values([metrics[column][max_component] for column in columns]))
+    return lines
+
+def fit_linear_regressions(actual, predicted):
+    ''' Fits predicted = slope * actual + intercept by least squares for every component in closed form
+
+    Replaces one sklearn LinearRegression per component with a single pass of means, variances and covariances
+
+    Args:
+        actual: the correct velocities [m/s], (num_samples, N) or (num_samples, N, 1)
+        predicted: the predicted velocities [m/s], the same number of values as actual
+    Returns:
+        dict with the (N, ) slope, intercept and r2 of each component and the global_slope, global_intercept
+        and global_r2 of all the components together
+    '''
+    actual = np.asarray(actual, dtype=np.float64)
+    x = actual.reshape(actual.shape[0], -1)
+    y = np.asarray(predicted, dtype=np.float64).reshape(x.shape)
+    fits = {}
+    for prefix, axis in [('', 0), ('global_', None)]:
+        x_mean = np.mean(x, axis=axis)
+        y_mean = np.mean(y, axis=axis)
+        x_deviation = x - x_mean
+        y_deviation = y - y_mean
+        covariance = np.mean(x_deviation * y_deviation, axis=axis)
+        x_variance = np.mean(x_deviation**2, axis=axis)
+        y_variance = np.mean(y_deviation**2, axis=axis)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = covariance / x_variance
+            fits[prefix + 'r2'] = covariance**2 / (x_variance * y_variance)
+        fits[prefix + 'slope'] = slope
+        fits[prefix + 'intercept'] = y_mean - slope * x_mean
+    return fits
@@ -1,14 +1,33 @@
+import os
+import json
+import time
 import numpy as np 
-import random as rand
-import matplotlib.pyplot as plt
-from keras import Sequential
-from keras.layers import Dropout
-from keras.layers import Dense
-from keras.layers import Input
-from sklearn.linear_model import LinearRegression
-# Updating Default Plot Font to be LaTex
-plt.rcParams['mathtext.fontset'] = 'stix'
-plt.rcParams['font.family'] = 'STIXGeneral'
+from functools import lru_cache
+from threading import Lock
+from collections import OrderedDict
+
+MANIFEST_FILE = 'model_manifest.json'
+# the number of live Keras models kept by load_model_and_scaler
+MODEL_REGISTRY_SIZE = 4
+_model_registry = OrderedDict()
+_model_registry_lock = Lock()
+# above this many points the prediction plots are drawn as 2D histograms instead of one marker per point
+DENSITY_THRESHOLD = 20000
+# keras and matplotlib are imported inside the functions that use them so that the data generation
+# helpers (and the worker processes that run them) do not pay for loading TensorFlow
+
+@lru_cache(maxsize=None)
+def get_pyplot(): 
+    ''' Imports matplotlib.pyplot on first use and sets the default plot font to LaTex 
+
+    Returns: 
+        The matplotlib.pyplot module
+    '''
+    import matplotlib.pyplot as plt
+    # Updating Default Plot Font to be LaTex
+    plt.rcParams['mathtext.fontset'] = 'stix'
+    plt.rcParams['font.family'] = 'STIXGeneral'
+    return plt
 
 def get_sensitivity(b): 
     ''' get_sesativity calculates the sensitivity resulting from the A' * v operation 
@@ -20,7 +39,203 @@ def get_sensitivity(b):
     '''
     return np.abs(b)
 
-def generate_constant_data(A, size, min_vel, max_vel): 
+def get_b(A, velocity_profile): 
+    ''' Calculates the b vectors of a batch of velocity profiles with a single (size, N) x (N, M) matrix product 
+
+    The real and imaginary parts of A are multiplied seperately so the real velocity block never has to be 
+    copied into a complex array. 
+
+    Args: 
+        A: the matrix generated from the COMSOL simulation, (M, N) 
+        velocity_profile: (size, N) ndarray of velocity profiles 
+    Returns: 
+        (size, M) complex ndarray of b vectors 
+    '''
+    bs = np.empty((velocity_profile.shape[0], A.shape[0]), dtype=complex)
+    bs.real = np.matmul(velocity_profile, np.real(A).T)
+    bs.imag = np.matmul(velocity_profile, np.imag(A).T)
+    return bs
+
+def get_profile_data(A, velocity_profile): 
+    ''' Calculates the sensitivity, phase and b vector for a whole batch of velocity profiles at once 
+
+    The b vectors for every profile are computed with get_b rather than one A * v product per profile. 
+
+    Args: 
+        A: the matrix generated from the COMSOL simulation, (M, N) 
+        velocity_profile: (size, N) or (size, N, 1) ndarray of velocity profiles 
+    Returns: 
+        sensitivity: (size, M, 1) ndarray of sensitivity matricies. 
+        velocity_profile: (size, N, 1) ndarray of corrisponding velocty profiles.
+        phases: (size, M, 1) of phases of the values in b 
+        bs: (size, M, 1) ndarray of both the real and imginary components of the b vector 
+    '''
+    velocity_profile = velocity_profile.reshape(-1, A.shape[1])
+    bs = get_b(A, velocity_profile)
+    sensitivity = get_sensitivity(bs)
+    phases = np.angle(bs)
+    return sensitivity[:, :, np.newaxis], velocity_profile[:, :, np.newaxis], phases[:, :, np.newaxis], bs[:, :, np.newaxis]
+
+def get_compact_profile_data(A, velocity_profile, with_bs=False, chunk_size=2**16): 
+    ''' Calculates the network ready float32 input matrix for a batch of velocity profiles 
+
+    Instead of four float64/complex128 arrays with a trailing singleton axis a single contiguous (size, 2M) 
+    float32 matrix is filled with the sensitivity in the first M columns and the phase in the last M columns. 
+    The b vectors are computed chunk_size profiles at a time so only a small complex block is ever alive 
+    unless with_bs is set. 
+
+    Args: 
+        A: the matrix generated from the COMSOL simulation, (M, N) 
+        velocity_profile: (size, N) or (size, N, 1) ndarray of velocity profiles 
+        with_bs: An option to also return the complex b vectors. Default = False 
+        chunk_size: the number of profiles processed at once. Default = 2**16 
+    Returns: 
+        inputs: (size, 2M) float32 ndarray of unscaled sensitivities followed by phases, see scale_compact_input 
+        velocity_profile: (size, N) float32 ndarray of corrisponding velocty profiles 
+        bs: (size, M) complex ndarray of b vectors. Only returned when with_bs is True 
+    '''
+    velocity_profile = velocity_profile.reshape(-1, A.shape[1])
+    size = velocity_profile.shape[0]
+    num_sens = A.shape[0]
+    inputs = np.empty((size, 2 * num_sens), dtype=np.float32)
+    if with_bs: 
+        bs = np.empty((size, num_sens), dtype=complex)
+    for start in range(0, size, chunk_size): 
+        stop = min(start + chunk_size, size)
+        b = get_b(A, velocity_profile[start:stop])
+        inputs[start:stop, :num_sens] = get_sensitivity(b)
+        inputs[start:stop, num_sens:] = np.angle(b)
+        if with_bs: 
+            bs[start:stop] = b 
+    velocity_profile = velocity_profile.astype(np.float32)
+    if with_bs: 
+        return inputs, velocity_profile, bs
+    return inputs, velocity_profile
+
+def sample_constant_profiles(size, num_vel, min_vel, max_vel, rng=None): 
+    ''' Samples a block of constant velocity profiles 
+
+    Args: 
+        size: the number of velocity profiles to generate 
+        num_vel: the number of components in each velocity profile 
+        min_vel: the minimum fluid velocity 
+        max_vel: the maximum fluid velocity 
+        rng: the numpy Generator used to draw the random parameters. Default = None (the global np.random state) 
+    Returns: 
+        (size, num_vel) ndarray of velocity profiles 
+    '''
+    if rng is None: 
+        rng = np.random
+    temp_vel = rng.uniform(min_vel, max_vel, (size, 1))
+    return np.repeat(temp_vel, num_vel, axis=1)
+
+def sample_linear_profiles(size, min_vel, max_vel, rad_pos, rng=None): 
+    ''' Samples a block of linear velocity profiles. See generate_linear_data for a description of the profile 
+
+    Args: 
+        size: the number of velocity profiles to generate 
+        min_vel: the minimum fluid velocity 
+        max_vel: the maximum fluid velocity 
+        rad_pos: A list of radial positions where the velocity profile should be sampled 
+        rng: the numpy Generator used to draw the random parameters. Default = None (the global np.random state) 
+    Returns: 
+        (size, N) ndarray of velocity profiles 
+    '''
+    if rng is None: 
+        rng = np.random
+    scaled_rad_pos = (rad_pos / rad_pos[-1]).reshape(1, -1)
+    temp_max_vel = rng.uniform(min_vel, max_vel, (size, 1))
+    temp_min_vel = rng.uniform(min_vel, temp_max_vel)
+    slope = (temp_min_vel - temp_max_vel) / (scaled_rad_pos[0, -1] - scaled_rad_pos[0, 0])
+    return slope * (scaled_rad_pos - scaled_rad_pos[0, 0]) + temp_max_vel
+
+def sample_parabolic_profiles(size, min_vel, max_vel, rad_pos, rng=None): 
+    ''' Samples a block of parabolic velocity profiles 
+
+    Args: 
+        size: the number of velocity profiles to generate 
+        min_vel: the minimum fluid velocity 
+        max_vel: the maximum fluid velocity 
+        rad_pos: A list of radial positions where the velocity profile should be sampled 
+        rng: the numpy Generator used to draw the random parameters. Default = None (the global np.random state) 
+    Returns: 
+        (size, N) ndarray of velocity profiles 
+    '''
+    if rng is None: 
+        rng = np.random
+    scaled_rad_pos = (rad_pos / rad_pos[-1]).reshape(1, -1)
+    temp_max_vel = rng.uniform(min_vel, max_vel, (size, 1))
+    temp_min_vel = rng.uniform(min_vel, temp_max_vel)
+    coef = (temp_max_vel - temp_min_vel) / (1 - (scaled_rad_pos[0, 0] / scaled_rad_pos[0, -1])**2)
+    return coef * (1 - (scaled_rad_pos / scaled_rad_pos[0, -1])**2) + temp_min_vel
+
+def sample_power_profiles(size, min_vel, max_vel, rad_pos, R, min_n, max_n, rng=None): 
+    ''' Samples a block of power law velocity profiles, u = u_max * (1 - r / R)^(1 / n) 
+
+    Args: 
+        size: the number of velocity profiles to generate 
+        min_vel: the minimum fluid velocity 
+        max_vel: the maximum fluid velocity 
+        rad_pos: A list of radial positions where the velocity profile should be sampled 
+        R: The inner radius of the pipe being modeled 
+        min_n: the smallest power law exponent 
+        max_n: the largest power law exponent 
+        rng: the numpy Generator used to draw the random parameters. Default = None (the global np.random state) 
+    Returns: 
+        (size, N) ndarray of velocity profiles 
+    '''
+    if rng is None: 
+        rng = np.random
+    scaled_rad_pos = (rad_pos / R).reshape(1, -1)
+    temp_max_vel = rng.uniform(min_vel, max_vel, (size, 1))
+    n = rng.uniform(min_n, max_n, (size, 1))
+    u_max = temp_max_vel / (1 - scaled_rad_pos[0, 0])**(1 / n)
+    return u_max * (1 - scaled_rad_pos)**(1 / n)
+
+def sample_monotonic_profiles(size, num_vel, min_vel, max_vel, rng=None): 
+    ''' Samples a block of random monotonically decreasing velocity profiles 
+
+    The sequential rule v_j = uniform(v_-1, v_j-1) is equivalent to v_j - v_-1 = (v_0 - v_-1) * u_1 * ... * u_j 
+    with u_k uniform on [0, 1), so the interior components are produced with a single cumulative product 
+    instead of a loop over the components. 
+
+    Args: 
+        size: the number of velocity profiles to generate 
+        num_vel: the number of components in each velocity profile 
+        min_vel: the minimum fluid velocity 
+        max_vel: the maximum fluid velocity 
+        rng: the numpy Generator used to draw the random parameters. Default = None (the global np.random state) 
+    Returns: 
+        (size, num_vel) ndarray of velocity profiles 
+    '''
+    if rng is None: 
+        rng = np.random
+    velocity_profile = np.empty((size, num_vel))
+    velocity_profile[:, 0] = rng.uniform(min_vel, max_vel, size)
+    velocity_profile[:, -1] = rng.uniform(min_vel, velocity_profile[:, 0])
+    if num_vel > 2: 
+        fractions = np.cumprod(rng.uniform(0, 1, (size, num_vel - 2)), axis=1)
+        span = (velocity_profile[:, 0] - velocity_profile[:, -1]).reshape(-1, 1)
+        velocity_profile[:, 1:-1] = velocity_profile[:, -1].reshape(-1, 1) + span * fractions
+    return velocity_profile
+
+def sample_random_profiles(size, num_vel, min_vel, max_vel, rng=None): 
+    ''' Samples a block of velocity profiles where every component is independently uniform 
+
+    Args: 
+        size: the number of velocity profiles to generate 
+        num_vel: the number of components in each velocity profile 
+        min_vel: the minimum fluid velocity 
+        max_vel: the maximum fluid velocity 
+        rng: the numpy Generator used to draw the random parameters. Default = None (the global np.random state) 
+    Returns: 
+        (size, num_vel) ndarray of velocity profiles 
+    '''
+    if rng is None: 
+        rng = np.random
+    return rng.uniform(min_vel, max_vel, (size, num_vel))
+
+def generate_constant_data(A, size, min_vel, max_vel, rng=None, compact=False, with_bs=False): 
     ''' Generates a sample of sensitivity and velocity data using a constant velocity profiles
     
     Each component of the velocity profile is set to the same number that is between min_vel and max_vel 
@@ -30,27 +245,22 @@ def generate_constant_data(A, size, min_vel, max_vel):
         size: the number of pairs of sensitivity, velocity vectors that you want to generate 
         min_vel: the minimum fluid velocity that will be included in the sensitivity generation 
         max_vel: the maximum fluid velocity that will be included in the sensitivity generation 
+        rng: the numpy Generator used to draw the random parameters. Default = None (the global np.random state) 
+        compact: An option to return the float32 layout of get_compact_profile_data instead. Default = False 
+        with_bs: With compact, an option to also return the b vectors. Default = False 
     Returns: 
         sensitivity: (size, M, 1) ndarray of sensitivity matricies. 
         velocity_profile: (size, N, 1) ndarray of corrisponding velocty profiles.
         phases: (size, M, 1) of phases of the values in b 
         bs: (size, M, 1) ndarray of both the real and imginary components of the b vector 
+        When compact is True the (inputs, velocity_profile[, bs]) of get_compact_profile_data are returned instead 
     ''' 
-    sensitivity = np.zeros((size, A.shape[0], 1))
-    velocity_profile = np.zeros((size, A.shape[1], 1))
-    phases = np.zeros((size, A.shape[0], 1))
-    bs = np.zeros((size, A.shape[0], 1), dtype=complex)
-
-    for i in range(size):
-        # creating the random v vector
-        velocity_profile[i] = rand.uniform(min_vel, max_vel) * np.ones((A.shape[1], 1))
-        b = np.matmul(A, velocity_profile[i])
-        phases[i] = np.angle(b)
-        sensitivity[i] = np.reshape(get_sensitivity(b), (A.shape[0], 1)) 
-        bs[i] = b 
-    return sensitivity, velocity_profile, phases, bs
-
-def generate_linear_data(A, size, min_vel, max_vel, rad_pos): 
+    velocity_profile = sample_constant_profiles(size, A.shape[1], min_vel, max_vel, rng=rng)
+    if compact: 
+        return get_compact_profile_data(A, velocity_profile, with_bs=with_bs)
+    return get_profile_data(A, velocity_profile)
+
+def generate_linear_data(A, size, min_vel, max_vel, rad_pos, rng=None, compact=False, with_bs=False): 
     ''' Generates a sample of sensitivity and velocity data using a linear velocity profiles
     
     A random temp_max_vel is generated within the range min_val to max_vel then a random temp_min_vel
@@ -65,31 +275,22 @@ def generate_linear_data(A, size, min_vel, max_vel, rad_pos):
         min_vel: the minimum fluid velocity that will be included in the sensitivity generation 
         max_vel: the maximum fluid velocity that will be included in the sensitivity generation 
         rad_pos: A list of radial positions where the velocity profile should be sampled 
+        rng: the numpy Generator used to draw the random parameters. Default = None (the global np.random state) 
+        compact: An option to return the float32 layout of get_compact_profile_data instead. Default = False 
+        with_bs: With compact, an option to also return the b vectors. Default = False 
     Returns: 
         sensitivity: (size, M, 1) ndarray of sensitivity matricies. 
         velocity_profile: (size, N, 1) ndarray of corrisponding velocty profiles.
         phases: (size, M, 1) of phases of the values in b 
         bs: (size, M, 1) ndarray of both the real and imginary components of the b vector 
+        When compact is True the (inputs, velocity_profile[, bs]) of get_compact_profile_data are returned instead 
     ''' 
-    sensitivity = np.zeros((size, A.shape[0], 1))
-    velocity_profile = np.zeros((size, A.shape[1], 1))
-    phases = np.zeros((size, A.shape[0], 1))
-    bs = np.zeros((size, A.shape[0], 1), dtype=complex)
-    scaled_rad_pos = (rad_pos / rad_pos[-1]).reshape(-1, 1)
-
-    for i in range(size):
-        # creating the random v vector
-        temp_max_vel = rand.uniform(min_vel, max_vel)
-        temp_min_vel = rand.uniform(min_vel, temp_max_vel) 
-        slope = (temp_min_vel - temp_max_vel) / (scaled_rad_pos[-1] - scaled_rad_pos[0])
-        velocity_profile[i] = (slope * (scaled_rad_pos - scaled_rad_pos[0]) + temp_max_vel).reshape(-1, 1)
-        b = np.matmul(A, velocity_profile[i])
-        phases[i] = np.angle(b)
-        sensitivity[i] = np.reshape(get_sensitivity(b), (A.shape[0], 1)) 
-        bs[i] = b 
-    return sensitivity, velocity_profile, phases, bs
-
-def generate_parabolic_data(A, size, min_vel, max_vel, rad_pos): 
+    velocity_profile = sample_linear_profiles(size, min_vel, max_vel, rad_pos, rng=rng)
+    if compact: 
+        return get_compact_profile_data(A, velocity_profile, with_bs=with_bs)
+    return get_profile_data(A, velocity_profile)
+
+def generate_parabolic_data(A, size, min_vel, max_vel, rad_pos, rng=None, compact=False, with_bs=False): 
     ''' Generates a sample of sensitivity and velocity data using parabolic velocity profiles
 
     Args:
@@ -98,32 +299,22 @@ def generate_parabolic_data(A, size, min_vel, max_vel, rad_pos):
         min_vel: the minimum fluid velocity that will be included in the sensitivity generation 
         max_vel: the maximum fluid velocity that will be included in the sensitivity generation 
         rad_pos: A list of radial positions where the velocity profile should be sampled 
+        rng: the numpy Generator used to draw the random parameters. Default = None (the global np.random state) 
+        compact: An option to return the float32 layout of get_compact_profile_data instead. Default = False 
+        with_bs: With compact, an option to also return the b vectors. Default = False 
     Returns: 
         sensitivity: (size, M, 1) ndarray of sensitivity matricies. 
         velocity_profile: (size, N, 1) ndarray of corrisponding velocty profiles.
         phases: (size, M, 1) of phases of the values in b 
         bs: (size, M, 1) ndarray of both the real and imginary components of the b vector 
+        When compact is True the (inputs, velocity_profile[, bs]) of get_compact_profile_data are returned instead 
     ''' 
-    sensitivity = np.zeros((size, A.shape[0], 1))
-    velocity_profile = np.zeros((size, A.shape[1], 1))
-    phases = np.zeros((size, A.shape[0], 1))
-    bs = np.zeros((size, A.shape[0], 1), dtype=complex)
-    scaled_rad_pos = (rad_pos / rad_pos[-1]).reshape(-1, 1)
-
-    for i in range(size):
-        # creating the random v vector
-        temp_max_vel = rand.uniform(min_vel, max_vel)
-        temp_min_vel = rand.uniform(min_vel, temp_max_vel) 
-        coef = (temp_max_vel - temp_min_vel) / (1 - (scaled_rad_pos[0] / scaled_rad_pos[-1])**2)
-
-        velocity_profile[i] = coef * (1 - (scaled_rad_pos / scaled_rad_pos[-1])**2) + temp_min_vel
-        b = np.matmul(A, velocity_profile[i])
-        phases[i] = np.angle(b)
-        sensitivity[i] = np.reshape(get_sensitivity(b), (A.shape[0], 1)) 
-        bs[i] = b 
-    return sensitivity, velocity_profile, phases, bs
-
-def generate_power_data(A, size, min_vel, max_vel, rad_pos, R, min_n, max_n): 
+    velocity_profile = sample_parabolic_profiles(size, min_vel, max_vel, rad_pos, rng=rng)
+    if compact: 
+        return get_compact_profile_data(A, velocity_profile, with_bs=with_bs)
+    return get_profile_data(A, velocity_profile)
+
+def generate_power_data(A, size, min_vel, max_vel, rad_pos, R, min_n, max_n, rng=None, compact=False, with_bs=False): 
     ''' Generates a sample of sensitivity and velocity data using parabolic velocity profiles
 
     Args:
@@ -132,31 +323,22 @@ def generate_power_data(A, size, min_vel, max_vel, rad_pos, R, min_n, max_n):
         min_vel: the minimum fluid velocity that will be included in the sensitivity generation 
         max_vel: the maximum fluid velocity that will be included in the sensitivity generation 
         rad_pos: A list of radial positions where the velocity profile should be sampled 
+        rng: the numpy Generator used to draw the random parameters. Default = None (the global np.random state) 
+        compact: An option to return the float32 layout of get_compact_profile_data instead. Default = False 
+        with_bs: With compact, an option to also return the b vectors. Default = False 
     Returns: 
         sensitivity: (size, M, 1) ndarray of sensitivity matricies. 
         velocity_profile: (size, N, 1) ndarray of corrisponding velocty profiles.
         phases: (size, M, 1) of phases of the values in b 
         bs: (size, M, 1) ndarray of both the real and imginary components of the b vector 
+        When compact is True the (inputs, velocity_profile[, bs]) of get_compact_profile_data are returned instead 
     ''' 
-    sensitivity = np.zeros((size, A.shape[0], 1))
-    velocity_profile = np.zeros((size, A.shape[1], 1))
-    phases = np.zeros((size, A.shape[0], 1))
-    bs = np.zeros((size, A.shape[0], 1), dtype=complex)
-    scaled_rad_pos = (rad_pos / R).reshape(-1, 1)
-
-    for i in range(size):
-        # creating the random v vector
-        temp_max_vel = rand.uniform(min_vel, max_vel)
-        n = rand.uniform(min_n, max_n)
-        u_max = temp_max_vel / ( 1 - scaled_rad_pos[0])**( 1 / n )
-        velocity_profile[i] = u_max * ( 1 - scaled_rad_pos)**( 1 / n )
-        b = np.matmul(A, velocity_profile[i])
-        phases[i] = np.angle(b)
-        sensitivity[i] = np.reshape(get_sensitivity(b), (A.shape[0], 1)) 
-        bs[i] = b 
-    return sensitivity, velocity_profile, phases, bs
-
-def generate_monotonic_data(A, size, min_vel, max_vel): 
+    velocity_profile = sample_power_profiles(size, min_vel, max_vel, rad_pos, R, min_n, max_n, rng=rng)
+    if compact: 
+        return get_compact_profile_data(A, velocity_profile, with_bs=with_bs)
+    return get_profile_data(A, velocity_profile)
+
+def generate_monotonic_data(A, size, min_vel, max_vel, rng=None, compact=False, with_bs=False): 
     ''' Generates a sample of sensitivity and velocity data using a random monotonically decreasing velocity profile 
     
     Each component of the velocity profile is set to a random value between min_vel and max_vel and 
@@ -167,29 +349,22 @@ def generate_monotonic_data(A, size, min_vel, max_vel):
         size: the number of pairs of sensitivity, velocity vectors that you want to generate 
         min_vel: the minimum fluid velocity that will be included in the sensitivity generation 
         max_vel: the maximum fluid velocity that will be included in the sensitivity generation 
+        rng: the numpy Generator used to draw the random parameters. Default = None (the global np.random state) 
+        compact: An option to return the float32 layout of get_compact_profile_data instead. Default = False 
+        with_bs: With compact, an option to also return the b vectors. Default = False 
     Returns: 
         sensitivity: (size, M, 1) ndarray of sensitivity matricies. 
         velocity_profile: (size, N, 1) ndarray of corrisponding velocty profiles.
         phases: (size, M, 1) of phases of the values in b 
         bs: (size, M, 1) ndarray of both the real and imginary components of the b vector 
+        When compact is True the (inputs, velocity_profile[, bs]) of get_compact_profile_data are returned instead 
     ''' 
-    sensitivity = np.zeros((size, A.shape[0], 1))
-    velocity_profile = np.zeros((size, A.shape[1], 1))
-    phases = np.zeros((size, A.shape[0], 1))
-    bs = np.zeros((size, A.shape[0], 1), dtype=complex)
-    for i in range(size):
-        # creating the random v vector
-        velocity_profile[i][0] = rand.uniform(min_vel, max_vel)
-        velocity_profile[i][-1] = rand.uniform(min_vel, velocity_profile[i][0])
-        for j in range(1, A.shape[1] - 1): 
-            velocity_profile[i][j] = rand.uniform(velocity_profile[i][-1], velocity_profile[i][j - 1])
-        b = np.matmul(A, velocity_profile[i])
-        phases[i] = np.angle(b)
-        sensitivity[i] = np.reshape(get_sensitivity(b), (A.shape[0], 1)) 
-        bs[i] = b 
-    return sensitivity, velocity_profile, phases, bs
-
-def generate_random_data(A, size, min_vel, max_vel): 
+    velocity_profile = sample_monotonic_profiles(size, A.shape[1], min_vel, max_vel, rng=rng)
+    if compact: 
+        return get_compact_profile_data(A, velocity_profile, with_bs=with_bs)
+    return get_profile_data(A, velocity_profile)
+
+def generate_random_data(A, size, min_vel, max_vel, rng=None, compact=False, with_bs=False): 
     ''' Generates a sample of sensitivity and velocity data using a random velocity profiles
     
     Each component of the velocity profile is set to a random value between min_vel and max_vel 
@@ -199,24 +374,20 @@ def generate_random_data(A, size, min_vel, max_vel):
         size: the number of pairs of sensitivity, velocity vectors that you want to generate 
         min_vel: the minimum fluid velocity that will be included in the sensitivity generation 
         max_vel: the maximum fluid velocity that will be included in the sensitivity generation 
+        rng: the numpy Generator used to draw the random parameters. Default = None (the global np.random state) 
+        compact: An option to return the float32 layout of get_compact_profile_data instead. Default = False 
+        with_bs: With compact, an option to also return the b vectors. Default = False 
     Returns: 
         sensitivity: (size, M, 1) ndarray of sensitivity matricies. 
         velocity_profile: (size, N, 1) ndarray of corrisponding velocty profiles.
         phases: (size, M, 1) of phases of the values in b 
         bs: (size, M, 1) ndarray of both the real and imginary components of the b vector 
+        When compact is True the (inputs, velocity_profile[, bs]) of get_compact_profile_data are returned instead 
     ''' 
-    sensitivity = np.zeros((size, A.shape[0], 1))
-    velocity_profile = np.zeros((size, A.shape[1], 1))
-    phases = np.zeros((size, A.shape[0], 1))
-    bs = np.zeros((size, A.shape[0], 1), dtype=complex)
-    for i in range(size):
-        # creating the random v vector
-        velocity_profile[i] = np.reshape(np.array([rand.uniform(min_vel, max_vel) for j in range(A.shape[1])]), (A.shape[1], 1))
-        b = np.matmul(A, velocity_profile[i])
-        phases[i] = np.angle(b)
-        sensitivity[i] = np.reshape(get_sensitivity(b), (A.shape[0], 1)) 
-        bs[i] = b 
-    return sensitivity, velocity_profile, phases, bs
+    velocity_profile = sample_random_profiles(size, A.shape[1], min_vel, max_vel, rng=rng)
+    if compact: 
+        return get_compact_profile_data(A, velocity_profile, with_bs=with_bs)
+    return get_profile_data(A, velocity_profile)
 
 def get_with_phase_input(sensitivity, phase, sensitivity_scale_factor=None, phase_scale_factor=None): 
     ''' Puts phases and sensitivity into the expected input for the NN model and scales them as needed 
@@ -242,7 +413,7 @@ def get_with_phase_input(sensitivity, phase, sensitivity_scale_factor=None, phas
         phase_scaled, phase_scale_factor = scale_phase(phase)
     else: 
         phase_scaled = phase / phase_scale_factor
-    scaled_input = np.ma.concatenate([sensitivity_scaled, phase_scaled], axis=1)
+    scaled_input = np.concatenate([sensitivity_scaled, phase_scaled], axis=1)
     return scaled_input, sensitivity_scale_factor, phase_scale_factor
 
 def scale_velocity(velocity, max_vel): 
@@ -286,10 +457,167 @@ def scale_phase(phase, scale_factor=None):
         scale_factor = np.max(np.abs(phase))
     return phase / scale_factor, scale_factor
 
+def scale_compact_input(inputs, sensitivity_scale_factor=None, phase_scale_factor=None, phase_shift=0): 
+    ''' Shifts and scales a compact (size, 2M) input matrix from get_compact_profile_data in place 
+
+    This is the compact layout equivalent of get_with_phase_input. No copy of the input matrix is made. 
+
+    Args: 
+        inputs: (size, 2M) float32 ndarray of sensitivities followed by phases. It is overwritten 
+        sensitivity_scale_factor: The factor the sensitivity should be scaled by. If none is provided 
+                                  the maximum sensitivity in the data set is used 
+        phase_scale_factor: The factor the phase should be scaled by. If none is provided 
+                            the maximum absolute value of the shifted phase in the data set is used 
+        phase_shift: the shift added to the phases before scaling. Default = 0 
+    Returns: 
+        inputs: the same matrix now scaled 
+        sensitivity_scale_factor: The factor the sensitivity was scaled by 
+        phase_scale_factor: The factor the phase was scaled by  
+    '''
+    num_sens = inputs.shape[1] // 2
+    sensitivity = inputs[:, :num_sens]
+    phase = inputs[:, num_sens:]
+    if phase_shift != 0: 
+        phase += phase_shift
+    if sensitivity_scale_factor == None: 
+        sensitivity_scale_factor = float(np.max(sensitivity))
+    if phase_scale_factor == None: 
+        phase_scale_factor = float(np.max(np.abs(phase)))
+    sensitivity /= sensitivity_scale_factor
+    phase /= phase_scale_factor
+    return inputs, sensitivity_scale_factor, phase_scale_factor
+
+class Scaler: 
+    ''' Fit once scaling of the network inputs and velocity targets that replaces the scale_* functions 
+
+    The scale factors are the same as those of get_with_phase_input and scale_velocity but they can be fitted 
+    incrementally from streamed batches with running maximums, are applied in place to float32 buffers and are 
+    saved as a small json file next to the Keras model 
+
+    Args: 
+        max_vel: The maximum possible velocity in the training set 
+        sensitivity_scale_factor: The factor the sensitivity is scaled by. Default = None (fitted) 
+        phase_scale_factor: The factor the phase is scaled by. Default = None (fitted) 
+        phase_shift: the shift added to the phases before scaling. Default = 0 
+        with_phase: if the network inputs contain the phases after the sensitivities. Default = True 
+    '''
+    def __init__(self, max_vel, sensitivity_scale_factor=None, phase_scale_factor=None, phase_shift=0, with_phase=True): 
+        self.max_vel = max_vel
+        self.sensitivity_scale_factor = sensitivity_scale_factor
+        self.phase_scale_factor = phase_scale_factor
+        self.phase_shift = phase_shift
+        self.with_phase = with_phase
+
+    def _num_sens(self, inputs): 
+        if self.with_phase: 
+            return inputs.shape[1] // 2
+        return inputs.shape[1]
+
+    def partial_fit(self, inputs): 
+        ''' Updates the running maximums with a batch of unscaled (size, 2M) or (size, M) network inputs '''
+        num_sens = self._num_sens(inputs)
+        sensitivity_max = float(np.max(inputs[:, :num_sens]))
+        if self.sensitivity_scale_factor is None or sensitivity_max > self.sensitivity_scale_factor: 
+            self.sensitivity_scale_factor = sensitivity_max
+        if self.with_phase: 
+            phase_max = float(np.max(np.abs(inputs[:, num_sens:] + self.phase_shift)))
+            if self.phase_scale_factor is None or phase_max > self.phase_scale_factor: 
+                self.phase_scale_factor = phase_max
+        return self
+
+    def fit(self, batches): 
+        ''' Fits the scale factors over an iterable of unscaled input batches (or a single input matrix) '''
+        if isinstance(batches, np.ndarray): 
+            batches = [batches]
+        for inputs in batches: 
+            self.partial_fit(inputs)
+        return self
+
+    def is_fitted(self): 
+        ''' If the scale factors the inputs need have been fitted or given '''
+        return self.sensitivity_scale_factor is not None and (not self.with_phase or self.phase_scale_factor is not None)
+
+    def check_fitted(self): 
+        ''' Raises a ValueError when the scale factors have not been fitted or given '''
+        if not self.is_fitted(): 
+            raise ValueError('The Scaler has no scale factors, fit it on the training inputs or give '
+                             + ('sensitivity_scale_factor and phase_scale_factor' if self.with_phase 
+                                else 'sensitivity_scale_factor'))
+
+    def transform(self, inputs, copy=False): 
+        ''' Shifts and scales (size, 2M) or (size, M) float32 network inputs, in place unless copy is True 
+
+        The scale factors must be fitted or given first, every batch is scaled by the same factors 
+        '''
+        self.check_fitted()
+        if copy: 
+            inputs = np.array(inputs, dtype=np.float32)
+        if self.with_phase: 
+            return scale_compact_input(inputs, self.sensitivity_scale_factor, self.phase_scale_factor, self.phase_shift)[0]
+        inputs /= self.sensitivity_scale_factor
+        return inputs
+
+    def transform_velocity(self, velocity, copy=False): 
+        ''' Scales velocity profiles between 0 and 1, in place unless copy is True '''
+        if copy: 
+            velocity = np.array(velocity, dtype=np.float32)
+        velocity /= self.max_vel
+        return velocity
+
+    def inverse_transform_velocity(self, velocity): 
+        ''' Turns scaled model predictions back into velocities in m/s '''
+        return velocity * self.max_vel
+
+    def to_dict(self): 
+        return {'max_vel': self.max_vel, 
+                'sensitivity_scale_factor': self.sensitivity_scale_factor, 
+                'phase_scale_factor': self.phase_scale_factor, 
+                'phase_shift': self.phase_shift, 
+                'with_phase': self.with_phase}
+
+    def save(self, path_to_file): 
+        ''' Saves the scale factors as json, typically as scaler.json in the *_Velocity_Results directory '''
+        with open(path_to_file, 'w') as f: 
+            json.dump(self.to_dict(), f, indent=4)
+
+    @classmethod
+    def load(cls, path_to_file): 
+        ''' Loads a Scaler saved with save '''
+        with open(path_to_file, 'r') as f: 
+            return cls(**json.load(f))
+
+def plot_predictions(ax, actual, predicted, density=None, bins=200): 
+    ''' Plots predicted against actual velocities on an axis, as markers or as a 2D histogram for large sets 
+
+    The 2D histogram is binned with numpy and drawn as a single image, so it takes about the same time and 
+    file size for a million points as for a thousand 
+
+    Args: 
+        ax: the matplotlib axis to plot on 
+        actual: the correct velocities [m/s] 
+        predicted: the predicted velocities [m/s] 
+        density: An option to draw the 2D histogram. Default = None (when there are more than DENSITY_THRESHOLD points) 
+        bins: the number of bins of each axis of the 2D histogram. Default = 200 
+    Returns: 
+        The artist that was drawn 
+    '''
+    actual = np.asarray(actual).reshape(-1)
+    predicted = np.asarray(predicted).reshape(-1)
+    if density is None: 
+        density = actual.size > DENSITY_THRESHOLD
+    if not density: 
+        return ax.plot(actual, predicted, 'o')[0]
+    from matplotlib.colors import LogNorm
+    counts, actual_edges, predicted_edges = np.histogram2d(actual, predicted, bins=bins)
+    # empty bins are masked so they keep the background color 
+    return ax.imshow(np.ma.masked_equal(counts.T, 0), origin='lower', aspect='auto', interpolation='nearest', 
+                     extent=(actual_edges[0], actual_edges[-1], predicted_edges[0], predicted_edges[-1]), 
+                     norm=LogNorm())
+
 def plot_model_results(profile_type, training_velocity, model_velocity, regression=True, 
                        component_graphs=True, global_graphs=True,
                        title_font_size=20, xlabel_font_size=16, ylabel_font_size=16, 
-                       bins=50, figsize=None, show_legend=True, hist_range_mag=0.1): 
+                       bins=50, figsize=None, show_legend=True, hist_range_mag=0.1, density=None, density_bins=200): 
     ''' Creates a plot of the NN performance for each velocity component being modeled 
 
     The plot will be a num_vel x 2 subplot where each component has a plot of its predictions versus the actual
@@ -312,34 +640,31 @@ def plot_model_results(profile_type, training_velocity, model_velocity, regressi
         figsize: An optional specifer for a custom size figure to be created. Default = None
         show_lenend: A boolean option to turn on and off the legend being displayed. Default = True 
         hist_range_mag: The upper bound of the histogram range. A symmetric range will be used. Default = 0.1
+        density: An option to plot the predictions as 2D histograms, see plot_predictions. 
+                 Default = None (when there are more than DENSITY_THRESHOLD predictions)
+        density_bins: the number of bins of each axis of the 2D histograms. Default = 200 
     Returns: 
         Nothing is returned the plot is created and displayed
     '''
+    from ECFM_Metrics_Helpers import fit_linear_regressions
+    plt = get_pyplot()
     # creating x labels for plotting linear fits 
     line_data = np.arange(np.min(training_velocity), np.max(training_velocity), np.min(training_velocity) * 1e-3 + 1e-3).reshape(-1, 1)
-    # making the correct answers into a 1 dimensional array 
-    correct = np.array(training_velocity).reshape(training_velocity.shape[0] * training_velocity.shape[1], 1)
-    # making the model answers into a 1 dimensional array 
-    guesses = np.array(model_velocity).reshape(model_velocity.shape[0] * model_velocity.shape[1], 1)
     # Getting the components for each vector 
-    training_components = np.zeros((training_velocity.shape[0], training_velocity.shape[1]))
-    model_components = np.zeros((training_velocity.shape[0], training_velocity.shape[1]))
+    training_components = np.asarray(training_velocity).reshape(training_velocity.shape[0], -1)
+    model_components = np.asarray(model_velocity).reshape(training_components.shape)
+    # making the correct and model answers into 1 dimensional arrays 
+    correct = training_components.reshape(-1, 1)
+    guesses = model_components.reshape(-1, 1)
     history_range = (-hist_range_mag, hist_range_mag)
-    # seperating the components for each predition
-    for i in range(training_velocity.shape[0]): 
-        for j in range(training_velocity.shape[1]): 
-            training_components[i, j] = training_velocity[i, j, 0]
-            model_components[i, j] = model_velocity[i, j]
+    if density is None: 
+        density = correct.size > DENSITY_THRESHOLD
+    # the 2D histograms are images, which have no legend entry 
+    model_legend = [] if density else ['Model']
 
     if regression: 
-        # Linear Regression for all of the components of every prediction 
-        global_fit = LinearRegression().fit(correct, guesses)   
-        regressions = [] 
-        # Creating a linear fit for each component
-        for i in range(training_velocity.shape[1]): 
-            temp_correct = training_components[:, i]
-            temp_guess = model_components[:, i]
-            regressions.append(LinearRegression().fit(temp_correct.reshape(-1, 1),  temp_guess.reshape(-1, 1)))
+        # Linear Regression for each component and for all of the components of every prediction 
+        fits = fit_linear_regressions(training_components, model_components)
     # Creating the plots and subplots 
     num_components = training_velocity.shape[1]
 
@@ -377,17 +702,17 @@ def plot_model_results(profile_type, training_velocity, model_velocity, regressi
     hist_ylabel = 'Counts'
     if component_graphs: 
         for i in range(num_components): 
-            legend_names = ['Model', 'y = x']
-            axs[i, 0].set
+            legend_names = model_legend + ['y = x']
             axs[i, 0].set_title('$\mathregular{v_{%d}}$' % (i), fontsize=title_font_size)
             axs[i, 0].set_xlabel(line_xlabel, fontsize=xlabel_font_size)
             axs[i, 0].set_ylabel(line_ylabel, fontsize=ylabel_font_size)
 
-            axs[i, 0].plot(training_components[:, i], model_components[:, i], 'o')
+            plot_predictions(axs[i, 0], training_components[:, i], model_components[:, i], density, density_bins)
             axs[i, 0].plot(line_data, line_data, '-k')
             if regression: 
-                axs[i, 0].plot(line_data, regressions[i].predict(line_data))
-                legend_names.append('Model Regression\n y = %.4f x + %.4f' % (regressions[i].coef_, regressions[i].intercept_))
+                axs[i, 0].plot(line_data, fits['slope'][i] * line_data + fits['intercept'][i])
+                legend_names.append('Model Regression\n y = %.4f x + %.4f\n $R^2$ = %.4f' % (fits['slope'][i], fits['intercept'][i], 
+                                                                                         fits['r2'][i]))
             if show_legend: 
                 axs[i, 0].legend(legend_names)
 
@@ -397,17 +722,18 @@ def plot_model_results(profile_type, training_velocity, model_velocity, regressi
             axs[i, 1].hist(model_components[:, i] - training_components[:, i], bins=bins, edgecolor='black', range=history_range)
     # plotting for the global fit 
     if global_graphs: 
-        legend_names = ['Model', 'y = x']
+        legend_names = model_legend + ['y = x']
         if regression: 
-            legend_names.append('y = %.4f x + %.4f' % (global_fit.coef_, global_fit.intercept_))
+            legend_names.append('y = %.4f x + %.4f\n $R^2$ = %.4f' % (fits['global_slope'], fits['global_intercept'], 
+                                                                   fits['global_r2']))
         if global_index == 0: 
             axs[0].set_title('$\mathregular{\\vec{v}}$', fontsize=title_font_size)
             axs[0].set_xlabel(line_xlabel, fontsize=xlabel_font_size)
             axs[0].set_ylabel(line_ylabel, fontsize=ylabel_font_size)
-            axs[0].plot(correct, guesses, 'o')
+            plot_predictions(axs[0], correct, guesses, density, density_bins)
             axs[0].plot(line_data, line_data, '-k')
             if regression: 
-                axs[0].plot(line_data, global_fit.predict(line_data))
+                axs[0].plot(line_data, fits['global_slope'] * line_data + fits['global_intercept'])
             if show_legend: 
                 axs[0].legend(legend_names)
 
@@ -419,10 +745,10 @@ def plot_model_results(profile_type, training_velocity, model_velocity, regressi
             axs[global_index, 0].set_title('$\mathregular{\\vec{v}}$', fontsize=title_font_size)
             axs[global_index, 0].set_xlabel(line_xlabel, fontsize=xlabel_font_size)
             axs[global_index, 0].set_ylabel(line_ylabel, fontsize=ylabel_font_size)
-            axs[global_index, 0].plot(correct, guesses, 'o')
+            plot_predictions(axs[global_index, 0], correct, guesses, density, density_bins)
             axs[global_index, 0].plot(line_data, line_data, '-k')
             if regression: 
-                axs[global_index, 0].plot(line_data, global_fit.predict(line_data))
+                axs[global_index, 0].plot(line_data, fits['global_slope'] * line_data + fits['global_intercept'])
             if show_legend: 
                 axs[global_index, 0].legend(legend_names)
 
@@ -454,6 +780,10 @@ def create_model(input_shape, num_output, num_nodes,
     Returns: 
         The NN model compiled and the model summary is displayed 
     '''
+    from keras import Sequential
+    from keras.layers import Dropout
+    from keras.layers import Dense
+    from keras.layers import Input
     model = Sequential()
     model.add(Input(shape=input_shape))
     model.add(Dropout(rate=dropout_rate))
@@ -470,7 +800,8 @@ def save_model_information(sensitivity_scale_factor,
                            num_test_samples, nodes_per_layer, 
                            num_hidden_layers, hidden_layer_activation, 
                            epochs, path_to_file, batch_size=None, learning_rate=1e-3, 
-                           optimizer='adam', phase_scale_factor=None):
+                           optimizer='adam', phase_scale_factor=None, 
+                           generator_config=None, metrics=None, timings=None, phase_shift=0):
     ''' Save the paramters used when achieving a set of results for the NN model iteration 
     Args: 
         sensitivity_scale_factor: the factor by which the sensitivities will be scaled 
@@ -487,8 +818,13 @@ def save_model_information(sensitivity_scale_factor,
         learning_rate: The learning rate used during training 
         optimizer: The optimizer used during training 
         phase_scale_factor: The phase scale factor that should be used when making model predicitions 
+        generator_config: An optional dictionary describing how the training data was generated 
+        metrics: An optional dictionary of the final training metrics 
+        timings: An optional dictionary of the wall times of each stage of the run 
+        phase_shift: the shift added to the phases before scaling. Default = 0 
     Returns: 
-        Nothing is returned but a file with the information is created at the location path_to_file
+        Nothing is returned but a file with the information is created at the location path_to_file 
+        The same information is also saved as model_manifest.json in the same directory, see save_model_artifact 
     '''
     with open(path_to_file, 'w') as f: 
         f.write('phase_scale_factor = ' + str(phase_scale_factor) + '\n')
@@ -504,6 +840,180 @@ def save_model_information(sensitivity_scale_factor,
         f.write('batch_size = ' + str(batch_size) + '\n') 
         f.write('learning_rate = %E' % learning_rate + '\n')
         f.write('optimizer = '+ optimizer)
+    scaler = Scaler(max_vel, sensitivity_scale_factor, phase_scale_factor, phase_shift, 
+                    with_phase=phase_scale_factor is not None)
+    training_config = {'min_vel': min_vel, 
+                       'num_training_samples': num_training_samples, 
+                       'num_test_samples': num_test_samples, 
+                       'nodes_per_layer': nodes_per_layer, 
+                       'num_hidden_layers': num_hidden_layers, 
+                       'hidden_layer_activation': hidden_layer_activation, 
+                       'num_epochs': epochs, 
+                       'batch_size': batch_size, 
+                       'learning_rate': learning_rate, 
+                       'optimizer': optimizer if isinstance(optimizer, str) else type(optimizer).__name__}
+    save_model_artifact(os.path.dirname(path_to_file), scaler, generator_config=generator_config, 
+                        training_config=training_config, metrics=metrics, timings=timings)
+
+def save_model_artifact(path_to_results, scaler, generator_config=None, training_config=None, 
+                        metrics=None, timings=None): 
+    ''' Saves the manifest that describes everything needed to use and reproduce a trained model 
+
+    The manifest is a single json file, model_manifest.json, in the *_Velocity_Results directory. It holds the 
+    location of the saved Keras model, the scaler factors, the generator and training configuration, the training 
+    metrics and the timings of the run. 
+
+    Args: 
+        path_to_results: the *_Velocity_Results directory of the model 
+        scaler: the Scaler used for the model inputs and outputs 
+        generator_config: An optional dictionary describing how the training data was generated 
+        training_config: An optional dictionary of the model and training hyperparameters 
+        metrics: An optional dictionary of the final training metrics 
+        timings: An optional dictionary of the wall times of each stage of the run 
+    Returns: 
+        The location of the manifest 
+    '''
+    profile_type = os.path.basename(os.path.normpath(path_to_results))[:-len('_Velocity_Results')]
+    manifest = {'profile_type': profile_type, 
+                'model': profile_type + '_Model', 
+                'scaler': scaler.to_dict(), 
+                'generator': generator_config or {}, 
+                'training': training_config or {}, 
+                'metrics': metrics or {}, 
+                'timings': timings or {}, 
+                'created': time.time()}
+    path_to_manifest = os.path.join(path_to_results, MANIFEST_FILE)
+    with open(path_to_manifest, 'w') as f: 
+        json.dump(manifest, f, indent=4, default=float)
+    return path_to_manifest
+
+def parse_model_params(path_to_file): 
+    ''' Reads a model_params.txt file written by save_model_information into a dictionary 
+
+    Every line is split on the first ' = ', numbers are converted to int or float and 'None' to None 
+
+    Args: 
+        path_to_file: the location of the model_params.txt file 
+    Returns: 
+        A dictionary of the saved parameters 
+    '''
+    params = {}
+    with open(path_to_file, 'r') as f: 
+        for line in f: 
+            if ' = ' not in line: 
+                continue
+            key, value = line.strip().split(' = ', 1)
+            if value == 'None': 
+                value = None
+            else: 
+                for convert in [int, float]: 
+                    try: 
+                        value = convert(value)
+                        break
+                    except ValueError: 
+                        pass
+            params[key] = value
+    return params
+
+@lru_cache(maxsize=None)
+def _load_model_artifact(path_to_results, modified_time): 
+    path_to_manifest = os.path.join(path_to_results, MANIFEST_FILE)
+    if os.path.isfile(path_to_manifest): 
+        with open(path_to_manifest, 'r') as f: 
+            return json.load(f)
+    # models trained before the manifest existed only have model_params.txt 
+    params = parse_model_params(os.path.join(path_to_results, 'model_params.txt'))
+    profile_type = os.path.basename(os.path.normpath(path_to_results))[:-len('_Velocity_Results')]
+    phase_scale_factor = params.pop('phase_scale_factor', None)
+    scaler = Scaler(float(params.pop('max_vel')), params.pop('sensitivity_scale_factor'), phase_scale_factor, 
+                    with_phase=phase_scale_factor is not None)
+    return {'profile_type': profile_type, 
+            'model': profile_type + '_Model', 
+            'scaler': scaler.to_dict(), 
+            'generator': {}, 
+            'training': params, 
+            'metrics': {}, 
+            'timings': {}}
+
+def load_model_artifact(profile_type): 
+    ''' Loads the manifest of a trained model, see save_model_artifact 
+
+    The manifest is parsed once and cached until the file changes on disk. Models without a manifest are read 
+    from their model_params.txt instead 
+
+    Args: 
+        profile_type: the profile type that is used for training the model 
+    Returns: 
+        A dictionary with the keys profile_type, model, scaler, generator, training, metrics and timings 
+    '''
+    path_to_results = profile_type + '_Velocity_Results'
+    path_to_manifest = os.path.join(path_to_results, MANIFEST_FILE)
+    if not os.path.isfile(path_to_manifest): 
+        path_to_manifest = os.path.join(path_to_results, 'model_params.txt')
+    return _load_model_artifact(os.path.abspath(path_to_results), os.path.getmtime(path_to_manifest))
+
+def load_model_scaler(profile_type): 
+    ''' Loads the Scaler of a trained model from its manifest 
+
+    Args: 
+        profile_type: the profile type that is used for training the model 
+    Returns: 
+        The Scaler used for the model inputs and outputs 
+    '''
+    return Scaler(**load_model_artifact(profile_type)['scaler'])
+
+def get_model_signature(profile_type): 
+    ''' Summarizes the files of a saved model so changes on disk can be detected without loading it 
+
+    Args: 
+        profile_type: the profile type that is used for training the model 
+    Returns: 
+        A tuple of the number of files, their total size and their latest modification time 
+    '''
+    path_to_results = profile_type + '_Velocity_Results'
+    paths = [os.path.join(path_to_results, name) for name in [MANIFEST_FILE, 'model_params.txt']]
+    for root, dirs, files in os.walk(os.path.join(path_to_results, profile_type + '_Model')): 
+        paths.extend(os.path.join(root, name) for name in files)
+    stats = [os.stat(path) for path in paths if os.path.isfile(path)]
+    return len(stats), sum(stat.st_size for stat in stats), max([stat.st_mtime_ns for stat in stats], default=0)
+
+def load_model_and_scaler(profile_type): 
+    ''' Loads a trained Keras model together with its Scaler in one call 
+
+    Models are loaded lazily and kept in a least recently used registry of MODEL_REGISTRY_SIZE entries keyed by 
+    profile_type, so sweeps that call the validation and uncertainty helpers many times only deserialize each 
+    model once. An entry is reloaded when the files of the model change on disk. 
+
+    Args: 
+        profile_type: the profile type that is used for training the model 
+    Returns: 
+        model: the trained Keras model 
+        scaler: the Scaler used for the model inputs and outputs 
+    '''
+    signature = get_model_signature(profile_type)
+    with _model_registry_lock: 
+        entry = _model_registry.get(profile_type)
+        if entry is not None and entry[0] == signature: 
+            _model_registry.move_to_end(profile_type)
+            return entry[1], entry[2]
+    from keras.models import load_model
+    artifact = load_model_artifact(profile_type)
+    model = load_model(os.path.join(profile_type + '_Velocity_Results', artifact['model']))
+    scaler = Scaler(**artifact['scaler'])
+    with _model_registry_lock: 
+        _model_registry[profile_type] = (signature, model, scaler)
+        _model_registry.move_to_end(profile_type)
+        while len(_model_registry) > MODEL_REGISTRY_SIZE: 
+            _model_registry.popitem(last=False)
+    return model, scaler
+
+def clear_model_registry(profile_type=None): 
+    ''' Removes one model, or every model when profile_type is None, from the registry of load_model_and_scaler '''
+    with _model_registry_lock: 
+        if profile_type is None: 
+            _model_registry.clear()
+        else: 
+            _model_registry.pop(profile_type, None)
 
 def show_previous_results(profile_type, regression=True, 
                           component_graphs=True, global_graphs=True,
@@ -542,22 +1052,8 @@ def load_model_scaling_factors(profile_type):
         sensitivity_scale_factor: The scale factor for the sensitivity 
         max_vel: The maximum possible velocity in the training set 
     '''
-    path_to_results = profile_type + '_Velocity_Results'
-    path_to_model_params = path_to_results + '/model_params.txt'
-    with open(path_to_model_params, 'r') as f: 
-        # throw away the phase_scale_factor 
-        phase_scale_factor = f.readline()[len('phase_scale_factor = '):-1]
-        # throw away sensitivity_scale_factor 
-        sensitivity_scale_factor = f.readline()[len('sensitivity_scale_factor = ' ):-1]
-        # throw away min_vel 
-        f.readline()
-        max_vel = float(f.readline()[len('max_vel = ' ):-1])
-
-        if 'None' not in phase_scale_factor: 
-            phase_scale_factor = float(phase_scale_factor)
-        if 'None' not in sensitivity_scale_factor: 
-            sensitivity_scale_factor = float(sensitivity_scale_factor)
-    return phase_scale_factor, sensitivity_scale_factor, max_vel 
+    scaler = load_model_scaler(profile_type)
+    return scaler.phase_scale_factor, scaler.sensitivity_scale_factor, scaler.max_vel 
 
 def plot_historys(historys, params, param_name=None, validation=True): 
     ''' Plots NN models training models training performance over the course of several different training sets 
@@ -569,6 +1065,7 @@ def plot_historys(historys, params, param_name=None, validation=True):
     Returns: 
         Nothing is displayed but histories are plotted in a (1, 2) subplot with mse on the left and mae on the right 
     '''
+    plt = get_pyplot()
     fig = plt.figure(figsize=(10, 5))
     gs = fig.add_gridspec(1, 2, hspace=0.25)
     axs = gs.subplots()
@@ -0,0 +1,101 @@
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+# buffers shared with the worker processes, set up once per worker by _attach_buffers
+_worker_buffers = {}
+
+def _get_layout(A, size, with_bs, compact):
+    ''' Lists the name, shape and dtype of every output buffer of a generate_*_data function '''
+    if compact:
+        layout = [('inputs', (size, 2 * A.shape[0]), np.float32),
+                  ('velocity', (size, A.shape[1]), np.float32)]
+        if with_bs:
+            layout.append(('bs', (size, A.shape[0]), np.complex128))
+        return layout
+    layout = [('sensitivity', (size, A.shape[0], 1), np.float64),
+              ('velocity', (size, A.shape[1], 1), np.float64),
+              ('phase', (size, A.shape[0], 1), np.float64)]
+    if with_bs:
+        layout.append(('bs', (size, A.shape[0], 1), np.complex128))
+    return layout
+
+def _attach_buffers(names, layout):
+    ''' Worker initializer that maps the shared output buffers into the worker process '''
+    _worker_buffers.clear()
+    for name, (key, shape, dtype) in zip(names, layout):
+        shm = shared_memory.SharedMemory(name=name)
+        _worker_buffers[key] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+def _generate_chunk(generator, A, start, stop, seed_sequence, generator_args):
+    ''' Generates samples start to stop with their own random stream and writes them into the shared buffers '''
+    rng = np.random.default_rng(seed_sequence)
+    results = generator(A, stop - start, rng=rng, **generator_args)
+    # the buffers are in the same order as the generator results, any unused b vectors are dropped by zip
+    for (shm, buffer), data in zip(_worker_buffers.values(), results):
+        buffer[start:stop] = data
+    return stop - start
+
+def generate_parallel_data(generator, A, size, seed, workers=None, chunk_size=2**16, with_bs=True, compact=False,
+                           **generator_args):
+    ''' Generates a reproducible data set with a generate_*_data function split over a pool of processes
+
+    The samples are split into chunks of chunk_size and every chunk draws from its own numpy Generator spawned
+    from a single SeedSequence(seed). The chunking does not depend on the number of workers so a given seed
+    produces bit-identical data for any worker count. Workers write their chunks directly into preallocated
+    shared memory so no large arrays are pickled between processes.
+
+    Args:
+        generator: the generate_*_data function used to create the data (e.g. generate_power_data)
+        A: the matrix generated from the COMSOL simulation, (M, N)
+        size: the number of pairs of sensitivity, velocity vectors that you want to generate
+        seed: the seed of the SeedSequence the per chunk random streams are spawned from
+        workers: the number of worker processes. 1 generates in the current process. Default = None (one per core)
+        chunk_size: the number of samples generated by each task. Default = 2**16
+        with_bs: An option to also return the complex b vectors. Default = True
+        compact: An option to generate the float32 layout of get_compact_profile_data. Default = False
+        generator_args: the remaining arguments of the generator (min_vel, max_vel, rad_pos, R, min_n, max_n)
+    Returns:
+        sensitivity: (size, M, 1) ndarray of sensitivity matricies.
+        velocity_profile: (size, N, 1) ndarray of corrisponding velocty profiles.
+        phases: (size, M, 1) of phases of the values in b
+        bs: (size, M, 1) ndarray of the b vectors. Only returned when with_bs is True
+        When compact is True the (inputs, velocity_profile[, bs]) of get_compact_profile_data are returned instead
+    '''
+    layout = _get_layout(A, size, with_bs, compact)
+    if compact:
+        generator_args = dict(generator_args, compact=True, with_bs=with_bs)
+    starts = list(range(0, size, chunk_size))
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(starts))
+    tasks = [(generator, A, start, min(start + chunk_size, size), seed_sequence, generator_args)
+             for start, seed_sequence in zip(starts, seed_sequences)]
+
+    if workers == 1:
+        outputs = {key: np.empty(shape, dtype=dtype) for key, shape, dtype in layout}
+        for generator, A, start, stop, seed_sequence, generator_args in tasks:
+            results = generator(A, stop - start, rng=np.random.default_rng(seed_sequence), **generator_args)
+            for output, data in zip(outputs.values(), results):
+                output[start:stop] = data
+        return tuple(outputs[key] for key, shape, dtype in layout)
+
+    shms = [shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+            for key, shape, dtype in layout]
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach_buffers,
+                                 initargs=([shm.name for shm in shms], layout)) as pool:
+            # consuming the results re-raises any exception from the workers
+            list(pool.map(_generate_chunk, *zip(*tasks)))
+        outputs = []
+        for shm, (key, shape, dtype) in zip(shms, layout):
+            # copying one buffer at a time and releasing it right away keeps the peak memory near one data set
+            outputs.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy())
+            shm.close()
+            shm.unlink()
+    finally:
+        for shm in shms:
+            try:
+                shm.close()
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+    return tuple(outputs)
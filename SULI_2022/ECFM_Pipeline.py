@@ -0,0 +1,372 @@
+''' Headless end to end ECFM workflow: generate -> train -> evaluate -> save -> validate
+
+Runs the same steps as the ECFM_NN_main notebooks from a config so models can be trained unattended on batch
+nodes. The wall time, peak RSS and samples/s of every stage are written to pipeline_report.json in the
+*_Velocity_Results directory next to the model.
+
+Usage:
+    python ECFM_Pipeline.py config.json --set size=2097152 --set epochs=5
+
+    The config is a json object with any of the keys of DEFAULT_CONFIG. --set values are parsed as json when
+    possible and as strings otherwise.
+'''
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+from math import pi
+from contextlib import contextmanager
+from ECFM_NN_helpers import generate_constant_data, generate_linear_data, generate_parabolic_data
+from ECFM_NN_helpers import generate_power_data, generate_monotonic_data, generate_random_data
+from ECFM_NN_helpers import create_model, load_model_and_scaler, plot_model_results, save_model_information, Scaler
+from ECFM_Input_Helpers import get_frequency_index, load_ecfm_inputs, MATRIX_FILE
+from ECFM_Parallel_Helpers import generate_parallel_data
+from ECFM_Cache_Helpers import generate_cached_data
+from ECFM_Metrics_Helpers import compute_metrics, metrics_to_dict
+
+GENERATORS = {'Constant': generate_constant_data,
+              'Linear': generate_linear_data,
+              'Parabolic': generate_parabolic_data,
+              'Power': generate_power_data,
+              'Monotonic': generate_monotonic_data,
+              'Random': generate_random_data}
+REPORT_FILE = 'pipeline_report.json'
+STAGES = ['generate', 'train', 'evaluate', 'save', 'validate']
+
+DEFAULT_CONFIG = {
+    # the results are saved in <profile_type>[_With_Phase]_Velocity_Results
+    'profile_type': 'Parabolic',
+    # the generate_*_data family the training data is drawn from. None uses profile_type
+    'profile_family': None,
+    'with_phase': True,
+    'input_directory': 'ECFM_Inputs',
+    'validation_directory': 'ECFM_Validation_Inputs',
+    'min_vel': 0,
+    'max_vel': 5,
+    'R': 0.012827,
+    'min_n': 5,
+    'max_n': 10,
+    'size': 8**7,
+    'test_size': 2**7,
+    'seed': 0,
+    # the number of data generation processes. None uses one per core
+    'workers': None,
+    # an optional ECFM_Dataset_Cache directory so repeated runs reuse the same training data
+    'cache_dir': None,
+    'phase_shift': 0,
+    # None uses (M + N) * 5 like the notebooks
+    'num_nodes': None,
+    'num_hidden_layers': 2,
+    'hidden_layer_activation': 'relu',
+    'dropout_rate': 0,
+    'epochs': 1,
+    'learning_rate': 1e-3,
+    'batch_size': 100,
+    'validation_split': 0.1,
+    # checkpointing, early stopping and learning rate schedule of the training, see train_model
+    'resume': True,
+    'checkpoint_every': 1,
+    'patience': None,
+    'reduce_lr_patience': None,
+    'reduce_lr_factor': 0.5,
+    'min_lr': 0,
+    'verbose': 2,
+    # the measured phases are shifted by this offset and the components in phase_unwrap get 2 pi added
+    'phase_offset': 0.4 - pi,
+    'phase_unwrap': [4, 10],
+    'validation_samples': 1000,
+    'error_factor': 0.05,
+    'plots': True,
+    'stages': STAGES,
+}
+# settings that change neither the data nor the trained weights, epochs is one of them so a finished run can be
+# extended by resuming it with more epochs
+RUN_KEYS = ['workers', 'cache_dir', 'verbose', 'plots', 'stages', 'validation_directory', 'validation_samples',
+            'error_factor', 'phase_offset', 'phase_unwrap', 'resume', 'checkpoint_every', 'epochs']
+
+def get_peak_rss():
+    ''' Gets the peak resident set size of this process and of its finished child processes
+
+    Returns:
+        peak_rss: the peak RSS of the current process [MB], None where the resource module is unavailable
+        peak_children_rss: the largest peak RSS of any finished child process [MB]
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 / 2**20 if sys.platform == 'darwin' else 1 / 2**10
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+@contextmanager
+def record_stage(report, name, num_samples=None):
+    ''' Records the wall time, peak RSS and throughput of a stage of the pipeline
+
+    The peak RSS is the peak of the process so far, so a stage that does not raise it reports the same value
+    as the stage before it
+
+    Args:
+        report: the dictionary the stage is recorded in under name
+        name: the name of the stage
+        num_samples: the number of samples processed by the stage, used for samples/s. Default = None
+    '''
+    start = time.perf_counter()
+    yield
+    wall_time = time.perf_counter() - start
+    peak_rss, peak_children_rss = get_peak_rss()
+    report[name] = {'wall_time': wall_time, 'peak_rss_mb': peak_rss, 'peak_children_rss_mb': peak_children_rss}
+    if num_samples is not None:
+        report[name]['num_samples'] = num_samples
+        report[name]['samples_per_second'] = num_samples / wall_time if wall_time > 0 else None
+    print('[%s] %.2f s, peak RSS %s MB' % (name, wall_time, 'n/a' if peak_rss is None else '%.0f' % peak_rss))
+
+def use_agg_backend():
+    ''' Makes matplotlib save figures without a display, without importing it when it is not loaded yet '''
+    if 'matplotlib' in sys.modules:
+        sys.modules['matplotlib'].use('Agg')
+    else:
+        os.environ['MPLBACKEND'] = 'Agg'
+
+def get_profile_type(config):
+    ''' Gets the name of the results directory and model of a config (e.g. Parabolic_With_Phase) '''
+    profile_type = config['profile_type']
+    if config['with_phase'] and not profile_type.endswith('_With_Phase'):
+        profile_type += '_With_Phase'
+    return profile_type
+
+def get_run_key(config):
+    ''' Creates a key of the settings of a training run, used to only resume checkpoints of the same run '''
+    settings = {key: value for key, value in config.items() if key not in RUN_KEYS}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+def get_generator(config, rad_pos):
+    ''' Gets the generate_*_data function and its arguments described by a config
+
+    Args:
+        config: the pipeline config, see DEFAULT_CONFIG
+        rad_pos: the radial positions of the velocity components
+    Returns:
+        generator: the generate_*_data function
+        generator_args: the keyword arguments of the generator
+    '''
+    family = (config['profile_family'] or config['profile_type']).replace('_With_Phase', '')
+    if family not in GENERATORS:
+        raise ValueError('Unknown profile family: ' + family)
+    generator_args = {'min_vel': config['min_vel'], 'max_vel': config['max_vel']}
+    if family in ['Linear', 'Parabolic', 'Power']:
+        generator_args['rad_pos'] = rad_pos
+    if family == 'Power':
+        generator_args.update(R=config['R'], min_n=config['min_n'], max_n=config['max_n'])
+    return GENERATORS[family], generator_args
+
+def generate_inputs(A, rad_pos, config, size, seed):
+    ''' Generates unscaled compact network inputs and velocity profiles for a config
+
+    Args:
+        A: the matrix generated from the COMSOL simulation, (M, N)
+        rad_pos: the radial positions of the velocity components
+        config: the pipeline config, see DEFAULT_CONFIG
+        size: the number of samples
+        seed: the seed of the data set
+    Returns:
+        inputs: (size, 2M) float32 ndarray of sensitivities then phases, (size, M) without phase
+        velocity: (size, N) float32 ndarray of velocity profiles [m/s]
+    '''
+    generator, generator_args = get_generator(config, rad_pos)
+    if config['cache_dir'] is not None:
+        sensitivity, velocity, phase = generate_cached_data(generator, A,
+                                                            os.path.join(config['input_directory'], MATRIX_FILE),
+                                                            size, seed, cache_dir=config['cache_dir'],
+                                                            workers=config['workers'], **generator_args)
+        inputs = np.concatenate([sensitivity[:, :, 0], phase[:, :, 0]], axis=1)
+        velocity = np.array(velocity[:, :, 0], dtype=np.float32)
+    else:
+        inputs, velocity = generate_parallel_data(generator, A, size, seed, workers=config['workers'],
+                                                  with_bs=False, compact=True, **generator_args)
+    if not config['with_phase']:
+        inputs = inputs[:, :A.shape[0]]
+    return np.ascontiguousarray(inputs, dtype=np.float32), velocity
+
+def load_validation_inputs(config, num_sens):
+    ''' Loads the measured sensitivities and phases and the CFD velocity profile used to validate the models
+
+    Args:
+        config: the pipeline config, see DEFAULT_CONFIG
+        num_sens: the number of frequencies the model uses
+    Returns:
+        measured_sensitivity: (M, ) measured sensitivities [V]
+        measured_phase: (M, 1) measured phases [Radians]
+        cfd_rad_pos: the radial positions of the CFD profile [m]
+        cfd_vel_profile: the CFD velocity profile [m/s]
+    '''
+    directory = config['validation_directory']
+    measured_sensitivity = np.loadtxt(os.path.join(directory, 'ECFM_measured_sensitivity.csv'), delimiter=',')
+    measured_phase = np.loadtxt(os.path.join(directory, 'ECFM_measured_phase_radian.csv'), delimiter=',')
+    measured_phase = measured_phase.reshape(-1, 1) + config['phase_offset']
+    if config['phase_unwrap'] is not None:
+        measured_phase[slice(*config['phase_unwrap'])] += 2 * pi
+    cfd_rad_pos = np.loadtxt(os.path.join(directory, 'ECFM_rad_pos.csv'), delimiter=',')
+    cfd_vel_profile = np.loadtxt(os.path.join(directory, 'ECFM_CFD_velocity.csv'), delimiter=',')
+    return measured_sensitivity[:num_sens], measured_phase[:num_sens], cfd_rad_pos, cfd_vel_profile
+
+def run_pipeline(config=None, headless=True, **overrides):
+    ''' Runs the ECFM workflow of the notebooks without any interaction
+
+    Args:
+        config: a dictionary with any of the keys of DEFAULT_CONFIG. Default = None (DEFAULT_CONFIG)
+        headless: An option to use the Agg matplotlib backend so figures are only saved. Default = True
+        overrides: single config values that take precedence over config
+    Returns:
+        The report that is also saved as pipeline_report.json: the config, the measurements of every stage,
+        the training and evaluation metrics, the per component evaluation metrics of compute_metrics and the
+        validation errors
+    '''
+    config = dict(DEFAULT_CONFIG, **(config or {}), **overrides)
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError('Unknown config keys: ' + ', '.join(sorted(unknown)))
+    if headless:
+        use_agg_backend()
+    stages = config['stages']
+    if set(stages) - set(STAGES):
+        raise ValueError('Unknown stages: ' + ', '.join(sorted(set(stages) - set(STAGES))))
+    if 'save' in stages and 'train' not in stages:
+        raise ValueError('The save stage needs the train stage')
+    profile_type = get_profile_type(config)
+    path_to_results = profile_type + '_Velocity_Results'
+    os.makedirs(path_to_results, exist_ok=True)
+    size, test_size, max_vel = config['size'], config['test_size'], config['max_vel']
+    report = {'profile_type': profile_type, 'config': config, 'stages': {}, 'metrics': {}}
+
+    A, rad_pos, freq = load_ecfm_inputs(config['input_directory'], get_frequency_index(config['with_phase']))
+    num_sens, num_vel = A.shape
+
+    # the validate stage uses the measurements and the saved model only, so it skips generating the data sets
+    if {'generate', 'train', 'evaluate'} & set(stages):
+        # evaluating a previously trained model needs neither the training set nor a new Scaler
+        with_training_set = 'train' in stages or 'evaluate' not in stages
+        with record_stage(report['stages'], 'generate', size * with_training_set + test_size):
+            if with_training_set:
+                train_inputs, train_velocity = generate_inputs(A, rad_pos, config, size, config['seed'])
+                scaler = Scaler(max_vel, phase_shift=config['phase_shift'],
+                                with_phase=config['with_phase']).fit(train_inputs)
+                train_inputs = scaler.transform(train_inputs)
+                train_velocity_scaled = scaler.transform_velocity(train_velocity)
+            else:
+                # the scale factors the saved model was trained with
+                model, scaler = load_model_and_scaler(profile_type)
+            eval_inputs, eval_velocity = generate_inputs(A, rad_pos, config, test_size, config['seed'] + 1)
+            eval_inputs = scaler.transform(eval_inputs)
+            eval_velocity_scaled = scaler.transform_velocity(eval_velocity, copy=True)
+
+    if 'train' in stages:
+        from tensorflow.keras.optimizers import Adam
+        from ECFM_Training_Helpers import train_model
+        num_nodes = config['num_nodes'] or (num_sens + num_vel) * 5
+        with record_stage(report['stages'], 'train', size * config['epochs']):
+            model = create_model((train_inputs.shape[1], ), num_vel, num_nodes,
+                                 num_hidden_layers=config['num_hidden_layers'],
+                                 hidden_layer_activation=config['hidden_layer_activation'],
+                                 optimizer=Adam(learning_rate=config['learning_rate']),
+                                 dropout_rate=config['dropout_rate'])
+            history = train_model(model, train_inputs, train_velocity_scaled,
+                                  os.path.join(path_to_results, 'checkpoints'), config['epochs'],
+                                  batch_size=config['batch_size'], validation_split=config['validation_split'],
+                                  resume=config['resume'], run_key=get_run_key(config),
+                                  checkpoint_every=config['checkpoint_every'], patience=config['patience'],
+                                  reduce_lr_patience=config['reduce_lr_patience'],
+                                  reduce_lr_factor=config['reduce_lr_factor'], min_lr=config['min_lr'],
+                                  verbose=config['verbose'], shuffle=True)
+        report['history'] = history.history
+        report['stopped_early'] = history.stopped_early
+        report['metrics'].update({key: float(values[-1]) for key, values in history.history.items()})
+        del train_inputs, train_velocity_scaled
+
+    if 'evaluate' in stages:
+        with record_stage(report['stages'], 'evaluate', test_size):
+            model_velocity = model.predict(eval_inputs, verbose=0)
+        errors = model_velocity - eval_velocity_scaled
+        report['metrics'].update({'eval_mse': float(np.mean(errors**2)),
+                                  'eval_mae': float(np.mean(np.abs(errors))),
+                                  'eval_rmse_m_s': float(np.sqrt(np.mean(errors**2)) * max_vel)})
+        report['evaluation'] = metrics_to_dict(compute_metrics(eval_velocity, model_velocity * max_vel))
+
+    if 'save' in stages:
+        with record_stage(report['stages'], 'save'):
+            model.save(os.path.join(path_to_results, profile_type + '_Model'))
+            if 'evaluate' in stages:
+                # same layout as the notebooks so show_previous_results keeps working
+                np.save(os.path.join(path_to_results, 'model_velocity'), model_velocity)
+                np.save(os.path.join(path_to_results, 'eval_velocity_scaled'), eval_velocity_scaled[:, :, np.newaxis])
+            generator, generator_args = get_generator(config, rad_pos)
+            generator_config = {key: value for key, value in generator_args.items() if key != 'rad_pos'}
+            generator_config.update(generator=generator.__name__, seed=config['seed'], phase_shift=config['phase_shift'])
+            save_model_information(scaler.sensitivity_scale_factor, config['min_vel'], max_vel, size, test_size,
+                                   num_nodes, config['num_hidden_layers'], config['hidden_layer_activation'],
+                                   config['epochs'], os.path.join(path_to_results, 'model_params.txt'),
+                                   config['batch_size'], config['learning_rate'],
+                                   phase_scale_factor=scaler.phase_scale_factor,
+                                   generator_config=generator_config, metrics=report['metrics'],
+                                   timings={name: stage['wall_time'] for name, stage in report['stages'].items()},
+                                   phase_shift=config['phase_shift'])
+            if config['plots'] and 'evaluate' in stages:
+                plot_model_results(profile_type, eval_velocity[:, :, np.newaxis], model_velocity * max_vel, bins=20)
+                plot_model_results(profile_type, eval_velocity[:, :, np.newaxis], model_velocity * max_vel, bins=20,
+                                   regression=False)
+
+    if 'validate' in stages:
+        from ECFM_Validation_Helpers import model_validation, model_validation_with_phase, sample_actual_profile
+        measured_sensitivity, measured_phase, cfd_rad_pos, cfd_vel_profile = load_validation_inputs(config, num_sens)
+        with record_stage(report['stages'], 'validate', config['validation_samples']):
+            if config['with_phase']:
+                base_case, errors = model_validation_with_phase(profile_type, cfd_vel_profile, cfd_rad_pos, rad_pos,
+                                                                measured_sensitivity, measured_phase,
+                                                                num_samples=config['validation_samples'],
+                                                                error_factor=config['error_factor'])
+            else:
+                base_case, errors = model_validation(profile_type, cfd_vel_profile, cfd_rad_pos, rad_pos,
+                                                     measured_sensitivity, num_samples=config['validation_samples'],
+                                                     error_factor=config['error_factor'])
+        actual_profile = sample_actual_profile(cfd_rad_pos, cfd_vel_profile, rad_pos).reshape(-1)
+        report['validation'] = {'predicted_profile': base_case.tolist(),
+                                'absolute_error': np.abs(base_case - actual_profile).tolist(),
+                                'metrics': metrics_to_dict(compute_metrics(actual_profile, base_case.reshape(1, -1))),
+                                'monte_carlo_rmse': errors.tolist()}
+
+    if 'matplotlib.pyplot' in sys.modules:
+        # releases the figures of the stages, which are already saved as pdf
+        sys.modules['matplotlib.pyplot'].close('all')
+    with open(os.path.join(path_to_results, REPORT_FILE), 'w') as f:
+        json.dump(report, f, indent=4, default=float)
+    return report
+
+def parse_value(value):
+    ''' Parses a --set value as json and falls back to the raw string '''
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the ECFM generate, train, evaluate and validate workflow')
+    parser.add_argument('config', nargs='?', help='a json file with any of the keys of DEFAULT_CONFIG')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='overrides a single config value, may be repeated')
+    args = parser.parse_args()
+    config = {}
+    if args.config is not None:
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+    for item in args.set:
+        key, value = item.split('=', 1)
+        config[key] = parse_value(value)
+    report = run_pipeline(config)
+    print(json.dumps({'stages': report['stages'], 'metrics': report['metrics']}, indent=4, default=float))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+''' Parallel hyperparameter sweeps over the training settings of the ECFM models
+
+The training data is generated and scaled once, saved as .npy files and memory mapped by every worker so the
+workers share the same pages instead of each holding a copy. Each point of the grid trains in its own process
+with TensorFlow limited to threads_per_worker threads. Finished points are stored in an sqlite database, so an
+interrupted or extended sweep only trains the points that are missing.
+
+Usage:
+    python ECFM_Sweep.py Activations config.json --grid '{"hidden_layer_activation": ["relu", "tanh", "elu"]}' --workers 3
+
+    The config holds the data and fixed training settings with the keys of ECFM_Pipeline.DEFAULT_CONFIG
+'''
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import itertools
+import numpy as np
+import multiprocessing
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ECFM_NN_helpers import Scaler
+from ECFM_Cache_Helpers import get_file_hash
+from ECFM_Input_Helpers import get_frequency_index, load_ecfm_inputs, MATRIX_FILE
+from ECFM_Pipeline import DEFAULT_CONFIG, RUN_KEYS, generate_inputs
+
+SWEEP_DIRECTORY = 'ECFM_Sweeps'
+STORE_FILE = 'sweeps.sqlite'
+# the settings that may change between the points of a sweep, everything else defines the shared data set
+TRAINING_KEYS = ['num_nodes', 'num_hidden_layers', 'hidden_layer_activation', 'dropout_rate', 'epochs',
+                 'learning_rate', 'batch_size', 'validation_split', 'patience', 'reduce_lr_patience',
+                 'reduce_lr_factor', 'min_lr']
+DATA_ARRAYS = ['train_inputs', 'train_velocity', 'eval_inputs', 'eval_velocity']
+
+class SweepStore:
+    ''' sqlite store of the results of the sweep points, indexed by sweep name and point key
+
+    Only the process running the sweep writes to the store and every point is committed as soon as it finishes.
+    A point shared by two sweeps has a row in each, so neither loses its result to the other
+
+    Args:
+        path_to_file: the location of the database. Default = 'ECFM_Sweeps/sweeps.sqlite'
+    '''
+    def __init__(self, path_to_file=os.path.join(SWEEP_DIRECTORY, STORE_FILE)):
+        directory = os.path.dirname(path_to_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path_to_file)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT, sweep TEXT, '
+                                'params TEXT, status TEXT, metrics TEXT, history TEXT, timings TEXT, '
+                                'error TEXT, finished REAL, PRIMARY KEY (sweep, key))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS results_sweep ON results (sweep, status)')
+        self.connection.commit()
+
+    def finished_keys(self, sweep):
+        ''' The keys of the points of a sweep that trained successfully '''
+        rows = self.connection.execute("SELECT key FROM results WHERE sweep = ? AND status = 'done'", (sweep, ))
+        return set(row[0] for row in rows)
+
+    def save(self, sweep, key, params, status, metrics=None, history=None, timings=None, error=None):
+        ''' Inserts or replaces the result of one point '''
+        self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (key, sweep, json.dumps(params, sort_keys=True), status, json.dumps(metrics or {}),
+                                 json.dumps(history or {}), json.dumps(timings or {}), error, time.time()))
+        self.connection.commit()
+
+    def results(self, sweep, status='done', sort_by='val_mse'):
+        ''' Loads the results of a sweep
+
+        Args:
+            sweep: the name of the sweep
+            status: only points with this status are returned, None returns all of them. Default = 'done'
+            sort_by: the metric the points are sorted by, None keeps the order they finished in. Default = 'val_mse'
+        Returns:
+            A list of dictionaries with the key, params, status, metrics, history, timings and error of each point
+        '''
+        query = 'SELECT * FROM results WHERE sweep = ?'
+        args = (sweep, )
+        if status is not None:
+            query += ' AND status = ?'
+            args += (status, )
+        rows = self.connection.execute(query + ' ORDER BY finished', args).fetchall()
+        names = ['key', 'sweep', 'params', 'status', 'metrics', 'history', 'timings', 'error', 'finished']
+        results = []
+        for row in rows:
+            result = dict(zip(names, row))
+            for name in ['params', 'metrics', 'history', 'timings']:
+                result[name] = json.loads(result[name])
+            results.append(result)
+        if sort_by is not None:
+            results.sort(key=lambda result: result['metrics'].get(sort_by, np.inf))
+        return results
+
+    def histories(self, sweep, param_name=None):
+        ''' Loads the training histories of a sweep in the form taken by plot_historys
+
+        Args:
+            sweep: the name of the sweep
+            param_name: the swept setting used to label each history. Default = None (all swept settings)
+        Returns:
+            historys: objects with a .history dictionary like the ones returned by model.fit
+            params: the label of each history
+        '''
+        results = self.results(sweep, sort_by=None)
+        historys = [SimpleNamespace(history=result['history']) for result in results]
+        if param_name is not None:
+            params = [result['params'][param_name] for result in results]
+        else:
+            params = [', '.join('%s=%s' % item for item in sorted(result['params'].items())) for result in results]
+        return historys, params
+
+    def close(self):
+        self.connection.close()
+
+def get_grid_points(grid):
+    ''' Expands a dictionary of setting -> list of values into the list of every combination '''
+    for name in grid:
+        if name not in TRAINING_KEYS:
+            raise ValueError('%s can not be swept, only %s can' % (name, ', '.join(TRAINING_KEYS)))
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+def get_data_key(config):
+    ''' Creates the key of the data set shared by the points of a sweep from the data settings and the A matrix '''
+    data_config = {key: value for key, value in config.items() if key not in TRAINING_KEYS + RUN_KEYS}
+    digest = hashlib.sha256(get_file_hash(os.path.join(config['input_directory'], MATRIX_FILE)).encode())
+    digest.update(json.dumps(data_config, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+def get_point_key(data_key, config, params):
+    ''' Creates the key of one point from its data set and every training setting it is trained with '''
+    training_config = {key: config[key] for key in TRAINING_KEYS}
+    training_config.update(params)
+    return hashlib.sha256((data_key + json.dumps(training_config, sort_keys=True)).encode()).hexdigest()
+
+def prepare_sweep_data(config, path_to_data):
+    ''' Generates, scales and saves the data set shared by the workers unless it is already saved
+
+    Args:
+        config: the sweep config, see ECFM_Pipeline.DEFAULT_CONFIG
+        path_to_data: the directory the .npy files and scaler.json are saved in
+    Returns:
+        The key of the data set, see get_data_key
+    '''
+    data_key = get_data_key(config)
+    path_to_key = os.path.join(path_to_data, 'data_key.txt')
+    if os.path.isfile(path_to_key):
+        with open(path_to_key, 'r') as f:
+            if f.read() == data_key:
+                return data_key
+    os.makedirs(path_to_data, exist_ok=True)
+    A, rad_pos, freq = load_ecfm_inputs(config['input_directory'], get_frequency_index(config['with_phase']))
+    train_inputs, train_velocity = generate_inputs(A, rad_pos, config, config['size'], config['seed'])
+    eval_inputs, eval_velocity = generate_inputs(A, rad_pos, config, config['test_size'], config['seed'] + 1)
+    scaler = Scaler(config['max_vel'], phase_shift=config['phase_shift'], with_phase=config['with_phase']).fit(train_inputs)
+    arrays = {'train_inputs': scaler.transform(train_inputs),
+              'train_velocity': scaler.transform_velocity(train_velocity),
+              'eval_inputs': scaler.transform(eval_inputs),
+              'eval_velocity': scaler.transform_velocity(eval_velocity)}
+    for name in DATA_ARRAYS:
+        np.save(os.path.join(path_to_data, name + '.npy'), arrays[name])
+    scaler.save(os.path.join(path_to_data, 'scaler.json'))
+    # the key is written last so a partially written data set is regenerated
+    with open(path_to_key, 'w') as f:
+        f.write(data_key)
+    return data_key
+
+def _init_worker(threads_per_worker):
+    # the thread counts have to be set before TensorFlow starts its thread pools
+    for name in ['OMP_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS']:
+        os.environ[name] = str(threads_per_worker)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads_per_worker)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+def _train_point(config, params, path_to_data, path_to_checkpoints, path_to_model=None):
+    from tensorflow.keras.optimizers import Adam
+    from ECFM_NN_helpers import create_model
+    from ECFM_Training_Helpers import train_model
+    config = dict(config, **params)
+    data = {name: np.load(os.path.join(path_to_data, name + '.npy'), mmap_mode='r') for name in DATA_ARRAYS}
+    num_inputs, num_vel = data['train_inputs'].shape[1], data['train_velocity'].shape[1]
+    num_sens = num_inputs // 2 if config['with_phase'] else num_inputs
+    num_nodes = config['num_nodes'] or (num_sens + num_vel) * 5
+
+    start = time.perf_counter()
+    model = create_model((num_inputs, ), num_vel, num_nodes, num_hidden_layers=config['num_hidden_layers'],
+                         hidden_layer_activation=config['hidden_layer_activation'],
+                         optimizer=Adam(learning_rate=config['learning_rate']), dropout_rate=config['dropout_rate'])
+    # a point interrupted with the sweep continues from its last checkpoint
+    history = train_model(model, data['train_inputs'], data['train_velocity'], path_to_checkpoints, config['epochs'],
+                          batch_size=config['batch_size'], validation_split=config['validation_split'],
+                          patience=config['patience'], reduce_lr_patience=config['reduce_lr_patience'],
+                          reduce_lr_factor=config['reduce_lr_factor'], min_lr=config['min_lr'], verbose=0,
+                          shuffle=True)
+    train_time = time.perf_counter() - start
+    start = time.perf_counter()
+    errors = model.predict(data['eval_inputs'], verbose=0) - data['eval_velocity']
+    evaluate_time = time.perf_counter() - start
+    if path_to_model is not None:
+        model.save(path_to_model)
+
+    history = history.history
+    metrics = {key: values[-1] for key, values in history.items()}
+    metrics.update(eval_mse=float(np.mean(errors**2)), eval_mae=float(np.mean(np.abs(errors))))
+    timings = {'train': train_time, 'evaluate': evaluate_time, 'epochs': len(history.get('loss', [])),
+               'samples_per_second': config['size'] * len(history.get('loss', [])) / train_time, 'pid': os.getpid()}
+    return metrics, history, timings
+
+def run_sweep(sweep, grid, config=None, workers=None, threads_per_worker=None, store=None,
+              sweep_directory=SWEEP_DIRECTORY, save_models=False):
+    ''' Trains every point of a grid of training settings in parallel and stores the results
+
+    Points that are already in the store for this sweep are skipped, so rerunning an interrupted sweep or
+    adding values to the grid only trains the new points
+
+    Args:
+        sweep: the name of the sweep, used in the store and for the data directory
+        grid: dictionary of a setting in TRAINING_KEYS -> the list of values to try
+        config: the data and fixed training settings, see ECFM_Pipeline.DEFAULT_CONFIG. Default = None (defaults)
+        workers: the number of points trained at the same time. Default = None (min(points, cores))
+        threads_per_worker: the TensorFlow threads used by each worker. Default = None (cores // workers)
+        store: the SweepStore the results are saved in. Default = None (ECFM_Sweeps/sweeps.sqlite)
+        sweep_directory: the directory of the shared data sets and saved models. Default = 'ECFM_Sweeps'
+        save_models: An option to save the Keras model of every point. Default = False
+    Returns:
+        The results of every finished point of the sweep sorted by val_mse, see SweepStore.results
+    '''
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    points = get_grid_points(grid)
+    if store is None:
+        store = SweepStore(os.path.join(sweep_directory, STORE_FILE))
+    path_to_data = os.path.join(sweep_directory, sweep + '_Data')
+    data_key = prepare_sweep_data(config, path_to_data)
+
+    finished = store.finished_keys(sweep)
+    pending = [(get_point_key(data_key, config, params), params) for params in points]
+    pending = [(key, params) for key, params in pending if key not in finished]
+    print('%s: %d of %d points to train' % (sweep, len(pending), len(points)))
+    if not pending:
+        return store.results(sweep)
+
+    num_cores = os.cpu_count() or 1
+    if workers is None:
+        workers = min(len(pending), num_cores)
+    if threads_per_worker is None:
+        threads_per_worker = max(1, num_cores // workers)
+    # TensorFlow is not fork safe so the workers are started fresh
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(threads_per_worker, )) as pool:
+        futures = {}
+        for key, params in pending:
+            path_to_checkpoints = os.path.join(sweep_directory, sweep + '_Checkpoints', key[:16])
+            path_to_model = os.path.join(sweep_directory, sweep + '_Models', key[:16]) if save_models else None
+            futures[pool.submit(_train_point, config, params, path_to_data, path_to_checkpoints,
+                                path_to_model)] = (key, params)
+        for future in as_completed(futures):
+            key, params = futures[future]
+            try:
+                metrics, history, timings = future.result()
+            except Exception as error:
+                store.save(sweep, key, params, 'failed', error=repr(error))
+                print('failed', params, repr(error))
+                continue
+            store.save(sweep, key, params, 'done', metrics, history, timings)
+            print('done', params, 'val_mse: %E' % metrics.get('val_mse', np.nan), '%.1f s' % timings['train'])
+    return store.results(sweep)
+
+def main():
+    parser = argparse.ArgumentParser(description='Train a grid of ECFM model settings in parallel')
+    parser.add_argument('sweep', help='the name of the sweep')
+    parser.add_argument('config', nargs='?', help='a json file with the data and fixed training settings')
+    parser.add_argument('--grid', required=True, help='json object of setting -> list of values')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threads-per-worker', type=int, default=None)
+    parser.add_argument('--save-models', action='store_true')
+    args = parser.parse_args()
+    config = {}
+    if args.config is not None:
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+    results = run_sweep(args.sweep, json.loads(args.grid), config, workers=args.workers,
+                        threads_per_worker=args.threads_per_worker, save_models=args.save_models)
+    for result in results:
+        print(result['params'], 'val_mse: %E' % result['metrics'].get('val_mse', np.nan),
+              'eval_mae: %E' % result['metrics'].get('eval_mae', np.nan))
+
+if __name__ == '__main__':
+    main()
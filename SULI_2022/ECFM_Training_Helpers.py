@@ -0,0 +1,205 @@
+import os
+import json
+from types import SimpleNamespace
+import tensorflow as tf
+from tensorflow import keras
+
+STATE_FILE = 'training_state.json'
+BEST_WEIGHTS_FILE = 'best.weights.h5'
+
+def load_training_state(path_to_checkpoints):
+    ''' Loads the state saved with the last checkpoint of a run, or None if the run has no checkpoint yet
+
+    Args:
+        path_to_checkpoints: the checkpoint directory of the run
+    Returns:
+        A dictionary with the completed epochs, merged history, learning rate and early stopping counters
+    '''
+    path_to_state = os.path.join(path_to_checkpoints, STATE_FILE)
+    if not os.path.isfile(path_to_state):
+        return None
+    with open(path_to_state, 'r') as f:
+        return json.load(f)
+
+def _has_lr_schedule(optimizer):
+    # the learning rate of an optimizer built with a LearningRateSchedule can not be set directly
+    return isinstance(optimizer.learning_rate, keras.optimizers.schedules.LearningRateSchedule)
+
+class TrainingCheckpoint(keras.callbacks.Callback):
+    ''' Callback that checkpoints a run and handles early stopping and reducing the learning rate on a plateau
+
+    The weights and the optimizer state are saved with tf.train.CheckpointManager together with a json state
+    holding the history so far and the counters of the early stopping and learning rate schedules, so a resumed
+    run continues exactly where the checkpoint was taken. The keras EarlyStopping and ReduceLROnPlateau
+    callbacks reset their counters at the start of every fit, which is why they are reimplemented here.
+
+    Args:
+        path_to_checkpoints: the directory the checkpoints are saved in
+        state: the state of the run, see load_training_state. Default = None (a new run)
+        run_key: identifies the settings of the run, stored with the state. Default = None
+        checkpoint_every: the number of epochs between checkpoints. Default = 1
+        max_to_keep: the number of checkpoints kept on disk. Default = 2
+        monitor: the logged metric used by early stopping and the learning rate schedule. Default = 'val_mse'
+        min_delta: the smallest decrease of monitor that counts as an improvement. Default = 0
+        patience: epochs without improvement before training stops. Default = None (no early stopping)
+        reduce_lr_patience: epochs without improvement before the learning rate is reduced. Default = None (never)
+        reduce_lr_factor: the factor the learning rate is multiplied by when it is reduced. Default = 0.5
+        min_lr: the smallest learning rate. Default = 0
+        verbose: An option to print when a checkpoint is saved or the learning rate changes. Default = 1
+    '''
+    def __init__(self, path_to_checkpoints, state=None, run_key=None, checkpoint_every=1, max_to_keep=2,
+                 monitor='val_mse', min_delta=0, patience=None, reduce_lr_patience=None, reduce_lr_factor=0.5,
+                 min_lr=0, verbose=1):
+        super().__init__()
+        self.path_to_checkpoints = path_to_checkpoints
+        self.state = state or {'epoch': 0, 'history': {}, 'best': None, 'wait': 0, 'lr_wait': 0,
+                               'stopped_early': False, 'learning_rate': None, 'run_key': run_key}
+        self.checkpoint_every = checkpoint_every
+        self.max_to_keep = max_to_keep
+        self.monitor = monitor
+        self.min_delta = min_delta
+        self.patience = patience
+        self.reduce_lr_patience = reduce_lr_patience
+        self.reduce_lr_factor = reduce_lr_factor
+        self.min_lr = min_lr
+        self.verbose = verbose
+        self.manager = None
+        self.saved_epoch = self.state['epoch']
+
+    def get_manager(self):
+        ''' Creates the CheckpointManager of the model and its optimizer once the model is known '''
+        if self.manager is None:
+            checkpoint = tf.train.Checkpoint(model=self.model, optimizer=self.model.optimizer)
+            self.manager = tf.train.CheckpointManager(checkpoint, self.path_to_checkpoints, max_to_keep=self.max_to_keep)
+        return self.manager
+
+    def restore(self):
+        ''' Restores the weights, optimizer state and learning rate of the last checkpoint '''
+        manager = self.get_manager()
+        if manager.latest_checkpoint is not None:
+            # expect_partial since the optimizer slots are only created in the first training step
+            manager.checkpoint.restore(manager.latest_checkpoint).expect_partial()
+        if self.state['learning_rate'] is not None and not _has_lr_schedule(self.model.optimizer):
+            keras.backend.set_value(self.model.optimizer.learning_rate, self.state['learning_rate'])
+
+    def save(self):
+        ''' Saves a checkpoint and then the state that belongs to it '''
+        self.get_manager().save(checkpoint_number=self.state['epoch'])
+        self.saved_epoch = self.state['epoch']
+        path_to_state = os.path.join(self.path_to_checkpoints, STATE_FILE)
+        with open(path_to_state + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent=4)
+        # replacing the file makes the new state visible only once it is complete
+        os.replace(path_to_state + '.tmp', path_to_state)
+        if self.verbose:
+            print('Saved checkpoint of epoch', self.state['epoch'])
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        state = self.state
+        for key, value in logs.items():
+            state['history'].setdefault(key, []).append(float(value))
+        state['epoch'] = epoch + 1
+        current = logs.get(self.monitor)
+        if current is not None:
+            if state['best'] is None or current < state['best'] - self.min_delta:
+                state['best'] = float(current)
+                state['wait'] = 0
+                state['lr_wait'] = 0
+                self.model.save_weights(os.path.join(self.path_to_checkpoints, BEST_WEIGHTS_FILE))
+            else:
+                state['wait'] += 1
+                state['lr_wait'] += 1
+            if (self.reduce_lr_patience is not None and state['lr_wait'] >= self.reduce_lr_patience
+                    and not _has_lr_schedule(self.model.optimizer)):
+                learning_rate = float(keras.backend.get_value(self.model.optimizer.learning_rate))
+                new_learning_rate = max(learning_rate * self.reduce_lr_factor, self.min_lr)
+                if new_learning_rate < learning_rate:
+                    keras.backend.set_value(self.model.optimizer.learning_rate, new_learning_rate)
+                    if self.verbose:
+                        print('Epoch %d: reducing the learning rate to %E' % (epoch + 1, new_learning_rate))
+                state['lr_wait'] = 0
+            if self.patience is not None and state['wait'] >= self.patience:
+                state['stopped_early'] = True
+                self.model.stop_training = True
+                if self.verbose:
+                    print('Epoch %d: early stopping, no improvement of %s in %d epochs' % (epoch + 1, self.monitor, self.patience))
+        if not _has_lr_schedule(self.model.optimizer):
+            state['learning_rate'] = float(keras.backend.get_value(self.model.optimizer.learning_rate))
+        if state['epoch'] % self.checkpoint_every == 0 or state['stopped_early']:
+            self.save()
+
+    def on_train_end(self, logs=None):
+        # the epochs since the last periodic checkpoint are not lost when training ends
+        if self.state['epoch'] != self.saved_epoch:
+            self.save()
+
+def train_model(model, inputs, targets, path_to_checkpoints, epochs, batch_size=None, validation_split=0.1,
+                resume=True, run_key=None, checkpoint_every=1, monitor='val_mse', min_delta=0, patience=None,
+                reduce_lr_patience=None, reduce_lr_factor=0.5, min_lr=0, lr_schedule=None,
+                restore_best_weights=True, verbose=1, callbacks=None, **fit_args):
+    ''' Trains a model made by create_model with checkpoints, resuming, early stopping and learning rate schedules
+
+    When path_to_checkpoints holds a checkpoint of the same run, the weights, optimizer state, learning rate and
+    early stopping counters are restored and training continues from the epoch after it. The histories of all
+    the sessions of the run are merged, so the result can be given to plot_historys like a model.fit history.
+
+    Args:
+        model: the compiled model, see create_model
+        inputs: the scaled network inputs, or a keras Sequence such as ECFMSequence
+        targets: the scaled velocity profiles, None when inputs is a Sequence
+        path_to_checkpoints: the directory the checkpoints of the run are saved in
+        epochs: the total number of epochs of the run, including those of earlier sessions
+        batch_size: the batch size. Default = None (keras default, or the Sequence batches)
+        validation_split: the fraction of the inputs used for val_mse and val_mae. Default = 0.1
+                          Use 0 with a Sequence and pass validation_data instead
+        resume: An option to continue from the last checkpoint in path_to_checkpoints. Default = True
+        run_key: identifies the settings of the run. A checkpoint with another run_key is not resumed. Default = None
+        checkpoint_every: the number of epochs between checkpoints. Default = 1
+        monitor: the metric used for early stopping, the plateau schedule and the best weights. Default = 'val_mse'
+        min_delta: the smallest decrease of monitor that counts as an improvement. Default = 0
+        patience: epochs without improvement before training stops. Default = None (no early stopping)
+        reduce_lr_patience: epochs without improvement before the learning rate is reduced. Default = None (never)
+        reduce_lr_factor: the factor the learning rate is multiplied by when it is reduced. Default = 0.5
+        min_lr: the smallest learning rate. Default = 0
+        lr_schedule: an optional function (epoch, learning_rate) -> learning_rate applied at the start of every
+                     epoch, with epoch counted from the start of the run. Default = None
+        restore_best_weights: An option to end with the weights of the epoch with the best monitor value. Default = True
+        verbose: the verbosity of model.fit and the checkpoint messages. Default = 1
+        callbacks: extra keras callbacks. Default = None
+        fit_args: any other arguments of model.fit (e.g. shuffle, workers)
+    Returns:
+        history: an object with the merged .history dictionary of every session of the run and the .epoch list
+    '''
+    os.makedirs(path_to_checkpoints, exist_ok=True)
+    state = load_training_state(path_to_checkpoints) if resume else None
+    if state is not None and state.get('run_key') != run_key:
+        if verbose:
+            print('Ignoring the checkpoints in', path_to_checkpoints, 'since they belong to another run')
+        state = None
+    checkpoint = TrainingCheckpoint(path_to_checkpoints, state=state, run_key=run_key,
+                                    checkpoint_every=checkpoint_every, monitor=monitor, min_delta=min_delta,
+                                    patience=patience, reduce_lr_patience=reduce_lr_patience,
+                                    reduce_lr_factor=reduce_lr_factor, min_lr=min_lr, verbose=verbose)
+    checkpoint.set_model(model)
+    if state is not None:
+        checkpoint.restore()
+        if verbose:
+            print('Resuming from epoch', state['epoch'])
+    else:
+        # a fresh run must not pick up the checkpoints of an older one
+        for name in os.listdir(path_to_checkpoints):
+            if name.startswith('ckpt') or name in [STATE_FILE, BEST_WEIGHTS_FILE, 'checkpoint']:
+                os.remove(os.path.join(path_to_checkpoints, name))
+
+    all_callbacks = [checkpoint] + list(callbacks or [])
+    if lr_schedule is not None:
+        all_callbacks.insert(0, keras.callbacks.LearningRateScheduler(lr_schedule))
+    if checkpoint.state['epoch'] < epochs and not checkpoint.state['stopped_early']:
+        model.fit(inputs, targets, batch_size=batch_size, epochs=epochs, initial_epoch=checkpoint.state['epoch'],
+                  validation_split=validation_split, verbose=verbose, callbacks=all_callbacks, **fit_args)
+    path_to_best = os.path.join(path_to_checkpoints, BEST_WEIGHTS_FILE)
+    if restore_best_weights and os.path.isfile(path_to_best):
+        model.load_weights(path_to_best)
+    return SimpleNamespace(history=checkpoint.state['history'], epoch=list(range(checkpoint.state['epoch'])),
+                           stopped_early=checkpoint.state['stopped_early'])
@@ -1,11 +1,398 @@
+import warnings
 import numpy as np 
-import matplotlib.pyplot as plt
-from tensorflow import keras
 from math import pi 
-from ECFM_NN_helpers import get_sensitivity
-from sklearn.metrics import mean_squared_error
+from statistics import NormalDist
+from ECFM_NN_helpers import get_sensitivity, get_pyplot, load_model_and_scaler
 
-def generate_noisy_data(velocity_profile, A, num_samples, error_factor): 
+class ErrorStatistics: 
+    ''' Streaming per component statistics of the prediction errors of a Monte Carlo run 
+
+    Batches of errors are merged with the parallel form of Welford's algorithm, so the statistics of any number 
+    of samples are kept in a few (N, ) arrays and are as accurate as computing them from all samples at once 
+
+    Args: 
+        num_components: the number of velocity components N 
+    '''
+    def __init__(self, num_components): 
+        self.count = 0
+        # running mean and sum of squared deviations of the error and of the squared error 
+        self.mean = np.zeros(num_components)
+        self.m2 = np.zeros(num_components)
+        self.mean_square = np.zeros(num_components)
+        self.m2_square = np.zeros(num_components)
+        # False only for an adaptive Monte Carlo run that used its sample budget before reaching its rtol 
+        self.converged = True
+
+    @staticmethod
+    def _merge(count, mean, m2, batch): 
+        batch_count = batch.shape[0]
+        batch_mean = np.mean(batch, axis=0)
+        batch_m2 = np.sum((batch - batch_mean)**2, axis=0)
+        total = count + batch_count
+        delta = batch_mean - mean
+        return mean + delta * batch_count / total, m2 + batch_m2 + delta**2 * count * batch_count / total
+
+    def update(self, errors): 
+        ''' Adds a (size, N) batch of prediction errors (prediction - target) [m/s] '''
+        errors = np.asarray(errors, dtype=np.float64)
+        if errors.shape[0] == 0: 
+            return self
+        self.mean, self.m2 = self._merge(self.count, self.mean, self.m2, errors)
+        self.mean_square, self.m2_square = self._merge(self.count, self.mean_square, self.m2_square, errors**2)
+        self.count += errors.shape[0]
+        return self
+
+    @property
+    def rmse(self): 
+        ''' The root mean squared error of each component [m/s] '''
+        return np.sqrt(self.mean_square)
+
+    @property
+    def std(self): 
+        ''' The sample standard deviation of the error of each component [m/s] '''
+        return np.sqrt(self.m2 / max(self.count - 1, 1))
+
+    def nrmse(self, velocity_profile): 
+        ''' The RMSE of each component normalized by the velocity it should have predicted '''
+        return self.rmse / np.asarray(velocity_profile).reshape(-1)
+
+    @property
+    def rmse_standard_error(self): 
+        ''' The standard error of the RMSE of each component [m/s] 
+
+        The standard error of the mean squared error propagated through the square root (delta method) 
+        '''
+        mean_square_error = np.sqrt(self.m2_square / max(self.count - 1, 1) / max(self.count, 1))
+        return mean_square_error / np.maximum(2 * self.rmse, np.finfo(float).tiny)
+
+    @property
+    def rmse_relative_error(self): 
+        ''' The standard error of the RMSE of each component relative to the RMSE '''
+        return self.rmse_standard_error / np.maximum(self.rmse, np.finfo(float).tiny)
+
+    def rmse_confidence_interval(self, confidence=0.95): 
+        ''' The normal approximation confidence interval of the RMSE of each component 
+
+        Args: 
+            confidence: the probability the interval holds the true RMSE. Default = 0.95 
+        Returns: 
+            lower: the (N, ) lower bounds [m/s] 
+            upper: the (N, ) upper bounds [m/s] 
+        '''
+        half_width = NormalDist().inv_cdf(0.5 + confidence / 2) * self.rmse_standard_error
+        return np.maximum(self.rmse - half_width, 0), self.rmse + half_width
+
+class NormalSampler: 
+    ''' Independent standard normal draws, the plain Monte Carlo noise 
+
+    Args: 
+        dimension: the number of noisy components M 
+        rng: the numpy Generator used for the draws. Default = None (the global np.random state) 
+        size: the total number of samples that will be drawn, when it is known in advance. Default = None 
+    '''
+    def __init__(self, dimension, rng=None, size=None): 
+        self.dimension = dimension
+        self.rng = np.random if rng is None else rng
+        self.size = size
+
+    def draw(self, size): 
+        ''' Draws a (size, dimension) array of standard normal samples '''
+        return self.rng.standard_normal((size, self.dimension))
+
+class AntitheticSampler(NormalSampler): 
+    ''' Standard normal draws in antithetic pairs z, -z, which cancel the odd order terms of the model response. 
+    This reduces the variance of odd statistics such as the mean error (stats.mean). The squared errors behind 
+    the RMSE are even in z, so the pairs do not reduce its variance and compare_sampler_variance leaves them out 
+    '''
+    def draw(self, size): 
+        z = self.rng.standard_normal(((size + 1) // 2, self.dimension))
+        return np.concatenate([z, -z])[:size]
+
+class LatinHypercubeSampler(NormalSampler): 
+    ''' Latin hypercube draws mapped to standard normals 
+
+    A Latin hypercube is only stratified as a whole. When size is given the first draw builds one hypercube of 
+    size points and the later draws are consecutive slices of it, so a run of size samples drawn in chunks is 
+    stratified over all of them, at the cost of holding the (size, dimension) noise. Otherwise, as in adaptive 
+    runs, every draw is a separate hypercube that stratifies each component into as many bins as it has samples 
+    '''
+    def __init__(self, dimension, rng=None, size=None): 
+        super().__init__(dimension, rng, size)
+        from scipy.stats import qmc
+        self.engine = qmc.LatinHypercube(dimension, seed=_get_qmc_seed(rng))
+        self.samples = np.empty((0, dimension))
+
+    def draw(self, size): 
+        if self.size is None: 
+            return _uniform_to_normal(self.engine.random(size))
+        if self.samples.shape[0] < size: 
+            # the budget is used up, or a draw is larger than it, so a new hypercube is started 
+            self.samples = _uniform_to_normal(self.engine.random(max(self.size, size)))
+        samples, self.samples = self.samples[:size], self.samples[size:]
+        return samples
+
+class SobolSampler(NormalSampler): 
+    ''' Scrambled Sobol points mapped to standard normals. Successive draws continue the same sequence and 
+    sample counts that are powers of 2 keep its balance properties 
+    '''
+    def __init__(self, dimension, rng=None, size=None): 
+        super().__init__(dimension, rng, size)
+        from scipy.stats import qmc
+        self.engine = qmc.Sobol(dimension, scramble=True, seed=_get_qmc_seed(rng))
+
+    def draw(self, size): 
+        with warnings.catch_warnings(): 
+            # the adaptive runs draw chunks that are not powers of 2 on purpose
+            warnings.simplefilter('ignore', UserWarning)
+            return _uniform_to_normal(self.engine.random(size))
+
+SAMPLERS = {'random': NormalSampler, 
+            'antithetic': AntitheticSampler, 
+            'latin_hypercube': LatinHypercubeSampler, 
+            'sobol': SobolSampler}
+
+def _get_qmc_seed(rng): 
+    # scipy.stats.qmc takes a Generator or an int seed, not the global np.random module, so np.random.seed 
+    # still makes the runs reproducible when no Generator is given
+    if isinstance(rng, np.random.Generator): 
+        return rng
+    return int((np.random if rng is None else rng).randint(2**32, dtype=np.int64))
+
+def _uniform_to_normal(uniform): 
+    from scipy.special import ndtri
+    tiny = np.finfo(float).eps
+    return ndtri(np.clip(uniform, tiny, 1 - tiny))
+
+def get_noise_sampler(sampler, dimension, rng=None, size=None): 
+    ''' Creates the sampler of the standard normal noise of a Monte Carlo run 
+
+    Args: 
+        sampler: one of 'random', 'antithetic', 'latin_hypercube' or 'sobol', or an already created sampler 
+        dimension: the number of noisy components M 
+        rng: the numpy Generator used by the sampler. Default = None (the global np.random state) 
+        size: the total number of samples that will be drawn, when it is known in advance. Default = None 
+    Returns: 
+        An object with a draw(size) method returning (size, dimension) standard normal samples 
+    '''
+    if not isinstance(sampler, str): 
+        return sampler
+    if sampler not in SAMPLERS: 
+        raise ValueError('Unknown sampler: ' + sampler + '. Use one of ' + ', '.join(SAMPLERS))
+    return SAMPLERS[sampler](dimension, rng, size)
+
+def get_velocity_predictor(model, scaler, phase_shift=None): 
+    ''' Creates a function that predicts velocities in m/s from unscaled sensitivities and phases 
+
+    Args: 
+        model: a Keras model or a NumpyModel 
+        scaler: the Scaler of the model 
+        phase_shift: the shift added to the phases before scaling. Default = None (the shift of the scaler) 
+    Returns: 
+        A function (sensitivity, phase) -> (size, N) ndarray of velocities [m/s] for (size, M) inputs. 
+        phase is ignored by models trained without phase 
+    '''
+    if phase_shift is None: 
+        phase_shift = scaler.phase_shift
+    # predict_on_batch runs a Keras model without the progress bar and per call overhead of predict
+    predict = getattr(model, 'predict_on_batch', model.predict)
+
+    def predict_velocity(sensitivity, phase=None): 
+        inputs = sensitivity / scaler.sensitivity_scale_factor
+        if scaler.with_phase: 
+            inputs = np.concatenate([inputs, (phase + phase_shift) / scaler.phase_scale_factor], axis=1)
+        return np.asarray(predict(inputs.astype(np.float32))).reshape(inputs.shape[0], -1) * scaler.max_vel
+    return predict_velocity
+
+def monte_carlo_errors(predict_velocity, velocity_profile, sensitivity, error_factor, num_samples, phase=None, 
+                       chunk_size=2**16, rng=None, rtol=None, min_samples=256, sampler='random'): 
+    ''' Propagates gaussian sensitivity noise through a model and accumulates the errors of the predictions 
+
+    The noise of a whole chunk is drawn with one call and predicted in one batch. Only one chunk of inputs and 
+    predictions is held at a time, so the memory use depends on chunk_size and not on num_samples. The one 
+    exception is the Latin hypercube noise of a run without rtol, which is drawn for all num_samples at once 
+
+    With rtol the run is adaptive: num_samples becomes the sample budget and samples are drawn until the 
+    relative standard error of the RMSE of every component is at most rtol. The size of each new chunk is the 
+    number of samples the current estimate of the relative error says are still needed, so a converged run 
+    stops close to the smallest sufficient sample count 
+
+    The noise of component j is sensitivity_j * (1 + error_factor * z_j) with z drawn by sampler. The Sobol 
+    and Latin hypercube samplers usually reach the same RMSE accuracy as independent draws with far fewer model 
+    evaluations, see compare_sampler_variance. The stopping rule treats their samples as independent, which 
+    overestimates their error, so adaptive runs with them stop later than they need to but not too early 
+
+    Args: 
+        predict_velocity: the model, see get_velocity_predictor 
+        velocity_profile: the (N, ) profile the predictions are compared to [m/s] 
+        sensitivity: the (M, ) sensitivity the noise is added to [V] 
+        error_factor: the standard deviation of the noise as a fraction of the sensitivity 
+        num_samples: the number of noisy sensitivity profiles 
+        phase: the (M, ) phases passed to the model unchanged. Default = None 
+        chunk_size: the number of samples drawn and predicted at once. Default = 2**16 
+        rng: the numpy Generator used to draw the noise. Default = None (the global np.random state) 
+        rtol: the relative standard error of the RMSE at which an adaptive run stops. Default = None (not adaptive) 
+        min_samples: the samples drawn before an adaptive run checks for convergence. Default = 256 
+        sampler: the noise sampler, see get_noise_sampler. Default = 'random' 
+    Returns: 
+        The ErrorStatistics of the prediction errors. stats.converged tells if an adaptive run reached rtol 
+    '''
+    velocity_profile = np.asarray(velocity_profile, dtype=np.float64).reshape(1, -1)
+    sensitivity = np.asarray(sensitivity, dtype=np.float64).reshape(1, -1)
+    if phase is not None: 
+        phase = np.asarray(phase, dtype=np.float64).reshape(1, -1)
+    # a fixed size run tells the sampler its budget so a Latin hypercube is stratified over all of it
+    sampler = get_noise_sampler(sampler, sensitivity.shape[1], rng, size=num_samples if rtol is None else None)
+    stats = ErrorStatistics(velocity_profile.shape[1])
+    if rtol is not None: 
+        stats.converged = False
+    size = min(chunk_size, num_samples) if rtol is None else min(min_samples, chunk_size, num_samples)
+    while size > 0: 
+        noisy_sensitivity = sensitivity * (1 + error_factor * sampler.draw(size))
+        noisy_phase = None if phase is None else np.broadcast_to(phase, noisy_sensitivity.shape)
+        stats.update(predict_velocity(noisy_sensitivity, noisy_phase) - velocity_profile)
+        size = min(chunk_size, num_samples - stats.count)
+        if rtol is not None: 
+            relative_error = np.max(stats.rmse_relative_error)
+            if relative_error <= rtol: 
+                stats.converged = True
+                break
+            # the relative error falls as 1 / sqrt(samples) 
+            needed = int(np.ceil(stats.count * (relative_error / rtol)**2)) - stats.count
+            size = min(max(needed, min_samples), size)
+    return stats
+
+def print_monte_carlo_errors(profile_type, stats, velocity_profile, confidence=0.95): 
+    ''' Prints the RMSE, its confidence interval and the NRMSE of each component of a Monte Carlo run '''
+    print('Uncertainty Monte Carlo:', profile_type, 'errors')
+    lower, upper = stats.rmse_confidence_interval(confidence)
+    for i, (error, normalized_error) in enumerate(zip(stats.rmse, stats.nrmse(velocity_profile))): 
+        print('component:', i, 'RMSE: {:.4f} m/s'.format(error), 
+              '{:.0%} CI: [{:.4f}, {:.4f}] m/s'.format(confidence, lower[i], upper[i]), 
+              'NRMSE: {:.0%}'.format(normalized_error))
+    print('samples:', stats.count, '' if stats.converged else '(sample budget reached before converging)')
+
+def get_velocity_jacobian(model, scaler, sensitivity, phase=None, phase_shift=None): 
+    ''' Computes the derivatives of the predicted velocities with respect to the measured sensitivities 
+
+    A NumpyModel gives its Jacobian from the exported weights, a Keras model by automatic differentiation. 
+    The phases are not noisy, so only the sensitivity columns of the Jacobian are kept 
+
+    Args: 
+        model: a Keras model or a NumpyModel 
+        scaler: the Scaler of the model. A NumpyModel can be its own scaler 
+        sensitivity: the (M, ) sensitivity the derivatives are taken at [V] 
+        phase: the (M, ) phases for models trained with phase [Radians]. Default = None 
+        phase_shift: the shift added to the phases before scaling. Default = None (the shift of the scaler) 
+    Returns: 
+        (N, M) ndarray of d velocity_i / d sensitivity_j [m/s / V] 
+    '''
+    if phase_shift is None: 
+        phase_shift = scaler.phase_shift
+    sensitivity = np.asarray(sensitivity, dtype=np.float64).reshape(1, -1)
+    inputs = sensitivity / scaler.sensitivity_scale_factor
+    if scaler.with_phase: 
+        phase = np.asarray(phase, dtype=np.float64).reshape(1, -1)
+        inputs = np.concatenate([inputs, (phase + phase_shift) / scaler.phase_scale_factor], axis=1)
+    if hasattr(model, 'jacobian'): 
+        jacobian = model.jacobian(inputs)[0]
+    else: 
+        import tensorflow as tf
+        inputs = tf.constant(inputs, dtype=tf.float32)
+        with tf.GradientTape() as tape: 
+            tape.watch(inputs)
+            outputs = model(inputs, training=False)
+        jacobian = tape.batch_jacobian(outputs, inputs).numpy()[0].astype(np.float64)
+    return jacobian[:, :sensitivity.shape[1]] * scaler.max_vel / scaler.sensitivity_scale_factor
+
+class LinearizedErrors: 
+    ''' First order (linearized) statistics of the prediction errors for gaussian sensitivity noise 
+
+    The model is replaced by its tangent at the measured sensitivity, so the noise with standard deviation 
+    error_factor * sensitivity gives gaussian velocity errors with covariance J diag(sigma**2) J^T around the 
+    error of the noiseless prediction. This is exact for small noise and misses the curvature of the model 
+
+    Args: 
+        mean: the (N, ) error of the noiseless prediction [m/s] 
+        covariance: the (N, N) covariance of the velocity errors [(m/s)**2] 
+    '''
+    def __init__(self, mean, covariance): 
+        self.mean = mean
+        self.covariance = covariance
+
+    @property
+    def std(self): 
+        ''' The standard deviation of the error of each component [m/s] '''
+        return np.sqrt(np.diag(self.covariance))
+
+    @property
+    def rmse(self): 
+        ''' The root mean squared error of each component [m/s] '''
+        return np.sqrt(self.mean**2 + np.diag(self.covariance))
+
+    def nrmse(self, velocity_profile): 
+        ''' The RMSE of each component normalized by the velocity it should have predicted '''
+        return self.rmse / np.asarray(velocity_profile).reshape(-1)
+
+def linearized_errors(predict_velocity, jacobian, velocity_profile, sensitivity, error_factor, phase=None): 
+    ''' Propagates gaussian sensitivity noise through the linearized model, the fast alternative to monte_carlo_errors 
+
+    Args: 
+        predict_velocity: the model, see get_velocity_predictor 
+        jacobian: the (N, M) Jacobian of the model at sensitivity, see get_velocity_jacobian 
+        velocity_profile: the (N, ) profile the predictions are compared to [m/s] 
+        sensitivity: the (M, ) sensitivity the noise is added to [V] 
+        error_factor: the standard deviation of the noise as a fraction of the sensitivity 
+        phase: the (M, ) phases passed to the model unchanged. Default = None 
+    Returns: 
+        The LinearizedErrors of the predictions 
+    '''
+    sensitivity = np.asarray(sensitivity, dtype=np.float64).reshape(1, -1)
+    if phase is not None: 
+        phase = np.asarray(phase, dtype=np.float64).reshape(1, -1)
+    mean = predict_velocity(sensitivity, phase)[0] - np.asarray(velocity_profile, dtype=np.float64).reshape(-1)
+    variance = (error_factor * sensitivity[0])**2
+    return LinearizedErrors(mean, np.matmul(jacobian * variance, jacobian.T))
+
+def print_linearized_errors(profile_type, stats, velocity_profile): 
+    ''' Prints the RMSE, the standard deviation and the NRMSE of each component of a linearized propagation '''
+    print('Uncertainty linearized:', profile_type, 'errors')
+    for i, (error, std, normalized_error) in enumerate(zip(stats.rmse, stats.std, stats.nrmse(velocity_profile))): 
+        print('component:', i, 'RMSE: {:.4f} m/s'.format(error), 'std: {:.4f} m/s'.format(std), 
+              'NRMSE: {:.0%}'.format(normalized_error))
+
+def propagate_errors(profile_type, model, scaler, velocity_profile, sensitivity, error_factor, num_samples, 
+                     phase=None, phase_shift=None, method='monte_carlo', **monte_carlo_args): 
+    ''' Propagates the sensitivity noise through a model with either method and prints the errors 
+
+    Args: 
+        profile_type: The profile used to train the NN model 
+        model: a Keras model or a NumpyModel 
+        scaler: the Scaler of the model 
+        velocity_profile: the (N, ) profile the predictions are compared to [m/s] 
+        sensitivity: the (M, ) sensitivity the noise is added to [V] 
+        error_factor: the standard deviation of the noise as a fraction of the sensitivity 
+        num_samples: the number of noisy sensitivity profiles of the Monte Carlo method 
+        phase: the (M, ) phases passed to the model unchanged. Default = None 
+        phase_shift: the shift added to the phases before scaling. Default = None (the shift of the scaler) 
+        method: 'monte_carlo' or 'linearized', one Jacobian in place of the samples. Default = 'monte_carlo' 
+        monte_carlo_args: chunk_size, rng, rtol and sampler, see monte_carlo_errors 
+    Returns: 
+        The ErrorStatistics or LinearizedErrors of the predictions 
+    '''
+    predict_velocity = get_velocity_predictor(model, scaler, phase_shift=phase_shift)
+    if method == 'linearized': 
+        jacobian = get_velocity_jacobian(model, scaler, sensitivity, phase=phase, phase_shift=phase_shift)
+        stats = linearized_errors(predict_velocity, jacobian, velocity_profile, sensitivity, error_factor, phase=phase)
+        print_linearized_errors(profile_type, stats, velocity_profile)
+    elif method == 'monte_carlo': 
+        stats = monte_carlo_errors(predict_velocity, velocity_profile, sensitivity, error_factor, num_samples, 
+                                   phase=phase, **monte_carlo_args)
+        print_monte_carlo_errors(profile_type, stats, velocity_profile)
+    else: 
+        raise ValueError('Unknown method: ' + method + ". Use 'monte_carlo' or 'linearized'")
+    return stats
+
+def generate_noisy_data(velocity_profile, A, num_samples, error_factor, rng=None): 
     ''' Generates sensitivity profiles with noise to simulate experimental uncertainty in measurements 
 
     Args: 
@@ -13,22 +400,21 @@ def generate_noisy_data(velocity_profile, A, num_samples, error_factor):
         A: The a matrix for calculating sensitivity and phase 
         num_samples: The number of noisy profiles to be generated 
         error_factor: The amount of noise that will be used when generating the noise 
+        rng: the numpy Generator used to draw the noise. Default = None (the global np.random state) 
     Returns: 
-        velocity_profiles: A tensor of the correct velocity profiles (num_samples, num_vel_components, 1)
+        velocity_profiles: A read only broadcast view of the correct velocity profiles (num_samples, num_vel_components, 1)
         noisy_sensitivities; A tensor of the noisy sensitivies generated (num_samples, num_sesitivity_components, 1)
     '''
-    sensivity = get_sensitivity(np.matmul(A, velocity_profile.reshape(-1, 1)))
-    noisy_sensitivity =  np.zeros((num_samples, A.shape[0], 1))
-    velocity_profiles = np.zeros((num_samples, A.shape[1], 1))
-    velocity_profile = velocity_profile.reshape(-1, 1)
-    for i in range(num_samples): 
-        velocity_profiles[i] = velocity_profile
-    for i in range(len(sensivity)):
-        noisy_sensitivity[:, i] = np.random.normal(sensivity[i], error_factor * sensivity[i], num_samples).reshape(-1, 1)
+    if rng is None: 
+        rng = np.random
+    sensivity = get_sensitivity(np.matmul(A, velocity_profile.reshape(-1, 1))).reshape(1, -1, 1)
+    noisy_sensitivity = rng.normal(sensivity, error_factor * sensivity, (num_samples, A.shape[0], 1))
+    velocity_profiles = np.broadcast_to(velocity_profile.reshape(1, -1, 1), (num_samples, A.shape[1], 1))
     return velocity_profiles, noisy_sensitivity
 
 def uncertainty_monte_carlo(profile_type, A, velocity_profile, rad_pos, num_samples, error_factor, R, 
-                            band_color=None, line_color='black'): 
+                            band_color=None, line_color='black', chunk_size=2**16, rng=None, rtol=None, 
+                            sampler='random', method='monte_carlo'): 
     ''' Method performs the monte carlo uncerainty quantification on the profile with noisy sensitivities
     
     Args: 
@@ -41,35 +427,28 @@ def uncertainty_monte_carlo(profile_type, A, velocity_profile, rad_pos, num_samp
         R: The inner radius of the pipe being modeled 
         band_color: The color that will be used on the error bands 
         line_color: The color that will be used when plotting the base velocity profile 
+        chunk_size: the number of noisy profiles predicted at once, see monte_carlo_errors. Default = 2**16 
+        rng: the numpy Generator used to draw the noise. Default = None (the global np.random state) 
+        rtol: An option to stop once the relative standard error of every RMSE is at most rtol, with num_samples 
+              as the sample budget. Default = None (always num_samples) 
+        sampler: the noise sampler, 'random', 'antithetic', 'latin_hypercube' or 'sobol'. Default = 'random' 
+        method: 'monte_carlo', or 'linearized' to propagate the noise through the Jacobian of the model. 
+                Default = 'monte_carlo' 
     Returns:    
-        The RMSE and NRMSE for each component is printed 
+        The RMSE and NRMSE for each component are printed, with the 95% confidence interval and samples used 
+        by the Monte Carlo method 
         errors: MRSE in the velocity calculation of each profile 
     '''
+    plt = get_pyplot()
     velocity_profile = velocity_profile.reshape(-1,)
     path_to_results = profile_type + '_Velocity_Results/'
-    path_to_model = path_to_results + profile_type + '_Model'
-    path_to_params = path_to_results + 'model_params.txt'
-    model = keras.models.load_model(path_to_model)
+    model, scaler = load_model_and_scaler(profile_type)
     file_name = path_to_results + profile_type + '_error_plot.pdf'
-    with open(path_to_params, 'r') as f: 
-            # throw away phase scaling 
-            f.readline()
-            sensitivity_scale_factor = float(f.readline()[len('sensitivity_scale_factor = ' ):-1])
-            f.readline() 
-            max_vel = int(f.readline()[len('max_vel = '):-1])
-
-    velocity_profiles, noisy_sensitivities = generate_noisy_data(velocity_profile, A, num_samples, error_factor)
-    noisy_sensitivities_scaled = noisy_sensitivities / sensitivity_scale_factor
-    velocity_predictions = model.predict(noisy_sensitivities_scaled).reshape(num_samples, A.shape[1], 1)
-    velocity_predictions *= max_vel 
-
-    errors = np.zeros((A.shape[1]))
-    normalized_errors = np.zeros((A.shape[1]))
-    print('Uncertainty Monte Carlo:', profile_type, 'errors')
-    for i in range(velocity_predictions.shape[1]):
-        errors[i] = np.sqrt(mean_squared_error(velocity_profiles[:, i], velocity_predictions[:, i]))
-        normalized_errors[i] = errors[i] / np.mean(velocity_profiles[:, i])
-        print('component:', i, 'RMSE: {:.4f} m/s'.format( errors[i]), 'NRMSE: {:.0%}'.format(normalized_errors[i]))
+
+    sensitivity = get_sensitivity(np.matmul(A, velocity_profile))
+    stats = propagate_errors(profile_type, model, scaler, velocity_profile, sensitivity, error_factor, num_samples, 
+                             method=method, chunk_size=chunk_size, rng=rng, rtol=rtol, sampler=sampler)
+    errors = stats.rmse
     
     plt.figure() 
     plt.title('Uncertainty in ' + profile_type.replace('_', ' ') + ' model with {:.0%}'.format(error_factor) + ' sensitivity noise' )
@@ -83,7 +462,7 @@ def uncertainty_monte_carlo(profile_type, A, velocity_profile, rad_pos, num_samp
     plt.show()
     return errors
 
-def generate_noisy_data_with_phases(velocity_profile, A, num_samples, error_factor):
+def generate_noisy_data_with_phases(velocity_profile, A, num_samples, error_factor, rng=None):
     ''' Generates sensitivity profiles with noise to simulate experimental uncertainty in measurements 
         also generated the phases to be used. No noise is put on the phases 
 
@@ -92,30 +471,24 @@ def generate_noisy_data_with_phases(velocity_profile, A, num_samples, error_fact
         A: The a matrix for calculating sensitivity and phase 
         num_samples: The number of noisy profiles to be generated 
         error_factor: The amount of noise that will be used when generating the noise 
+        rng: the numpy Generator used to draw the noise. Default = None (the global np.random state) 
     Returns: 
-        velocity_profiles: A tensor of the correct velocity profiles (num_samples, num_vel_components, 1)
+        velocity_profiles: A read only broadcast view of the correct velocity profiles (num_samples, num_vel_components, 1)
         noisy_sensitivities; A tensor of the noisy sensitivies generated (num_samples, num_sesitivity_components, 1)
-        phases: The phases associated with the velocity profile generated (num_samples, num_sesitivity_components, 1)
+        phases: A read only broadcast view of the phases of the velocity profile (num_samples, num_sesitivity_components, 1)
     '''
-    b =  np.matmul(A, velocity_profile.reshape(-1, 1))
-    sensivity = get_sensitivity(b)
-    phase = np.angle(b)
-    noisy_sensitivity = np.zeros((num_samples, A.shape[0], 1))
-
-    phases = np.zeros((num_samples, A.shape[0], 1))
-    velocity_profiles = np.zeros((num_samples, A.shape[1], 1))
-    velocity_profile = velocity_profile.reshape(-1, 1)
-
-    for i in range(num_samples): 
-        velocity_profiles[i] = velocity_profile
-        phases[i] = phase 
-    for i in range(len(sensivity)):
-        noisy_sensitivity[:, i] = np.random.normal(sensivity[i], error_factor * sensivity[i], num_samples).reshape(-1, 1)
+    if rng is None: 
+        rng = np.random
+    b = np.matmul(A, velocity_profile.reshape(-1, 1))
+    sensivity = get_sensitivity(b).reshape(1, -1, 1)
+    noisy_sensitivity = rng.normal(sensivity, error_factor * sensivity, (num_samples, A.shape[0], 1))
+    phases = np.broadcast_to(np.angle(b).reshape(1, -1, 1), (num_samples, A.shape[0], 1))
+    velocity_profiles = np.broadcast_to(velocity_profile.reshape(1, -1, 1), (num_samples, A.shape[1], 1))
     return velocity_profiles, noisy_sensitivity, phases
 
-
 def uncertainty_monte_carlo_phases(profile_type, A, velocity_profile, rad_pos, num_samples, error_factor, R, 
-                                   band_color=None, line_color='black', phase_shift=2 * pi): 
+                                   band_color=None, line_color='black', phase_shift=2 * pi, chunk_size=2**16, rng=None, 
+                                   rtol=None, sampler='random', method='monte_carlo'): 
     ''' Method performs the monte carlo uncerainty quantification on the profile with noisy sensitivities
     
     Args: 
@@ -128,40 +501,30 @@ def uncertainty_monte_carlo_phases(profile_type, A, velocity_profile, rad_pos, n
         R: The inner radius of the pipe being modeled 
         band_color: The color that will be used on the error bands 
         line_color: The color that will be used when plotting the base velocity profile 
+        phase_shift: the shift added to the phases before scaling. Default = 2 pi 
+        chunk_size: the number of noisy profiles predicted at once, see monte_carlo_errors. Default = 2**16 
+        rng: the numpy Generator used to draw the noise. Default = None (the global np.random state) 
+        rtol: An option to stop once the relative standard error of every RMSE is at most rtol, with num_samples 
+              as the sample budget. Default = None (always num_samples) 
+        sampler: the noise sampler, 'random', 'antithetic', 'latin_hypercube' or 'sobol'. Default = 'random' 
+        method: 'monte_carlo', or 'linearized' to propagate the noise through the Jacobian of the model. 
+                Default = 'monte_carlo' 
     Returns:    
-        The RMSE and NRMSE for each component is printed 
+        The RMSE and NRMSE for each component are printed, with the 95% confidence interval and samples used 
+        by the Monte Carlo method 
         errors: MRSE in the velocity calculation of each profile 
     '''                                
+    plt = get_pyplot()
     velocity_profile = velocity_profile.reshape(-1,)
     path_to_results = profile_type + '_Velocity_Results/'
-    path_to_model = path_to_results + profile_type + '_Model'
-    path_to_params = path_to_results + 'model_params.txt'
-    model = keras.models.load_model(path_to_model)
+    model, scaler = load_model_and_scaler(profile_type)
     file_name = path_to_results + profile_type + '_error_plot.pdf'
-    
-    with open(path_to_params, 'r') as f: 
-            phase_scale_factor = float(f.readline()[len('phase_scale_factor = ' ):-1])
-            sensitivity_scale_factor = float(f.readline()[len('sensitivity_scale_factor = ' ):-1])
-            f.readline() 
-            max_vel = int(f.readline()[len('max_vel = '):-1])
-
-   
-
-    velocity_profiles, noisy_sensitivity, noisy_phases = generate_noisy_data_with_phases(velocity_profile, A, num_samples, error_factor)
-    noisy_phases += phase_shift
-    noisy_sensitivity_scaled = noisy_sensitivity / sensitivity_scale_factor
-    noisy_phases_scaled = noisy_phases / phase_scale_factor
-    noisy_input = np.ma.concatenate([noisy_sensitivity_scaled, noisy_phases_scaled], axis=1)
-    velocity_predictions = model.predict(noisy_input)
-    velocity_predictions *= max_vel
-    
-    errors = np.zeros((A.shape[1]))
-    normalized_errors = np.zeros((A.shape[1]))
-    print('Uncertainty Monte Carlo:', profile_type, 'errors')
-    for i in range(velocity_predictions.shape[1]):
-        errors[i] = np.sqrt(mean_squared_error(velocity_profiles[:, i], velocity_predictions[:, i]))
-        normalized_errors[i] = errors[i] / np.mean(velocity_profiles[:, i])
-        print('component:', i, 'RMSE: {:.4f} m/s'.format( errors[i]), 'NRMSE: {:.0%}'.format(normalized_errors[i]))
+
+    b = np.matmul(A, velocity_profile)
+    stats = propagate_errors(profile_type, model, scaler, velocity_profile, get_sensitivity(b), error_factor, 
+                             num_samples, phase=np.angle(b), phase_shift=phase_shift, method=method, 
+                             chunk_size=chunk_size, rng=rng, rtol=rtol, sampler=sampler)
+    errors = stats.rmse
     
     plt.figure() 
     plt.title('Uncertainty in ' + profile_type.replace('_', ' ') + ' model with {:.0%}'.format(error_factor) + ' sensitivity noise' )
@@ -1,8 +1,8 @@
-import keras 
 import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.metrics import mean_squared_error
-from ECFM_NN_helpers import get_with_phase_input, load_model_scaling_factors, scale_sensitivty
+from functools import lru_cache
+from ECFM_NN_helpers import get_pyplot, load_model_and_scaler, scale_sensitivty
+from ECFM_Uncertainty_Helpers import get_velocity_predictor, monte_carlo_errors
+from ECFM_Metrics_Helpers import compute_metrics, format_component_metrics
 
 def magnitude_validation(measured_mag, simulated_mag, frequencies, 
                          title_font_size=24, label_font_size=20,tick_size=14): 
@@ -21,6 +21,7 @@ def magnitude_validation(measured_mag, simulated_mag, frequencies,
         The plot is then saved as "mag_comparison.pdf" 
         A table of absolute errors between the two magnitudes is also displayed 
     '''
+    plt = get_pyplot()
     plt.figure() 
     plt.plot(frequencies, measured_mag, 'o-')
     plt.plot(frequencies, simulated_mag, 'o-')
@@ -55,6 +56,7 @@ def phase_validation(measured_phase, simulated_phase, frequencies,
         The plot is then saved as "phase_comparison.pdf" in the current directory
         A table of absolute errors between the two phases is also displayed 
     '''
+    plt = get_pyplot()
     plt.figure()
     plt.plot(frequencies, measured_phase, 'o-')
     plt.plot(frequencies, simulated_phase, 'o-')
@@ -71,33 +73,79 @@ def phase_validation(measured_phase, simulated_phase, frequencies,
         print('Frequency Index: {:2d}'.format(i + 1), 'AE [Rad]: {:2.4E}'.format(phase_errors[i][0]), 'NAE:  {:2.2%}'.format(phase_errors[i][0] / np.abs(measured_phase[i][0])))
     print('Global Average AE [Rad]: {:2.4E}'.format(np.average(phase_errors)), 'NAE:  {:2.2%}'.format(np.average(phase_errors / np.abs(measured_phase))))
 
-def sample_actual_profile(actual_rad, actual_vel, wanted_rad): 
-    ''' Given a more complete velocity profile this function samples it at the location the NN model is trained to predict 
+OUT_OF_RANGE = ['error', 'clip', 'extrapolate', 'nan']
+
+@lru_cache(maxsize=32)
+def _get_interpolation_weights(actual_rad_bytes, wanted_rad_bytes, out_of_range): 
+    # keyed on the raw bytes of the grids so a repeated grid pair reuses its weights 
+    actual_rad = np.frombuffer(actual_rad_bytes)
+    wanted_rad = np.frombuffer(wanted_rad_bytes)
+    order = np.argsort(actual_rad, kind='stable')
+    sorted_rad = actual_rad[order]
+    if sorted_rad.size < 2 or np.any(np.diff(sorted_rad) == 0): 
+        raise ValueError('actual_rad needs at least 2 distinct radial positions and no repeated ones')
+    # the interval [sorted_rad[i], sorted_rad[i + 1]] holding each wanted radius, with the end intervals 
+    # also used for the radii outside of the profile 
+    i = np.clip(np.searchsorted(sorted_rad, wanted_rad, side='right') - 1, 0, sorted_rad.size - 2)
+    weight = (wanted_rad - sorted_rad[i]) / (sorted_rad[i + 1] - sorted_rad[i])
+    outside = (wanted_rad < sorted_rad[0]) | (wanted_rad > sorted_rad[-1])
+    if np.any(outside): 
+        if out_of_range == 'error': 
+            raise ValueError('Radial positions ' + str(wanted_rad[outside]) + ' are outside of the sampled profile [' 
+                             + str(sorted_rad[0]) + ', ' + str(sorted_rad[-1]) + ']')
+        if out_of_range == 'clip': 
+            weight = np.clip(weight, 0, 1)
+        elif out_of_range == 'nan': 
+            weight[outside] = np.nan
+    lower, upper = order[i], order[i + 1]
+    for array in (lower, upper, weight): 
+        array.flags.writeable = False
+    return lower, upper, weight
 
-    Behaviour is undefined if all positions in wanted_rad are contained by actual_rad 
+def get_interpolation_weights(actual_rad, wanted_rad, out_of_range='error'): 
+    ''' Finds the linear interpolation weights that sample a profile given at actual_rad at the radii wanted_rad 
 
     Args: 
-        actual_rad: The radial positions of the velocities in the actual_vel profile 
-        actual_vel: The velocity profile that is being sampled 
-        wanted_rad: The positions at which you want to sample the actual_vel profile 
+        actual_rad: The radial positions of the sampled profiles, in any order 
+        wanted_rad: The positions at which the profiles are sampled 
+        out_of_range: what to do with wanted radii outside of actual_rad. 'error' raises a ValueError, 'clip' 
+                      holds the velocity of the nearest end, 'extrapolate' continues the end segment and 'nan' 
+                      gives nan. Default = 'error' 
     Returns: 
-        The velocity profile sampled at each location in wanted_rad 
+        lower: the index in actual_rad of the point below each wanted radius 
+        upper: the index in actual_rad of the point above each wanted radius 
+        weight: the weight of the upper point, the velocity is (1 - weight) * vel[lower] + weight * vel[upper] 
     '''
-    sample_profile = np.zeros((wanted_rad.shape[0], 1))
-    for i in range(wanted_rad.shape[0]): 
-        rad_below = [x for x in actual_rad if x<=wanted_rad[i]][-1]
-        rad_above = [x for x in actual_rad if x>wanted_rad[i]][0]
-        
-        idx_below = np.where(actual_rad == rad_below)[0][0]
-        idx_above = np.where(actual_rad == rad_above)[0][0]
+    if out_of_range not in OUT_OF_RANGE: 
+        raise ValueError('Unknown out_of_range: ' + str(out_of_range) + '. Use one of ' + ', '.join(OUT_OF_RANGE))
+    actual_rad = np.ascontiguousarray(actual_rad, dtype=np.float64).reshape(-1)
+    wanted_rad = np.ascontiguousarray(wanted_rad, dtype=np.float64).reshape(-1)
+    return _get_interpolation_weights(actual_rad.tobytes(), wanted_rad.tobytes(), out_of_range)
 
-        vel_above = actual_vel[idx_below]
-        vel_below = actual_vel[idx_above]
+def sample_actual_profile(actual_rad, actual_vel, wanted_rad, out_of_range='error'): 
+    ''' Given a more complete velocity profile this function samples it at the location the NN model is trained to predict 
 
-        slope = (vel_below - vel_above) / (rad_below - rad_above)
-        sample_profile[i] = slope * (rad_above -  wanted_rad[i]) + vel_below
+    The profiles are linearly interpolated between the two closest points of actual_rad. Many profiles on the same 
+    radial grid, like the cases of a CFD sweep, are sampled at once, and the interpolation weights of a repeated 
+    grid pair are cached 
 
-    return sample_profile
+    Args: 
+        actual_rad: The radial positions of the velocities in the actual_vel profile 
+        actual_vel: The velocity profile that is being sampled, or a (num_cases, len(actual_rad)) array of profiles 
+        wanted_rad: The positions at which you want to sample the actual_vel profile 
+        out_of_range: what to do with wanted radii outside of actual_rad, 'error', 'clip', 'extrapolate' or 'nan', 
+                      see get_interpolation_weights. Default = 'error' 
+    Returns: 
+        The velocity profile sampled at each location in wanted_rad (len(wanted_rad), 1), or 
+        (num_cases, len(wanted_rad)) for several profiles 
+    '''
+    lower, upper, weight = get_interpolation_weights(actual_rad, wanted_rad, out_of_range)
+    actual_vel = np.asarray(actual_vel, dtype=np.float64)
+    num_points = np.size(actual_rad)
+    single_profile = actual_vel.ndim == 1 or actual_vel.shape == (num_points, 1)
+    profiles = actual_vel.reshape(-1, num_points)
+    sample_profile = (1 - weight) * profiles[:, lower] + weight * profiles[:, upper]
+    return sample_profile.reshape(-1, 1) if single_profile else sample_profile
 
 def get_path_to_model(profile_type):
     ''' Gets the location where model information is stored 
@@ -120,33 +168,22 @@ def print_model_error(profile_type, actual_profile, model_profile):
         profile_type: The type of velocity profile used to train the NN 
         actual_profile: The velocity profile used as a baseline 
         model_profile: The profile predicted by the model 
+    Returns: 
+        The metrics of the prediction, see compute_metrics 
     '''
+    metrics = compute_metrics(np.reshape(actual_profile, (1, -1)), np.reshape(model_profile, (1, -1)))
     print('Actual Error in the', profile_type, 'model')
-    error_sum = 0 
-    normalized_sum = 0 
-    max_error = 0 
-    nmax_error = 0 
-    max_component = 0; 
-    for i in range(len(actual_profile)): 
-        error = np.abs(actual_profile[i] - model_profile[i])
-        normalized_error = error / actual_profile[i]
-        if normalized_error >= nmax_error: 
-            max_error = error[0] 
-            nmax_error = normalized_error[0]
-            max_component = i 
-        error_sum += error[0] 
-        normalized_sum += normalized_error[0]
-        print('Component:', i, 'MAE: {:.2f} m/s'.format(error[0]), 'NMAE: {:.0%}'.format(normalized_error[0]))
-    print('Average Error in profile MAE: {:.2f} m/s'.format(error_sum / len(actual_profile)), 'NMAE: {:.0%}'.format(normalized_sum / len(actual_profile)))
-    print('Max Error Component:', max_component, ' MAE: {:.2f} m/s'.format(max_error), 'NMAE: {:.0%}'.format(nmax_error))
+    print('\n'.join(format_component_metrics(metrics)))
     print()
     print()
+    return metrics
 
 def model_validation(profile_type, actual_profile, actual_rad_pos, model_rad_pos, actual_sensitivity,
                      title_font_size=24, 
                      label_font_size=20,
                      tick_size=14,
-                     num_samples=1000, error_factor=0.05, figsize=(5, 5)): 
+                     num_samples=1000, error_factor=0.05, figsize=(5, 5), chunk_size=2**16, rng=None, 
+                     rtol=None, sampler='random'): 
     ''' Compares the models predicted velocity profile to one generated via CFD simulation. Monte Carlo uncertainty 
         analysis is then performed adding noise to the sensitivity only 
 
@@ -162,44 +199,36 @@ def model_validation(profile_type, actual_profile, actual_rad_pos, model_rad_pos
         num_samples: the number of sensitivity profiles used in the monte carlo anlysis. Default = 1000
         error_factor: the percentage of noise added to the sensitivity profile. Default = 0.05
         figsize: the size of the pdf that is generated. Default = (5, 5)
+        chunk_size: the number of noisy profiles predicted at once, see monte_carlo_errors. Default = 2**16 
+        rng: the numpy Generator used to draw the noise. Default = None (the global np.random state) 
+        rtol: An option to stop the monte carlo analysis once the relative standard error of every RMSE is at most 
+              rtol, with num_samples as the sample budget. Default = None (always num_samples) 
+        sampler: the noise sampler, 'random', 'antithetic', 'latin_hypercube' or 'sobol'. Default = 'random' 
     Returns: 
-        No value is returned but a plot of the given profile and model guesses with error bars is generated. 
+        A plot of the given profile and model guesses with error bars is generated. 
         A table of RMSE and NRMSE is generated for the monte carlo analysis 
         A table of AE and NAE is generated for the models predictions with the given sensitivity profile 
+        base_case: the velocity profile predicted from the measurements [m/s]
+        errors: the monte carlo RMSE of each velocity component [m/s]
     '''
-    path_to_model = get_path_to_model(profile_type)[0]
-    sensitivity_scale_factor, max_vel = load_model_scaling_factors(profile_type)[1:3]
+    plt = get_pyplot()
+    model, scaler = load_model_and_scaler(profile_type)
+    sensitivity_scale_factor, max_vel = scaler.sensitivity_scale_factor, scaler.max_vel
     sensitivity_scaled = scale_sensitivty(actual_sensitivity, scale_factor=sensitivity_scale_factor)[0]
-    model = keras.models.load_model(path_to_model)
     base_case = model.predict(sensitivity_scaled.reshape(1, len(sensitivity_scaled), 1)).reshape(-1,)
     base_case *= max_vel  
-    noisy_sensitivity =  np.zeros((num_samples, len(actual_sensitivity), 1))
-    velocity_profiles = np.zeros((num_samples, len(model_rad_pos), 1))
     velocity_profile = sample_actual_profile(actual_rad_pos, actual_profile, model_rad_pos)
-
-    for i in range(num_samples): 
-        velocity_profiles[i] = velocity_profile
-    for i in range(len(actual_sensitivity)):
-        noisy_sensitivity[:, i] = np.random.normal(actual_sensitivity[i], error_factor * actual_sensitivity[i], num_samples).reshape(-1, 1)
-    
-    noisy_profiles_scaled = model.predict(noisy_sensitivity / sensitivity_scale_factor)
-    velocity_predictions =  noisy_profiles_scaled * max_vel
-
-    errors = np.zeros((len(model_rad_pos)))
-    normalized_errors = np.zeros((len(model_rad_pos)))
+    stats = monte_carlo_errors(get_velocity_predictor(model, scaler), velocity_profile, actual_sensitivity, 
+                               error_factor, num_samples, chunk_size=chunk_size, rng=rng, rtol=rtol, 
+                               sampler=sampler)
+    errors = stats.rmse
+    normalized_errors = stats.nrmse(velocity_profile)
     print('Monte Carlo Uncertainty Quantification')
-    max_error = 0
-    nmax_error = 0
-    max_idx = 0
-    for i in range(velocity_predictions.shape[1]):
-        errors[i] = np.sqrt(mean_squared_error(velocity_profiles[:, i], velocity_predictions[:, i]))
-        normalized_errors[i] = errors[i] / actual_profile[i]
-        print('component:', i, 'RMSE: {:.2f} m/s'.format( errors[i]), 'NRMSE: {:.0%}'.format(normalized_errors[i]))
-        if nmax_error <= normalized_errors[i]:
-            nmax_error = normalized_errors[i]
-            max_error = errors[i]
-            max_idx = i
-    print('Max Error Component:', max_idx, 'RMSE: {:.2f} m/s'.format(max_error), 'NRMSE: {:.0%}'.format(nmax_error))
+    print('\n'.join(format_component_metrics({'rmse': errors, 'nrmse': normalized_errors}, columns=('rmse', 'nrmse'), 
+                                              label='component:', average=False)))
+    max_idx = int(np.argmax(normalized_errors))
+    lower, upper = stats.rmse_confidence_interval()
+    print('Samples:', stats.count, 'Max Error Component 95% CI: [{:.2f}, {:.2f}] m/s'.format(lower[max_idx], upper[max_idx]))
     plt.figure(figsize=figsize)
     plt.plot(actual_rad_pos, actual_profile, '-k')
     plt.title(profile_type.replace('_With_Phase', '') + ' Model Validation', fontsize=title_font_size)
@@ -214,14 +243,16 @@ def model_validation(profile_type, actual_profile, actual_rad_pos, model_rad_pos
     plt.savefig(file_name, format='pdf', bbox_inches='tight')
     plt.show()
 
-    print_model_error(profile_type, sample_actual_profile(actual_rad_pos, actual_profile, model_rad_pos), base_case)
+    print_model_error(profile_type, velocity_profile, base_case)
+    return base_case, errors
 
 def model_validation_with_phase(profile_type, actual_profile, actual_rad_pos, model_rad_pos, 
                                 actual_sensitivity, actual_phase, 
                                 title_font_size=24, 
                                 label_font_size=20,
                                 tick_size=14,
-                                num_samples=1000, error_factor=0.05, figsize=(5, 5)): 
+                                num_samples=1000, error_factor=0.05, figsize=(5, 5), chunk_size=2**16, rng=None, 
+                                rtol=None, sampler='random', phase_shift=None): 
     ''' Compares the models predicted velocity profile to one generated via CFD simulation. Monte Carlo uncertainty 
         analysis is then performed adding noise to the sensitivity only 
 
@@ -238,53 +269,39 @@ def model_validation_with_phase(profile_type, actual_profile, actual_rad_pos, mo
         num_samples: the number of sensitivity profiles used in the monte carlo anlysis. Default = 1000
         error_factor: the percentage of noise added to the sensitivity profile. Default = 0.05
         figsize: the size of the pdf that is generated. Default = (5, 5)
+        chunk_size: the number of noisy profiles predicted at once, see monte_carlo_errors. Default = 2**16 
+        rng: the numpy Generator used to draw the noise. Default = None (the global np.random state) 
+        rtol: An option to stop the monte carlo analysis once the relative standard error of every RMSE is at most 
+              rtol, with num_samples as the sample budget. Default = None (always num_samples) 
+        sampler: the noise sampler, 'random', 'antithetic', 'latin_hypercube' or 'sobol'. Default = 'random' 
+        phase_shift: the shift added to the measured phases before scaling. Default = None (the shift the model 
+                     was trained with, 0 for models without a manifest) 
     Returns: 
-        No value is returned but a plot of the given profile and model guesses with error bars is generated. 
+        A plot of the given profile and model guesses with error bars is generated. 
         A table of RMSE and NRMSE is generated for the monte carlo analysis 
         A table of AE and NAE is generated for the models predictions with the given sensitivity profile 
+        base_case: the velocity profile predicted from the measurements [m/s]
+        errors: the monte carlo RMSE of each velocity component [m/s]
     '''
-    path_to_model = get_path_to_model(profile_type)[0]
-    phase_scale_factor, sensitivity_scale_factor, max_vel = load_model_scaling_factors(profile_type)
-    scaled_input = get_with_phase_input(actual_sensitivity.reshape(1, -1, 1), actual_phase.reshape(1, -1, 1), 
-                                        sensitivity_scale_factor=sensitivity_scale_factor, 
-                                        phase_scale_factor=phase_scale_factor)[0]
-    model = keras.models.load_model(path_to_model)
-    base_case = model.predict(scaled_input).reshape(-1,)
-    base_case *= max_vel 
-    
+    plt = get_pyplot()
+    model, scaler = load_model_and_scaler(profile_type)
+    # the measurement and the Monte Carlo run are scaled and shifted the same way as the training inputs 
+    predict_velocity = get_velocity_predictor(model, scaler, phase_shift=phase_shift)
+    base_case = predict_velocity(np.reshape(actual_sensitivity, (1, -1)), np.reshape(actual_phase, (1, -1))).reshape(-1,)
      
-    noisy_sensitivity = np.zeros((num_samples, len(actual_sensitivity), 1))
-    phases = np.zeros((num_samples, len(actual_sensitivity), 1))
-    velocity_profiles = np.zeros((num_samples, len(model_rad_pos), 1))
     velocity_profile = sample_actual_profile(actual_rad_pos, actual_profile, model_rad_pos)
-
-    for i in range(num_samples): 
-        velocity_profiles[i] = velocity_profile
-        phases[i] = actual_phase
-    for i in range(len(actual_sensitivity)):
-        noisy_sensitivity[:, i] = np.random.normal(actual_sensitivity[i], error_factor * actual_sensitivity[i], num_samples).reshape(-1, 1)
-    
-    scaled_input = get_with_phase_input(noisy_sensitivity, phases, 
-                                        sensitivity_scale_factor=sensitivity_scale_factor, 
-                                        phase_scale_factor=phase_scale_factor)[0]
-    noisy_profiles_scaled = model.predict(scaled_input)
-    velocity_predictions =  noisy_profiles_scaled * max_vel
-
-    errors = np.zeros((len(model_rad_pos)))
-    normalized_errors = np.zeros((len(model_rad_pos)))
+    stats = monte_carlo_errors(predict_velocity, velocity_profile, 
+                               actual_sensitivity, error_factor, num_samples, phase=actual_phase, 
+                               chunk_size=chunk_size, rng=rng, rtol=rtol, 
+                               sampler=sampler)
+    errors = stats.rmse
+    normalized_errors = stats.nrmse(velocity_profile)
     print('Monte Carlo Uncertainty Quantification')
-    max_error = 0
-    nmax_error = 0
-    max_idx = 0
-    for i in range(velocity_predictions.shape[1]):
-        errors[i] = np.sqrt(mean_squared_error(velocity_profiles[:, i], velocity_predictions[:, i]))
-        normalized_errors[i] = errors[i] / actual_profile[i]
-        print('component:', i, 'RMSE: {:.2f} m/s'.format( errors[i]), 'NRMSE: {:.0%}'.format(normalized_errors[i]))
-        if nmax_error <= normalized_errors[i]:
-            nmax_error = normalized_errors[i]
-            max_error = errors[i]
-            max_idx = i
-    print('Max Error Component:', max_idx, 'RMSE: {:.2f} m/s'.format(max_error), 'NRMSE: {:.0%}'.format(nmax_error))
+    print('\n'.join(format_component_metrics({'rmse': errors, 'nrmse': normalized_errors}, columns=('rmse', 'nrmse'), 
+                                              label='component:', average=False)))
+    max_idx = int(np.argmax(normalized_errors))
+    lower, upper = stats.rmse_confidence_interval()
+    print('Samples:', stats.count, 'Max Error Component 95% CI: [{:.2f}, {:.2f}] m/s'.format(lower[max_idx], upper[max_idx]))
     plt.figure(figsize=figsize)
     plt.plot(actual_rad_pos * 100, actual_profile, '-k')
     plt.title(profile_type.replace('_With_Phase', '') + ' Model Validation', fontsize=title_font_size)
@@ -301,7 +318,8 @@ def model_validation_with_phase(profile_type, actual_profile, actual_rad_pos, mo
     plt.savefig(file_name, format='pdf', bbox_inches='tight')
     plt.show()
 
-    print_model_error(profile_type, sample_actual_profile(actual_rad_pos, actual_profile, model_rad_pos), base_case)
+    print_model_error(profile_type, velocity_profile, base_case)
+    return base_case, errors
 
 
 
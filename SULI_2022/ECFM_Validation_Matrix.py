@@ -0,0 +1,357 @@
+''' Validates every trained ECFM model against every measured case and collects the errors in one table
+
+Each model is loaded once and run on all the cases, with the models running in parallel threads. The model
+exported with export_numpy_model is used when it exists, since it needs neither TensorFlow nor a lock. The
+result is a tidy table with one row per model, case and velocity component, and a summary that ranks the
+models by their mean errors. The validation figures are rendered one at a time in a background thread once the
+table and summary are saved, since matplotlib is not thread safe.
+
+A case is a directory with the files of ECFM_Validation_Inputs (ECFM_measured_sensitivity.csv,
+ECFM_measured_phase_radian.csv, ECFM_rad_pos.csv and ECFM_CFD_velocity.csv). The cases directory is either
+one case or holds one case per subdirectory.
+
+Usage:
+    python ECFM_Validation_Matrix.py --cases ECFM_Validation_Cases --samples 10000 --workers 4
+    python ECFM_Validation_Matrix.py --models Done Done_With_Phase --no-figures
+'''
+import os
+import csv
+import glob
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ECFM_NN_helpers import MANIFEST_FILE, get_pyplot, load_model_and_scaler
+from ECFM_Input_Helpers import INPUT_DIRECTORY, load_ecfm_inputs
+from ECFM_Metrics_Helpers import compute_metrics
+from ECFM_Inference_Helpers import get_path_to_numpy_model, load_numpy_model
+from ECFM_Uncertainty_Helpers import (get_velocity_predictor, get_velocity_jacobian, linearized_errors,
+                                      monte_carlo_errors, SAMPLERS)
+from ECFM_Validation_Helpers import sample_actual_profile
+from ECFM_Pipeline import DEFAULT_CONFIG, load_validation_inputs, use_agg_backend
+
+MATRIX_DIRECTORY = 'ECFM_Validation_Matrix'
+TABLE_FILE = 'validation_matrix.csv'
+SUMMARY_FILE = 'validation_summary.csv'
+RESULTS_SUFFIX = '_Velocity_Results'
+CASE_FILES = ['ECFM_measured_sensitivity.csv', 'ECFM_measured_phase_radian.csv', 'ECFM_rad_pos.csv',
+              'ECFM_CFD_velocity.csv']
+
+def find_models(directory='.'):
+    ''' Finds the profile types of every trained model saved in a *_Velocity_Results directory
+
+    Args:
+        directory: the directory holding the results directories. Default = '.'
+    Returns:
+        The sorted list of profile types
+    '''
+    profile_types = []
+    for path in glob.glob(os.path.join(directory, '*' + RESULTS_SUFFIX)):
+        profile_type = os.path.basename(path)[:-len(RESULTS_SUFFIX)]
+        if (os.path.isfile(os.path.join(path, MANIFEST_FILE)) or os.path.isdir(os.path.join(path, profile_type + '_Model'))
+                or os.path.isfile(os.path.join(path, profile_type + '_Model.npz'))):
+            profile_types.append(profile_type)
+    return sorted(profile_types)
+
+def find_cases(cases_directory):
+    ''' Finds the measured cases in a directory
+
+    Args:
+        cases_directory: a case directory, or a directory with one case per subdirectory
+    Returns:
+        dict of case name -> case directory, sorted by name
+    '''
+    def is_case(path):
+        return all(os.path.isfile(os.path.join(path, name)) for name in CASE_FILES)
+    if is_case(cases_directory):
+        return {os.path.basename(os.path.normpath(cases_directory)): cases_directory}
+    cases = {}
+    for name in sorted(os.listdir(cases_directory)):
+        if is_case(os.path.join(cases_directory, name)):
+            cases[name] = os.path.join(cases_directory, name)
+    if not cases:
+        raise ValueError('No validation cases with ' + ', '.join(CASE_FILES) + ' in ' + cases_directory)
+    return cases
+
+def load_cases(cases, num_sens, phase_offset=DEFAULT_CONFIG['phase_offset'],
+               phase_unwrap=DEFAULT_CONFIG['phase_unwrap']):
+    ''' Loads the measurements and CFD profile of every case, see ECFM_Pipeline.load_validation_inputs
+
+    Args:
+        cases: dict of case name -> case directory, see find_cases
+        num_sens: the number of frequencies loaded, the most any of the models use
+        phase_offset: added to the measured phases. Default = ECFM_Pipeline.DEFAULT_CONFIG['phase_offset']
+        phase_unwrap: the [start, stop) frequencies whose phases get 2 pi added. Default = DEFAULT_CONFIG['phase_unwrap']
+    Returns:
+        dict of case name -> dict with the sensitivity, phase, cfd_rad_pos and cfd_vel_profile arrays
+    '''
+    loaded = {}
+    for name, directory in cases.items():
+        config = {'validation_directory': directory, 'phase_offset': phase_offset, 'phase_unwrap': phase_unwrap}
+        sensitivity, phase, cfd_rad_pos, cfd_vel_profile = load_validation_inputs(config, num_sens)
+        loaded[name] = {'sensitivity': sensitivity.reshape(-1), 'phase': phase.reshape(-1),
+                        'cfd_rad_pos': cfd_rad_pos, 'cfd_vel_profile': cfd_vel_profile}
+    return loaded
+
+def load_validation_model(profile_type, backend='auto'):
+    ''' Loads a model and its scaler for validation
+
+    Args:
+        profile_type: The type of profile used to train the model
+        backend: 'numpy' for the export of export_numpy_model, 'keras' for the saved Keras model or 'auto' to
+                 use the NumPy export when it exists. Default = 'auto'
+    Returns:
+        model: a NumpyModel or Keras model
+        scaler: the Scaler of the model, the NumpyModel itself for the NumPy backend
+    '''
+    if backend == 'numpy' or (backend == 'auto' and os.path.isfile(get_path_to_numpy_model(profile_type))):
+        model = load_numpy_model(profile_type)
+        return model, model
+    return load_model_and_scaler(profile_type)
+
+def get_num_frequencies(model, scaler):
+    ''' Gets the number of frequencies a NumpyModel or Keras model takes, see get_frequency_index '''
+    num_inputs = model.num_inputs if hasattr(model, 'num_inputs') else model.input_shape[1]
+    return num_inputs // 2 if scaler.with_phase else num_inputs
+
+def validate_model(profile_type, cases, rad_pos, num_samples=1000, error_factor=0.05, method='monte_carlo',
+                   seed=0, sampler='random', rtol=None, backend='auto', out_of_range='error'):
+    ''' Predicts every case with one model and propagates the sensitivity noise of each
+
+    The phases are shifted by the phase shift each model was trained with, as in model_validation_with_phase.
+    Each model gets the first frequencies of the cases, as many as it was trained on
+
+    Args:
+        profile_type: The type of profile used to train the model
+        cases: the loaded cases, see load_cases
+        rad_pos: the radial positions where the model predicts velocities [m]
+        num_samples: the number of noisy sensitivity profiles per case. Default = 1000
+        error_factor: the standard deviation of the noise as a fraction of the sensitivity. Default = 0.05
+        method: 'monte_carlo' or 'linearized', see propagate_errors. Default = 'monte_carlo'
+        seed: the seed of the noise, the same for every model and case. Default = 0
+        sampler: the noise sampler, see get_noise_sampler. Default = 'random'
+        rtol: the relative standard error of the RMSE at which the Monte Carlo runs stop. Default = None
+        backend: see load_validation_model. Default = 'auto'
+        out_of_range: how model radii outside of the CFD profile are sampled, see sample_actual_profile. Default = 'error'
+    Returns:
+        list with a dictionary per case of the model, case, actual and predicted profiles, RMSE and samples used
+    '''
+    model, scaler = load_validation_model(profile_type, backend)
+    predict_velocity = get_velocity_predictor(model, scaler)
+    num_freq = get_num_frequencies(model, scaler)
+    results = []
+    for name, case in cases.items():
+        sensitivity, phase = case['sensitivity'][:num_freq], case['phase'][:num_freq]
+        actual = sample_actual_profile(case['cfd_rad_pos'], case['cfd_vel_profile'], rad_pos, out_of_range).reshape(-1)
+        predicted = predict_velocity(sensitivity.reshape(1, -1), phase.reshape(1, -1))[0]
+        if method == 'linearized':
+            jacobian = get_velocity_jacobian(model, scaler, sensitivity, phase=phase)
+            stats = linearized_errors(predict_velocity, jacobian, actual, sensitivity, error_factor, phase=phase)
+            samples = 0
+        else:
+            stats = monte_carlo_errors(predict_velocity, actual, sensitivity, error_factor, num_samples, phase=phase,
+                                       rng=np.random.default_rng(seed), rtol=rtol, sampler=sampler)
+            samples = stats.count
+        results.append({'model': profile_type, 'case': name, 'actual': actual, 'predicted': predicted,
+                        'rmse': stats.rmse, 'samples': samples})
+    return results
+
+def run_validation_matrix(profile_types=None, cases_directory=DEFAULT_CONFIG['validation_directory'],
+                          input_directory=INPUT_DIRECTORY, workers=None, phase_offset=DEFAULT_CONFIG['phase_offset'],
+                          phase_unwrap=DEFAULT_CONFIG['phase_unwrap'], **validate_args):
+    ''' Validates every model against every case, the models running in parallel threads
+
+    NumPy and TensorFlow release the GIL while predicting, so the threads overlap the model evaluations
+
+    Args:
+        profile_types: the models to validate. Default = None (every model found by find_models)
+        cases_directory: the directory of the cases, see find_cases. Default = 'ECFM_Validation_Inputs'
+        input_directory: the directory of the COMSOL inputs, see load_ecfm_inputs. Default = 'ECFM_Inputs'
+        workers: the number of models validated at once. Default = None (ThreadPoolExecutor default)
+        phase_offset: added to the measured phases. Default = ECFM_Pipeline.DEFAULT_CONFIG['phase_offset']
+        phase_unwrap: the [start, stop) frequencies whose phases get 2 pi added. Default = DEFAULT_CONFIG['phase_unwrap']
+        validate_args: num_samples, error_factor, method, seed, sampler, rtol, backend and out_of_range,
+                       see validate_model
+    Returns:
+        results: list of the validate_model results of every model and case, in model then case order
+        cases: the loaded cases, see load_cases
+        rad_pos: the radial positions of the velocity components [m]
+        failures: dict of profile type -> error message for the models that could not be validated
+    '''
+    if profile_types is None:
+        profile_types = find_models()
+    # every frequency is loaded, validate_model gives each model the ones it was trained on
+    A, rad_pos, freq = load_ecfm_inputs(input_directory)
+    cases = load_cases(find_cases(cases_directory), A.shape[0], phase_offset, phase_unwrap)
+    results = {}
+    failures = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(validate_model, profile_type, cases, rad_pos, **validate_args): profile_type
+                   for profile_type in profile_types}
+        for future in as_completed(futures):
+            profile_type = futures[future]
+            try:
+                results[profile_type] = future.result()
+            except Exception as error:
+                failures[profile_type] = '%s: %s' % (type(error).__name__, error)
+                print('Failed to validate', profile_type, '-', failures[profile_type])
+    results = [result for profile_type in profile_types if profile_type in results for result in results[profile_type]]
+    return results, cases, rad_pos, failures
+
+def compute_matrix_metrics(results):
+    ''' Computes the errors of every model, case and velocity component at once with compute_metrics
+
+    Args:
+        results: the results of run_validation_matrix
+    Returns:
+        dict with the models and cases in the order of the results, the (num_models, num_cases, N) actual and
+        predicted profiles and the metrics. The metrics hold the (num_models, num_cases, N) mae and nmae of the
+        prediction from the measurement and the rmse and nrmse of the noisy predictions
+    '''
+    models = list(dict.fromkeys(result['model'] for result in results))
+    cases = list(dict.fromkeys(result['case'] for result in results))
+    shape = (len(models), len(cases), len(results[0]['actual']))
+    actual, predicted, rmse = np.full(shape, np.nan), np.full(shape, np.nan), np.full(shape, np.nan)
+    for result in results:
+        index = (models.index(result['model']), cases.index(result['case']))
+        actual[index], predicted[index], rmse[index] = result['actual'], result['predicted'], result['rmse']
+    # every case is one sample, so the metrics over the samples axis are those of each component
+    metrics = compute_metrics(actual[:, :, np.newaxis], predicted[:, :, np.newaxis])
+    metrics = {'mae': metrics['mae'], 'nmae': metrics['nmae'], 'rmse': rmse}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics['nrmse'] = rmse / np.abs(actual)
+    return {'models': models, 'cases': cases, 'actual': actual, 'predicted': predicted, 'metrics': metrics}
+
+def get_matrix_table(matrix, rad_pos):
+    ''' Turns the matrix metrics into a tidy table with one row per model, case and velocity component
+
+    Args:
+        matrix: the metrics of compute_matrix_metrics
+        rad_pos: the radial positions of the velocity components [m]
+    Returns:
+        list of dictionaries with the model, case, component, radial_position, actual, predicted, mae, nmae, rmse
+        and nrmse of each row
+    '''
+    num_models, num_cases, num_components = matrix['actual'].shape
+    columns = {'model': np.repeat(matrix['models'], num_cases * num_components),
+               'case': np.tile(np.repeat(matrix['cases'], num_components), num_models),
+               'component': np.tile(np.arange(num_components), num_models * num_cases),
+               'radial_position': np.tile(np.asarray(rad_pos, dtype=np.float64).reshape(-1), num_models * num_cases),
+               'actual': matrix['actual'].reshape(-1),
+               'predicted': matrix['predicted'].reshape(-1)}
+    columns.update({column: values.reshape(-1) for column, values in matrix['metrics'].items()})
+    return [dict(zip(columns, row)) for row in zip(*[values.tolist() for values in columns.values()])]
+
+def summarize_matrix(matrix, sort_by='nmae'):
+    ''' Averages the errors of each model over its cases and components
+
+    Args:
+        matrix: the metrics of compute_matrix_metrics
+        sort_by: the column the models are ranked by, smallest first. Default = 'nmae'
+    Returns:
+        list with a dictionary per model of its mean errors, the largest nmae and the number of cases
+    '''
+    metrics = matrix['metrics']
+    columns = {column: np.mean(metrics[column], axis=(1, 2)) for column in ['mae', 'nmae', 'rmse', 'nrmse']}
+    columns['max_nmae'] = np.max(metrics['nmae'], axis=(1, 2))
+    summary = [dict(model=model, cases=len(matrix['cases']), **{column: values[i].item() for column, values in columns.items()})
+               for i, model in enumerate(matrix['models'])]
+    return sorted(summary, key=lambda entry: entry[sort_by])
+
+def save_table(rows, path_to_file):
+    ''' Saves a list of dictionaries with the same keys as a csv file '''
+    with open(path_to_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+def print_summary(summary):
+    ''' Prints the model ranking of summarize_matrix '''
+    print('%-28s %6s %10s %8s %10s %8s %9s' % ('model', 'cases', 'MAE [m/s]', 'NMAE', 'RMSE [m/s]', 'NRMSE', 'max NMAE'))
+    for entry in summary:
+        print('%-28s %6d %10.3f %8.1f%% %10.3f %7.1f%% %8.1f%%' % (entry['model'], entry['cases'], entry['mae'],
+                                                                  100 * entry['nmae'], entry['rmse'],
+                                                                  100 * entry['nrmse'], 100 * entry['max_nmae']))
+
+def render_validation_figure(result, case, rad_pos, path_to_file, figsize=(5, 5), title_font_size=24,
+                             label_font_size=20, tick_size=14):
+    ''' Saves the validation plot of model_validation_with_phase for one model and case
+
+    The figure is made with the object oriented matplotlib API rather than pyplot, so it can be rendered outside
+    of the main thread
+    '''
+    from matplotlib.figure import Figure
+    figure = Figure(figsize=figsize)
+    ax = figure.add_subplot()
+    actual = result['actual']
+    ax.plot(case['cfd_rad_pos'] * 100, case['cfd_vel_profile'], '-k')
+    ax.plot(rad_pos * 100, result['predicted'], '-o', color='C01')
+    ax.fill_between(rad_pos * 100, actual - result['rmse'], actual + result['rmse'])
+    ax.set_title(result['model'].replace('_With_Phase', '') + ' Model Validation', fontsize=title_font_size)
+    ax.set_xlabel('Radial Position [cm]', fontsize=label_font_size)
+    ax.set_ylabel('Velocity [m/s]', fontsize=label_font_size)
+    ax.tick_params(axis='x', labelsize=tick_size)
+    ax.tick_params(axis='y', labelsize=tick_size)
+    ax.legend(['CFD', 'NN'], fontsize=16)
+    figure.savefig(path_to_file, format='pdf', bbox_inches='tight')
+    return path_to_file
+
+def render_figures(results, cases, rad_pos, path_to_figures):
+    ''' Starts rendering the validation figure of every model and case in a background thread
+
+    The figures are rendered one after the other, matplotlib is not safe to use from several threads at once
+
+    Args:
+        results: the results of run_validation_matrix
+        cases: the loaded cases, see load_cases
+        rad_pos: the radial positions of the velocity components [m]
+        path_to_figures: the directory the figures are saved in as <model>_<case>_Validation_plot.pdf
+    Returns:
+        The list of futures of the saved figure paths, wait on them before the process exits
+    '''
+    os.makedirs(path_to_figures, exist_ok=True)
+    # sets the plot fonts before the thread starts
+    get_pyplot()
+    executor = ThreadPoolExecutor(max_workers=1)
+    futures = [executor.submit(render_validation_figure, result, cases[result['case']], rad_pos,
+                               os.path.join(path_to_figures, result['model'] + '_' + result['case'] + '_Validation_plot.pdf'))
+               for result in results]
+    executor.shutdown(wait=False)
+    return futures
+
+def main():
+    parser = argparse.ArgumentParser(description='Validate every ECFM model against every measured case')
+    parser.add_argument('--models', nargs='*', default=None, help='the profile types, default every saved model')
+    parser.add_argument('--cases', default=DEFAULT_CONFIG['validation_directory'])
+    parser.add_argument('--inputs', default=INPUT_DIRECTORY)
+    parser.add_argument('--output', default=MATRIX_DIRECTORY)
+    parser.add_argument('--samples', type=int, default=1000)
+    parser.add_argument('--error-factor', type=float, default=0.05)
+    parser.add_argument('--method', choices=['monte_carlo', 'linearized'], default='monte_carlo')
+    parser.add_argument('--sampler', choices=list(SAMPLERS), default='random')
+    parser.add_argument('--rtol', type=float, default=None)
+    parser.add_argument('--backend', choices=['auto', 'numpy', 'keras'], default='auto')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-figures', action='store_true')
+    args = parser.parse_args()
+    use_agg_backend()
+    results, cases, rad_pos, failures = run_validation_matrix(args.models, args.cases, args.inputs, args.workers,
+                                                              num_samples=args.samples, error_factor=args.error_factor,
+                                                              method=args.method, seed=args.seed, sampler=args.sampler,
+                                                              rtol=args.rtol, backend=args.backend)
+    if not results:
+        return 1
+    matrix = compute_matrix_metrics(results)
+    table = get_matrix_table(matrix, rad_pos)
+    summary = summarize_matrix(matrix)
+    os.makedirs(args.output, exist_ok=True)
+    save_table(table, os.path.join(args.output, TABLE_FILE))
+    save_table(summary, os.path.join(args.output, SUMMARY_FILE))
+    print_summary(summary)
+    futures = [] if args.no_figures else render_figures(results, cases, rad_pos, args.output)
+    for future in as_completed(futures):
+        future.result()
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())